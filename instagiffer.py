@@ -44,6 +44,8 @@ __changelogUrl__ = "https://github.com/ex-hale/instagiffer/releases"
 __faqUrl__ = "https://github.com/ex-hale/instagiffer#faq"
 
 import hashlib
+import io
+import json
 import sys
 import os
 import shutil
@@ -58,14 +60,17 @@ import ctypes
 import locale
 import argparse
 import shlex
+import struct
+import threading
 import traceback
 from random import randrange
 from os.path import expanduser
 import configparser
 from configparser import ConfigParser, RawConfigParser
-from threading import Thread
+from threading import Lock, Thread
+from collections import OrderedDict
 from queue import Empty, Queue
-from math import gcd
+from math import ceil, gcd, pi, sin, tan
 
 # TK
 from tkinter import ttk
@@ -77,7 +82,7 @@ from tkinter.filedialog import askopenfilename, askdirectory, asksaveasfilename
 
 # PIL
 import PIL
-from PIL import ImageTk, ImageFilter, ImageDraw
+from PIL import ImageTk, ImageFilter, ImageDraw, ImageChops, ImageColor, ImageOps, GifImagePlugin
 
 # Win32 specific includes
 if sys.platform == "win32":
@@ -179,6 +184,18 @@ def GetFileExtension(filename):
     return fext
 
 
+def FrameNumbersToStr(frameNums):
+    """Sorted frame numbers as ranges, e.g. [2, 3, 4, 7] -> "2-4, 7" """
+    ranges = []
+    for frameNum in frameNums:
+        if ranges and ranges[-1][1] == frameNum - 1:
+            ranges[-1][1] = frameNum
+        else:
+            ranges.append([frameNum, frameNum])
+
+    return ", ".join(str(first) if first == last else "%d-%d" % (first, last) for first, last in ranges)
+
+
 def IsPictureFile(fileName):
     return GetFileExtension(fileName) in ["jpeg", "jpg", "png", "bmp", "tif"]
 
@@ -265,6 +282,15 @@ def DurationStrToSec(durationStr):
         return int(ms / 1000)  # Floor
 
 
+def ByteSizeStrToBytes(sizeStr):
+    """A size like 8MB, 500k or 2000000 in bytes. Units are powers of 1024. Raises ValueError"""
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmg]?)i?b?\s*$", str(sizeStr), re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid size: %s" % (sizeStr))
+
+    return int(float(match.group(1)) * 1024 ** ("", "k", "m", "g").index(match.group(2).lower()))
+
+
 def MillisecToDurationComponents(msTotal):
     secTotal = msTotal / 1000
     h = int(secTotal / 3600)
@@ -320,10 +346,43 @@ def DefaultOutputHandler(stdoutLines, stderrLines, cmd):
 
 ON_POSIX = "posix" in sys.builtin_module_names
 
+# How long RunProcess waits for output before ticking the callback anyway. The loop
+# wakes as soon as the process prints something or exits, so this only bounds how
+# stale the progress bar can get while a process is silent.
+PROCESS_IDLE_TICK_SEC = 0.1
+
+# Shortest piece of a clip worth giving its own ffmpeg when extracting in segments
+EXTRACTION_SEGMENT_MIN_SEC = 5.0
+
+# Frames are compared for near duplicates as a grid of this many by this many averaged colors
+DUPLICATE_GRID_SIZE = 32
+
+# Frames, spread over the clip, that a global palette is worked out from
+GLOBAL_PALETTE_SAMPLE_FRAMES = 12
+
+# gifsicle --lossy level of each fileOptimizerTier. 0 is lossless
+GIF_OPTIMIZER_TIERS = (("lossless", 0), ("light", 30), ("medium", 80), ("heavy", 200))
+
+# What GenerateWithinBudget tries, best first: percentages of the configured size, color counts
+# below the configured one, and keeping every frame or every second frame
+BUDGET_SCALES = (100, 90, 80, 70, 60, 50, 40, 30)
+BUDGET_COLORS = (128, 64)
+BUDGET_FRAME_STEPS = (1, 2)
+
 
 def EnqueueProcessOutput(streamId, inStream, outQueue):
     for line in iter(inStream.readline, ""):
-        outQueue.put(line)
+        outQueue.put((streamId, line))
+    outQueue.put((streamId, None))  # End of stream
+
+
+def SplitCommandLine(cmd):
+    """A command line as the list of arguments the program gets. POSIX shell rules would eat the
+    backslashes in Windows and UNC paths, so on Windows only the double quotes come off"""
+    if not ImAPC():
+        return shlex.split(cmd)
+
+    return [token[1:-1] if len(token) > 1 and token[0] == token[-1] == '"' else token for token in shlex.split(cmd, posix=False)]
 
 
 def RunProcess(
@@ -332,12 +391,15 @@ def RunProcess(
     returnOutput=False,
     callBackFinalize=True,
     outputTranslator=DefaultOutputHandler,
+    extraEnv=None,
 ):
-    """Run a process"""
+    """Run a process. Wakes up whenever the process writes output or exits rather than polling.
+    extraEnv holds environment variables to set for it on top of ours"""
     if debug_mode:
         logging.info("RunProcess: %s", str(cmd)[:200])
 
     env = os.environ.copy()
+    env.update(extraEnv or {})
 
     if ImAPC():
         startupinfo = subprocess.STARTUPINFO()
@@ -359,38 +421,59 @@ def RunProcess(
         encoding="utf-8",
         errors="replace",
     )
-    qOut = Queue()
-    qErr = Queue()
-    tOut = Thread(target=EnqueueProcessOutput, args=("OUT", pipe.stdout, qOut))
-    tErr = Thread(target=EnqueueProcessOutput, args=("ERR", pipe.stderr, qErr))
 
-    tOut.start()
-    tErr.start()
+    # Both readers feed one queue so a single blocking get() wakes us for either stream
+    qOutput = Queue()
+    readers = [
+        Thread(target=EnqueueProcessOutput, args=("OUT", pipe.stdout, qOutput), daemon=True),
+        Thread(target=EnqueueProcessOutput, args=("ERR", pipe.stderr, qOutput), daemon=True),
+    ]
+
+    for reader in readers:
+        reader.start()
 
+    openStreams = len(readers)
     callbackReturnedFalse = False
 
     stdout = ""
     stderr = ""
 
+    def Collect(item):
+        nonlocal openStreams, stdout, stderr, stdoutLines, stderrLines
+
+        streamId, line = item
+        if line is None:
+            openStreams -= 1
+        elif streamId == "OUT":
+            stdoutLines = line
+            stdout += line
+        else:
+            stderrLines = line
+            stderr += line
+
     percent = None
-    while True:
+    percentDoneInt = None
+    while openStreams > 0:
         statusStr = None
         stderrLines = None
         stdoutLines = None
+        exited = pipe.poll() is not None
+        gotOutput = False
 
+        # Block until there is output, the process closes its pipes (exit), or the idle tick expires
         try:
+            Collect(qOutput.get(timeout=PROCESS_IDLE_TICK_SEC))
+            gotOutput = True
+
             while True:  # Exhaust the queue
-                stdoutLines = qOut.get_nowait()
-                stdout += stdoutLines
+                Collect(qOutput.get_nowait())
         except Empty:
             pass
 
-        try:
-            while True:
-                stderrLines = qErr.get_nowait()
-                stderr += stderrLines
-        except Empty:
-            pass
+        # The process is gone and its output has stopped, but something it started (a helper
+        # process) still has the pipes open. Don't wait for that to exit too
+        if exited and not gotOutput:
+            break
 
         if outputTranslator is not None:
             statusStr, percentDoneInt = outputTranslator(stdoutLines, stderrLines, cmd)
@@ -411,12 +494,6 @@ def RunProcess(
             callbackReturnedFalse = True
             break
 
-        # Check if done
-        if pipe.poll() is not None:
-            break
-
-        time.sleep(0.1)  # Polling frequency. Lengthening this will decrease responsiveness
-
     # Notify callback of exit. Check callballFinalize so we don't prematurely reset the progress bar
     if callback is not None and callBackFinalize is True:
         callback(True)
@@ -427,15 +504,25 @@ def RunProcess(
 
     # result
     try:
-        remainingStdout = ""
-        remainingStderr = ""
-        remainingStdout, remainingStderr = pipe.communicate()
-    except IOError as e:
+        pipe.wait()
+    except OSError as e:
         logging.error("Encountered error communicating with sub-process" + str(e))
 
+    # Pick up whatever the readers saw after we stopped listening
+    for reader in readers:
+        reader.join(PROCESS_IDLE_TICK_SEC)
+
+    try:
+        while True:
+            Collect(qOutput.get_nowait())
+    except Empty:
+        pass
+
+    if not any(reader.is_alive() for reader in readers):
+        pipe.stdout.close()
+        pipe.stderr.close()
+
     success = pipe.returncode == 0
-    stdout += remainingStdout
-    stderr += remainingStderr
 
     # Logging
     if debug_mode:
@@ -686,6 +773,1030 @@ class ImagemagickFont:
             return 0
 
 
+class ImagemagickWorker:
+    """A long-lived 'magick -script -' process that runs frame commands streamed to it over stdin.
+
+    ImageMagick loads its configuration, delegates and fonts once when the worker starts rather than
+    once per frame. Every command runs inside its own parentheses (with -respect-parentheses) so
+    settings can't leak from one frame into the next, and is followed by a verbose write of a 1x1
+    sentinel image which tells us the command has finished.
+    """
+
+    def __init__(self, convertPath, sentinelFile, extraEnv=None):
+        self.sentinelFile = sentinelFile
+        self.output = Queue()
+
+        startupinfo = None
+        if ImAPC():
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            startupinfo.wShowWindow = subprocess.SW_HIDE
+
+        env = os.environ.copy()
+        env.update(extraEnv or {})
+
+        self.pipe = subprocess.Popen(
+            [convertPath, "-script", "-"],
+            startupinfo=startupinfo,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=1,
+            close_fds=ON_POSIX,
+            encoding="utf-8",
+            errors="replace",
+        )
+
+        for streamId, stream in (("OUT", self.pipe.stdout), ("ERR", self.pipe.stderr)):
+            Thread(target=EnqueueProcessOutput, args=(streamId, stream, self.output), daemon=True).start()
+
+        self.Send(["-respect-parentheses"])
+
+    @staticmethod
+    def QuoteToken(token):
+        if "'" not in token:
+            return "'%s'" % (token)
+        return '"%s"' % (token.replace("\\", "\\\\").replace('"', '\\"'))
+
+    def Send(self, tokens):
+        self.pipe.stdin.write(" ".join(self.QuoteToken(t) for t in tokens) + "\n")
+        self.pipe.stdin.flush()
+
+    def IsAlive(self):
+        return self.pipe.poll() is None
+
+    def Stop(self):
+        try:
+            self.pipe.stdin.close()
+        except OSError:
+            pass
+
+        try:
+            self.pipe.kill()
+            self.pipe.wait()
+        except OSError:
+            logging.error("ImagemagickWorker: kill() caused an exception")
+
+    @staticmethod
+    def IsNewOutput(outputFileName, outputBefore):
+        """True if outputFileName has been written since outputBefore was taken from os.stat"""
+        try:
+            outputAfter = os.stat(outputFileName)
+        except OSError:
+            return False
+
+        if outputBefore is None:
+            return True
+
+        return (outputAfter.st_mtime_ns, outputAfter.st_size, outputAfter.st_ino) != (outputBefore.st_mtime_ns, outputBefore.st_size, outputBefore.st_ino)
+
+    def Run(self, cmd, callback=None, outputTranslator=DefaultOutputHandler, timeoutSec=None):
+        """Run a convert command line. Returns True on success, False if the callback aborted,
+        or None if the worker couldn't run it and the caller should fall back to RunProcess"""
+        tokens = SplitCommandLine(cmd)[1:]
+
+        if len(tokens) < 2:
+            return None
+
+        outputFileName = tokens[-1]
+
+        # Frames are often rewritten in place, so the output being there afterwards isn't enough
+        try:
+            outputBefore = os.stat(outputFileName)
+        except OSError:
+            outputBefore = None
+
+        try:
+            self.Send(["("] + tokens[:-1] + ["-write", outputFileName, ")", "-delete", "0--1"])
+            self.Send(["(", "-size", "1x1", "xc:none", "-verbose", "-write", self.sentinelFile, ")", "-delete", "0--1"])
+        except (OSError, ValueError):
+            self.Stop()
+            return None
+
+        statusStr, percentDoneInt = None, None
+        if outputTranslator is not None:
+            statusStr, percentDoneInt = outputTranslator(None, None, cmd)
+
+        sentinelName = os.path.basename(self.sentinelFile)
+        failed = False
+        result = None
+        startTs = time.time()
+
+        while True:
+            try:
+                _streamId, line = self.output.get(timeout=PROCESS_IDLE_TICK_SEC)
+            except Empty:
+                line = ""
+
+            # Worker went away
+            if line is None:
+                break
+
+            if "@ error/" in line or "@ fatal" in line:
+                logging.error("ImagemagickWorker: " + line.strip())
+                failed = True
+
+            # Don't trust the worker's state after an error. Let the spawn path report it properly
+            if sentinelName in line:
+                if not failed and self.IsNewOutput(outputFileName, outputBefore):
+                    result = True
+                break
+
+            if callback is not None and callback(percentDoneInt, statusStr) == False:
+                result = False
+                break
+
+            if timeoutSec is not None and time.time() - startTs > timeoutSec:
+                logging.error("ImagemagickWorker: no response after %d seconds" % (timeoutSec))
+                break
+
+        if result is not True:
+            self.Stop()
+
+        return result
+
+
+class ImagemagickWorkerPool:
+    """Hands out persistent ImageMagick workers. Disables itself if a worker fails its first command"""
+
+    def __init__(self, convertPath, workDir, extraEnv=None):
+        self.convertPath = convertPath
+        self.workDir = workDir
+        self.extraEnv = extraEnv
+        self.idleWorkers = []
+        self.lock = Lock()
+        self.disabled = False
+        self.workersStarted = 0
+
+    def Run(self, cmd, callback=None):
+        worker = self.Acquire()
+
+        if worker is None:
+            return None
+
+        result = worker.Run(cmd, callback)
+        self.Release(worker)
+        return result
+
+    def Acquire(self):
+        with self.lock:
+            if self.disabled:
+                return None
+            if len(self.idleWorkers):
+                return self.idleWorkers.pop()
+            self.workersStarted += 1
+            workerId = self.workersStarted
+
+        try:
+            worker = ImagemagickWorker(self.convertPath, os.path.join(self.workDir, "magickworker%d.png" % (workerId)), self.extraEnv)
+        except OSError:
+            logging.error("Unable to start a persistent ImageMagick worker. Falling back to one process per frame")
+            self.disabled = True
+            return None
+
+        # Make sure this build of ImageMagick actually speaks our protocol before trusting it with frames
+        probeFile = os.path.join(self.workDir, "magickprobe%d.png" % (workerId))
+        if worker.Run('"%s" -size 1x1 xc:black "%s"' % (self.convertPath, probeFile), None, None, 10) is not True:
+            logging.error("Persistent ImageMagick worker didn't respond. Falling back to one process per frame")
+            worker.Stop()
+            self.disabled = True
+            return None
+
+        logging.info("Started persistent ImageMagick worker %d" % (workerId))
+        return worker
+
+    def Release(self, worker):
+        with self.lock:
+            if worker.IsAlive() and not self.disabled:
+                self.idleWorkers.append(worker)
+                return
+
+        worker.Stop()
+
+    def Shutdown(self):
+        with self.lock:
+            workers = self.idleWorkers
+            self.idleWorkers = []
+
+        for worker in workers:
+            worker.Stop()
+
+
+class FfmpegFrameStream:
+    """Decoded frames read straight off an ffmpeg pipe, instead of having ffmpeg encode them as PNG.
+
+    cmd must make ffmpeg write '-f rawvideo -pix_fmt rgb24' frames of width x height to stdout.
+    Iterating gives one bytes object of width * height * 3 per frame, in order. The frames don't
+    stay in memory: ExtractFramesFromStream saves them to original/, which every later stage
+    (ImageMagick included) reads from.
+    """
+
+    def __init__(self, cmd, width, height):
+        self.width = width
+        self.height = height
+        self.frameBytes = width * height * 3
+        self.errors = Queue()
+        self.endOfStream = False
+
+        startupinfo = None
+        if ImAPC():
+            startupinfo = subprocess.STARTUPINFO()
+            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+            startupinfo.wShowWindow = subprocess.SW_HIDE
+        else:
+            cmd = shlex.split(cmd)
+
+        self.pipe = subprocess.Popen(
+            cmd,
+            startupinfo=startupinfo,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=self.frameBytes,
+            close_fds=ON_POSIX,
+        )
+
+        # ffmpeg stalls if nobody drains stderr
+        errorStream = io.TextIOWrapper(self.pipe.stderr, encoding="utf-8", errors="replace")
+        self.errorReader = Thread(target=EnqueueProcessOutput, args=("ERR", errorStream, self.errors), daemon=True)
+        self.errorReader.start()
+
+    def __iter__(self):
+        while True:
+            frame = self.ReadFrame()
+            if frame is None:
+                return
+            yield frame
+
+    def ReadFrame(self):
+        """The next frame's pixels, or None once ffmpeg is done"""
+        frame = self.pipe.stdout.read(self.frameBytes)
+        if len(frame) < self.frameBytes:
+            self.endOfStream = True
+            return None
+        return frame
+
+    def ToImage(self, frame):
+        return PIL.Image.frombuffer("RGB", (self.width, self.height), frame, "raw", "RGB", 0, 1)
+
+    def Close(self):
+        """Stop ffmpeg if it's still going. Returns True if it had finished successfully"""
+        killed = False
+
+        if not self.endOfStream and self.pipe.poll() is None:
+            try:
+                self.pipe.kill()
+                killed = True
+            except OSError:
+                logging.error("FfmpegFrameStream: kill() caused an exception")
+
+        self.pipe.wait()
+        self.pipe.stdout.close()
+        self.errorReader.join(PROCESS_IDLE_TICK_SEC)
+
+        errors = ""
+        try:
+            while True:
+                _streamId, line = self.errors.get_nowait()
+                if line is not None:
+                    errors += line
+        except Empty:
+            pass
+
+        if len(errors):
+            logging.error("ffmpeg: " + errors.strip())
+
+        return not killed and self.pipe.returncode == 0
+
+
+class FrameStore:
+    """Sorted listing of the frames in one of the engine's working directories, kept in memory.
+
+    The listing and the newest modification time are read again when the directory's mtime moves
+    (a frame was added, removed or renamed) or after Invalidate(). Rewriting a frame in place doesn't
+    touch the directory, so whoever does that must call Invalidate().
+    """
+
+    # A directory changed this close to the scan can change again without its mtime moving (coarse
+    # timestamps on FAT and some kernels), so such a scan is only used once
+    RACY_WINDOW_SEC = 2.0
+
+    def __init__(self, directory, extension=None):
+        self.directory = directory
+        self.extension = extension
+        self.lock = Lock()
+        self.files = None
+        self.lastModifiedTs = 0
+        self.dirMtime = None
+
+    def Invalidate(self):
+        with self.lock:
+            self.files = None
+
+    def Refresh(self):
+        """Re-read the directory if it changed since the last scan. Call with the lock held"""
+        try:
+            dirMtime = os.stat(self.directory).st_mtime
+        except OSError:
+            dirMtime = None
+
+        if self.files is not None and self.dirMtime is not None and dirMtime == self.dirMtime:
+            return
+
+        scanTime = time.time()
+        files = []
+        lastModifiedTs = 0
+
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith(".") or (self.extension and not entry.name.endswith(self.extension)):
+                        continue
+                    try:
+                        lastModifiedTs = max(lastModifiedTs, entry.stat().st_mtime)
+                    except OSError:
+                        continue  # Removed while we were looking
+                    files.append(os.path.join(self.directory, entry.name))
+        except OSError:
+            pass
+
+        files.sort()
+        if len(files):
+            lastModifiedTs = max(lastModifiedTs, dirMtime)
+
+        self.files = files
+        self.lastModifiedTs = lastModifiedTs
+        self.dirMtime = dirMtime if dirMtime is not None and dirMtime < scanTime - self.RACY_WINDOW_SEC else None
+
+    def GetList(self):
+        with self.lock:
+            self.Refresh()
+            return list(self.files)
+
+    def Count(self):
+        with self.lock:
+            self.Refresh()
+            return len(self.files)
+
+    def Exists(self):
+        return self.Count() > 0
+
+    def GetLastModifiedTs(self):
+        """Newest of the directory's and the frames' mtimes, or 0 if there are no frames"""
+        with self.lock:
+            self.Refresh()
+            return self.lastModifiedTs
+
+
+class FrameCache:
+    """Frames rendered earlier, filed under a hash of the input frame and of the command that made them.
+
+    Switching an effect off again, or going back to an earlier caption, copies the earlier results back
+    instead of running ImageMagick again. Once the cache grows past maxBytes, the least recently used
+    entries are deleted. With maxBytes 0 nothing is kept, but GetEntryName still works. Safe to use
+    from frame worker threads.
+    """
+
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.lock = Lock()
+        self.entries = OrderedDict()  # entry name -> size in bytes, least recently used first
+        self.totalBytes = 0
+        self.fileHashes = dict()  # path -> ((size, mtime, inode), digest)
+        self.hits = 0
+        self.misses = 0
+
+        if maxBytes <= 0:
+            return
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        # Pick up entries left by an earlier session, oldest first
+        found = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".tmp"):
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+                continue
+            stat = entry.stat()
+            found.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _mtime, name, size in sorted(found):
+            self.entries[name] = size
+            self.totalBytes += size
+
+    def HashFile(self, path):
+        stat = os.stat(path)
+        stamp = (stat.st_size, stat.st_mtime_ns, stat.st_ino)  # Renumbering frames renames other files over a path
+
+        with self.lock:
+            known = self.fileHashes.get(path)
+        if known is not None and known[0] == stamp:
+            return known[1]
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+
+        with self.lock:
+            self.fileHashes[path] = (stamp, digest)
+        return digest
+
+    def GetEntryName(self, inputFileName, outputFileName, cmd):
+        """Name of the entry holding the result of cmd. Besides the input, any other files the command
+        reads (cinemagraph key frame and mask, image layers) are identified by their contents. The first
+        quoted string in cmd is the program and is left as is. Raises OSError if the input is missing"""
+        operation = re.sub(r'-comment "[^"]*"', "", cmd)  # Progress reporting only
+        programAndPaths = re.findall(r'"([^"]*)"', operation)
+
+        operation = operation.replace('"%s"' % (inputFileName), "<in>").replace('"%s"' % (outputFileName), "<out>")
+        for path in programAndPaths[1:]:
+            if path not in (inputFileName, outputFileName) and os.path.isfile(path):
+                operation = operation.replace('"%s"' % (path), "<%s>" % (self.HashFile(path)))
+
+        key = hashlib.sha256()
+        key.update(self.HashFile(inputFileName).encode("ascii"))
+        key.update(operation.encode("utf-8"))
+        return key.hexdigest() + os.path.splitext(outputFileName)[1]
+
+    def Fetch(self, entryName, outputFileName):
+        """Copy a cached result to outputFileName. Returns False on a miss"""
+        if self.maxBytes <= 0:
+            return False
+
+        entryPath = os.path.join(self.directory, entryName)
+
+        with self.lock:
+            found = entryName in self.entries
+            if found:
+                self.entries.move_to_end(entryName)
+
+        if found:
+            try:
+                shutil.copyfile(entryPath, outputFileName)
+                os.utime(entryPath)  # So that recency survives a restart
+            except OSError:
+                found = False
+
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return found
+
+    def Store(self, entryName, outputFileName):
+        if self.maxBytes <= 0:
+            return
+
+        entryPath = os.path.join(self.directory, entryName)
+        tmpPath = "%s.%d.tmp" % (entryPath, threading.get_ident())  # Identical frames can finish at the same time
+
+        try:
+            shutil.copyfile(outputFileName, tmpPath)
+            os.replace(tmpPath, entryPath)
+            size = os.path.getsize(entryPath)
+        except OSError:
+            logging.error("FrameCache: unable to store %s" % (outputFileName))
+            return
+
+        evicted = []
+        with self.lock:
+            self.totalBytes += size - self.entries.get(entryName, 0)
+            self.entries[entryName] = size
+            self.entries.move_to_end(entryName)
+
+            while self.totalBytes > self.maxBytes and len(self.entries) > 1:
+                name, oldSize = self.entries.popitem(last=False)
+                self.totalBytes -= oldSize
+                evicted.append(name)
+
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def GetStats(self):
+        with self.lock:
+            return self.hits, self.misses
+
+
+class MediaProbe:
+    """What ffprobe makes of media files. Results are kept in a JSON file under the file's path, size and
+    modification time, so opening a file seen before doesn't start a process at all.
+
+    Only the first video stream is looked at. A probe is {"stream": ..., "format": ...} as ffprobe reports
+    them, plus "keyframeIntervalSec": the usual gap between keyframes in the first KEYFRAME_SCAN_SEC of the
+    file (None with fewer than two keyframes there).
+    """
+
+    KEYFRAME_SCAN_SEC = 30
+    MAX_ENTRIES = 500
+
+    def __init__(self, ffprobePath, cacheFileName):
+        self.ffprobePath = ffprobePath
+        self.cacheFileName = cacheFileName
+
+        try:
+            with open(cacheFileName, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = dict()
+
+    def Save(self):
+        # Oldest first. Probes are re-added at the end when they are refreshed
+        for path in list(self.entries)[: max(0, len(self.entries) - self.MAX_ENTRIES)]:
+            del self.entries[path]
+
+        try:
+            with open(self.cacheFileName + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(self.entries, f)
+            os.replace(self.cacheFileName + ".tmp", self.cacheFileName)
+        except OSError as e:
+            logging.error("Unable to save media probe cache: %s" % (e))
+
+    def Probe(self, path):
+        """Returns the probe for path, or None if there's no ffprobe or it can't make sense of the file"""
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        stamp = [stat.st_size, stat.st_mtime_ns]
+        entry = self.entries.get(path)
+        if entry is not None and entry["stamp"] == stamp:
+            logging.info("Media probe cache hit: " + path)
+            return entry["probe"]
+
+        if not self.ffprobePath:
+            return None
+
+        stdout, stderr = RunProcess(
+            '"%s" -v error -print_format json -select_streams v:0 -show_format -show_streams -show_entries packet=pts_time,flags -read_intervals %%+%d "%s"'
+            % (self.ffprobePath, self.KEYFRAME_SCAN_SEC, path),
+            None,
+            True,
+        )
+
+        try:
+            result = json.loads(stdout)
+            probe = {"stream": result["streams"][0], "format": result.get("format", dict())}
+        except (ValueError, KeyError, IndexError):
+            logging.error("ffprobe can't read %s: %s" % (path, stderr.strip()))
+            return None
+
+        keyframes = sorted(float(p["pts_time"]) for p in result.get("packets", []) if "K" in p.get("flags", "") and p.get("pts_time", "N/A") != "N/A")
+        gaps = sorted(b - a for a, b in zip(keyframes, keyframes[1:]) if b > a)
+        probe["keyframeIntervalSec"] = gaps[len(gaps) // 2] if len(gaps) else None
+
+        self.entries.pop(path, None)
+        self.entries[path] = {"stamp": stamp, "probe": probe}
+        self.Save()
+        return probe
+
+
+class PillowEffects:
+    """In-process stand-in for the ImageMagick effects chain in AnimatedGif.ImageProcessing.
+
+    Each step follows the formula of the ImageMagick operator it replaces, so frames from either
+    engine can sit side by side in one GIF. Settings are read once, up front. Apply can then be
+    called from frame worker threads.
+    """
+
+    # ImageMagick's default pixel intensity (Rec. 709 luma)
+    LUMA = (0.212656, 0.715158, 0.072186, 0)
+
+    # -sharpen's kernel is normalized with the center tap counted twice: amount = 1 / (1 + 1/(2 pi sigma^2))
+    SHARPEN_PERCENT = 86
+
+    def __init__(self, conf, gifOutput):
+        self.unsupported = []
+
+        if conf.GetParamBool("effects", "oilPaint"):
+            self.unsupported.append("oil paint")
+        if conf.GetParamBool("effects", "nashville"):
+            self.unsupported.append("nashville")
+        if conf.GetParam("color", "colorspace") not in ("CMYK", "Gray"):
+            self.unsupported.append("%s colorspace" % (conf.GetParam("color", "colorspace")))
+        if conf.GetParamBool("blend", "cinemagraph") and conf.GetParamBool("blend", "cinemagraphUseTransparency"):
+            self.unsupported.append("transparency")
+
+        self.brightnessContrast = None
+        if conf.GetParam("effects", "brightness") != "0":
+            self.brightnessContrast = (int(conf.GetParam("effects", "brightness")), int(conf.GetParam("effects", "contrast")))
+
+        self.sharpen = conf.GetParamBool("effects", "sharpen")
+
+        self.saturation = None
+        if conf.GetParam("color", "saturation") != "0":
+            self.saturation = int(100 + ReScale(int(conf.GetParam("color", "saturation")), (-100, 100), (-80, 80)))
+
+        self.sepia = None
+        if conf.GetParamBool("effects", "sepiaTone"):
+            self.sepia = int(ReScale(int(conf.GetParam("effects", "sepiaToneAmount")), (0, 100), (75, 100)))
+
+        self.tint = None
+        if conf.GetParamBool("effects", "colorTint"):
+            self.tint = (
+                ImageColor.getrgb(conf.GetParam("effects", "colorTintColor")),
+                int(ReScale(int(conf.GetParam("effects", "colorTintAmount")), (0, 100), (30, 100))),
+            )
+
+        self.vignette = None
+        if conf.GetParamBool("effects", "fadeEdges"):
+            amount = 100 - int(conf.GetParam("effects", "fadeEdgeAmount"))
+            self.vignette = (int(ReScale(amount, (0, 100), (20, 60))), int(ReScale(amount, (0, 100), (50, 5000))), -30, -30)
+
+        self.blur = None
+        if int(conf.GetParam("effects", "blur")) > 0:
+            self.blur = ReScale(int(conf.GetParam("effects", "blur")), (0, 100), (1, 11))
+
+        self.border = None
+        if conf.GetParamBool("effects", "border"):
+            self.border = (conf.GetParam("effects", "borderColor"), int(ReScale(int(conf.GetParam("effects", "borderAmount")), (0, 100), (1, 40))))
+
+        # -ordered-dither is applied on the spot; -dither only changes how -colors picks colors
+        self.orderedDither = False
+        self.dither = False
+        if self.sharpen:
+            self.orderedDither = int(conf.GetParam("effects", "sharpenAmount")) < 30
+            self.dither = True
+
+        self.gray = conf.GetParam("color", "colorspace") == "Gray"
+
+        self.numColors = None
+        if gifOutput:
+            self.numColors = int(conf.GetParam("color", "numcolors"))
+        self.palette = None
+
+    def IsSupported(self):
+        return len(self.unsupported) == 0
+
+    def UsePalette(self, paletteFile):
+        """Map frames to the colors in paletteFile instead of picking colors for each frame"""
+        with PIL.Image.open(paletteFile) as img:
+            colors = img.convert("RGB").tobytes()[: 256 * 3]
+
+        # Unused entries repeat a color rather than adding black
+        self.palette = PIL.Image.new("P", (1, 1))
+        self.palette.putpalette(colors + colors[:3] * (256 - len(colors) // 3))
+
+    def Apply(self, inputFileName, outputFileName):
+        """Process one frame. Returns None, without writing anything, if the frame has transparency"""
+        with PIL.Image.open(inputFileName) as img:
+            img = self.Render(img)
+
+        if img is None:
+            return None
+
+        img.save(outputFileName)
+        return True
+
+    def Render(self, img):
+        """Process one frame in memory. Returns None if the frame has transparency"""
+        if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+            if img.convert("RGBA").getchannel("A").getextrema()[0] < 255:
+                return None
+        img = img.convert("RGB")
+
+        if self.brightnessContrast is not None:
+            img = self.BrightnessContrast(img, *self.brightnessContrast)
+        if self.sharpen:
+            img = self.Sharpen(img)
+        if self.saturation is not None:
+            img = self.Saturation(img, self.saturation)
+        if self.sepia is not None:
+            img = self.SepiaTone(img, self.sepia)
+        if self.tint is not None:
+            img = self.Tint(img, *self.tint)
+        if self.vignette is not None:
+            img = self.Vignette(img, *self.vignette)
+        if self.blur is not None:
+            img = img.filter(ImageFilter.GaussianBlur(self.blur))
+        if self.border is not None:
+            img = ImageOps.expand(img, border=self.border[1], fill=self.border[0])
+        if self.sharpen:
+            img = self.Sharpen(img)
+        if self.orderedDither:
+            img = self.OrderedDither(img, 20)
+        if self.gray:
+            img = img.convert("L", self.LUMA)
+        if self.palette is not None:
+            img = img.quantize(palette=self.palette, dither=PIL.Image.FLOYDSTEINBERG if self.dither else PIL.Image.NONE)
+        elif self.numColors is not None and self.numColors > 0:
+            img = img.quantize(min(self.numColors, 256), dither=PIL.Image.FLOYDSTEINBERG if self.dither else PIL.Image.NONE)
+
+        return img
+
+    @staticmethod
+    def Clamp(val):
+        return max(0, min(255, int(val + 0.5)))
+
+    @staticmethod
+    def BrightnessContrast(img, brightness, contrast):
+        """-brightness-contrast: a straight line through mid-gray"""
+        slope = max(0.0, tan(pi * (contrast / 100.0 + 1.0) / 4.0))
+        intercept = brightness / 100.0 + ((100 - brightness) / 200.0) * (1.0 - slope)
+        lut = [PillowEffects.Clamp(255 * (slope * i / 255.0 + intercept)) for i in range(256)]
+        return img.point(lut * 3)
+
+    @staticmethod
+    def Sharpen(img):
+        """-sharpen Nx1. The radius only bounds the kernel, so it doesn't matter here"""
+        return img.filter(ImageFilter.UnsharpMask(1, PillowEffects.SHARPEN_PERCENT, 0))
+
+    @staticmethod
+    def Saturation(img, percent):
+        """-modulate 100,percent: scale HSL saturation, i.e. push each pixel away from its HSL lightness"""
+        r, g, b = img.split()
+        lightness = ImageChops.add(ImageChops.lighter(ImageChops.lighter(r, g), b), ImageChops.darker(ImageChops.darker(r, g), b), 2.0)
+        return PIL.Image.blend(PIL.Image.merge("RGB", (lightness, lightness, lightness)), img, percent / 100.0)
+
+    @staticmethod
+    def SepiaTone(img, percent):
+        """-sepia-tone: every output channel, including the -normalize and -contrast passes
+        ImageMagick runs afterwards, is a function of intensity alone, so it all folds into three lookup tables"""
+        threshold = 255 * percent / 100.0
+        intensity = img.convert("L", PillowEffects.LUMA)
+        luts = [[], [], []]
+
+        for i in range(256):
+            luts[0].append(255 if i > threshold else i + 255 - threshold)
+            luts[1].append(max(threshold / 7.0, 255 if i > 7.0 * threshold / 6.0 else i + 255 - 7.0 * threshold / 6.0))
+            luts[2].append(max(threshold / 7.0, 0 if i < threshold / 6.0 else i - threshold / 6.0))
+
+        # -normalize: stretch each channel so that 2% of pixels go black and 1% go white
+        histogram = intensity.histogram()
+        pixelCount = sum(histogram)
+
+        for lut in luts:
+            channelHistogram = [0] * 256
+            for i, count in enumerate(histogram):
+                channelHistogram[PillowEffects.Clamp(lut[i])] += count
+
+            black = 0
+            total = 0
+            while black < 255:
+                total += channelHistogram[black]
+                if total > 0.02 * pixelCount:
+                    break
+                black += 1
+
+            white = 255
+            total = 0
+            while white > 0:
+                total += channelHistogram[white]
+                if total > 0.01 * pixelCount:
+                    break
+                white -= 1
+
+            if white > black:
+                lut[:] = [min(255.0, max(0.0, (v - black) * 255.0 / (white - black))) for v in lut]
+
+        # -contrast: move HSB brightness (the largest channel) along a sine curve, keeping hue and saturation
+        for i in range(256):
+            brightest = max(luts[0][i], luts[1][i], luts[2][i])
+            if brightest > 0:
+                brightness = brightest / 255.0
+                brightness += 0.5 * (0.5 * (sin(pi * (brightness - 0.5)) + 1.0) - brightness)
+                scale = min(1.0, max(0.0, brightness)) * 255.0 / brightest
+                for lut in luts:
+                    lut[i] *= scale
+
+        return PIL.Image.merge("RGB", [intensity.point([PillowEffects.Clamp(v) for v in lut]) for lut in luts])
+
+    @staticmethod
+    def Tint(img, color, amount):
+        """-fill color -tint amount: shift midtones towards the color, leaving black and white alone"""
+        fillIntensity = sum(c * w for c, w in zip(color, PillowEffects.LUMA))
+        lut = []
+        for c in color:
+            shift = amount * c / 100.0 - fillIntensity
+            lut += [PillowEffects.Clamp(i + shift * (1.0 - 4.0 * (i / 255.0 - 0.5) ** 2)) for i in range(256)]
+        return img.point(lut)
+
+    @staticmethod
+    def Vignette(img, radius, sigma, x, y):
+        """-background black -vignette radiusxsigma+x+y: a blurred ellipse used as the alpha over black"""
+        w, h = img.size
+        mask = PIL.Image.new("L", img.size, 0)
+        ImageDraw.Draw(mask).ellipse((x, y, w - x, h - y), fill=255)
+
+        # ImageMagick cuts the gaussian off at radius; past that sigma it's effectively a box
+        if sigma >= radius:
+            mask = mask.filter(ImageFilter.BoxBlur(radius))
+        else:
+            mask = mask.filter(ImageFilter.GaussianBlur(sigma))
+
+        return PIL.Image.composite(img, PIL.Image.new("RGB", img.size, "black"), mask)
+
+    @staticmethod
+    def OrderedDither(img, levels):
+        """-ordered-dither checks,levels"""
+        steps = levels - 1
+        luts = []
+
+        # The checks map is 2x2 with thresholds 1 and 2 out of 3
+        for threshold in (1, 2):
+            lut = []
+            for i in range(256):
+                t = int(i / 255.0 * (steps * 3 + 1))
+                level = t // 3
+                lut.append(PillowEffects.Clamp((level + (t - level * 3 >= threshold)) * 255.0 / steps))
+            luts.append(img.point(lut * 3))
+
+        w, h = img.size
+        evenRow = (b"\x00\xff" * (w // 2 + 1))[:w]
+        oddRow = (b"\xff\x00" * (w // 2 + 1))[:w]
+        checks = PIL.Image.frombytes("L", img.size, ((evenRow + oddRow) * (h // 2 + 1))[: w * h])
+
+        return PIL.Image.composite(luts[1], luts[0], checks)
+
+
+class GifEncoder:
+    """Writes a GIF one frame at a time, so only the frame being added is ever in memory.
+
+    Each frame gets a color table of its own. Frames with numColors colors or fewer (what
+    ImageProcessing leaves) are written with exactly those colors; others are quantized first.
+    Pillow's GIF encoder does the LZW compression.
+
+    With optimize, each frame after the first is compared against what's on screen by then and only
+    the rectangle that changed is written, with the pixels in it that didn't change left transparent
+    (disposal 1: frames draw over the ones before). A frame that changes nothing isn't written at all;
+    the frame before stays up for its delay too. Frames are held back one at a time to allow for that.
+    """
+
+    def __init__(self, fileName, size, numLoops, numColors=256, optimize=True):
+        self.size = size
+        self.numColors = max(2, min(numColors, 256))
+        self.optimize = optimize
+        self.frameCount = 0
+        self.canvas = None  # What's on screen after the frames so far, with optimize
+        self.pending = None  # [frame, offset, transparency, delayMs] of the frame held back
+        self.out = open(fileName, "wb")
+
+        # Header and logical screen descriptor: no global color table
+        self.out.write(b"GIF89a" + struct.pack("<HHBBB", size[0], size[1], 0x70, 0, 0))
+
+        # Loop count, written the way ImageMagick's -loop does
+        self.out.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", numLoops) + b"\x00")
+
+    def AddFrame(self, img, delayMs):
+        if img.size != self.size:
+            img = img.resize(self.size, PIL.Image.LANCZOS)
+        img = img.convert("RGB")
+
+        if not self.optimize:
+            self.Flush()
+            self.pending = [self.ToPalette(img, self.numColors), (0, 0), None, delayMs]
+            return
+
+        if self.canvas is None:
+            box = (0, 0) + self.size
+            changed = None
+        else:
+            diff = ImageChops.difference(self.canvas, img)
+            box = diff.getbbox()
+
+            if box is None:
+                self.pending[3] += delayMs
+                return
+
+            # Pixels where any channel differs
+            r, g, b = diff.crop(box).split()
+            changed = ImageChops.lighter(ImageChops.lighter(r, g), b).point(lambda v: 255 if v else 0)
+
+        # Leave a color table entry free for transparency
+        frame = self.ToPalette(img.crop(box), self.numColors if changed is None else min(self.numColors, 255))
+        transparency = None
+
+        if changed is not None and changed.getextrema()[0] == 0:
+            transparency = frame.getextrema()[1] + 1
+            if transparency < 256:
+                frame.putpalette(frame.getpalette()[: transparency * 3] + [0, 0, 0])
+                frame.paste(transparency, mask=ImageChops.invert(changed))
+            else:
+                transparency = None
+
+        if self.canvas is None:
+            self.canvas = frame.convert("RGB")
+        else:
+            self.canvas.paste(frame.convert("RGB"), box[:2], changed)
+
+        self.Flush()
+        self.pending = [frame, box[:2], transparency, delayMs]
+
+    @staticmethod
+    def ToPalette(img, numColors):
+        """An RGB image as a "P" image of at most numColors colors"""
+        colors = img.getcolors(numColors)
+
+        if colors is None:
+            return img.quantize(numColors, dither=PIL.Image.FLOYDSTEINBERG)
+
+        # With a box per color, median cut can only give each color a box of its own. Quantizing
+        # to a given palette goes through a lookup cache that can mix up colors that are close
+        return img.quantize(len(colors), method=PIL.Image.MEDIANCUT)
+
+    def Flush(self):
+        """Write out the frame held back"""
+        if self.pending is None:
+            return
+
+        frame, offset, transparency, delayMs = self.pending
+        params = {"duration": delayMs, "disposal": 1, "include_color_table": True}
+        if transparency is not None:
+            params["transparency"] = transparency
+
+        for chunk in GifImagePlugin.getdata(frame, offset, **params):
+            self.out.write(chunk)
+
+        self.pending = None
+        self.frameCount += 1
+
+    def Close(self):
+        self.Flush()
+        self.out.write(b";")
+        self.out.close()
+
+
+def SetGifFrameDelays(fileName, frameDelays):
+    """Change the delays of some of a GIF's frames without decoding it: frameDelays maps frame indexes
+    to delays in hundredths of a second. Walks the GIF's blocks and rewrites the delay field of each
+    frame's graphic control extension, adding one where a frame has none. Nothing else in the file
+    changes. Returns the indexes of frames the GIF doesn't have. Raises ValueError if the file isn't
+    a GIF or is cut short"""
+    with open(fileName, "rb") as f:
+        data = f.read()
+
+    if data[:6] not in (b"GIF87a", b"GIF89a") or len(data) < 13:
+        raise ValueError("%s isn't a GIF" % (fileName))
+
+    def SkipSubBlocks(pos):
+        while True:
+            if pos >= len(data):
+                raise ValueError("%s is cut short" % (fileName))
+            if data[pos] == 0:
+                return pos + 1
+            pos += data[pos] + 1
+
+    def ColorTableSize(packed):
+        return 3 << ((packed & 0x07) + 1) if packed & 0x80 else 0
+
+    pos = 13 + ColorTableSize(data[10])
+    delayOffsets = []  # Per frame: where its delay field is, or where a graphic control extension goes
+    missing = []  # Frames without a graphic control extension
+    gce = None
+
+    while pos < len(data) and data[pos] != 0x3B:
+        if data[pos] == 0x21 and pos + 1 < len(data):
+            if data[pos + 1] == 0xF9 and data[pos + 2 : pos + 3] == b"\x04":
+                gce = pos + 4
+            pos = SkipSubBlocks(pos + 2)
+        elif data[pos] == 0x2C and pos + 10 < len(data):
+            if gce is None:
+                missing.append(len(delayOffsets))
+                gce = pos
+            delayOffsets.append(gce)
+            gce = None
+            pos = SkipSubBlocks(pos + 11 + ColorTableSize(data[pos + 9]))
+        else:
+            raise ValueError("%s has an unknown block at byte %d" % (fileName, pos))
+
+    notFound = [frameIdx for frameIdx in frameDelays if not 0 <= frameIdx < len(delayOffsets)]
+    frameDelays = {frameIdx: delay for frameIdx, delay in frameDelays.items() if frameIdx not in notFound}
+
+    if not any(frameIdx in missing for frameIdx in frameDelays):
+        # Only the delay fields change
+        with open(fileName, "r+b") as f:
+            for frameIdx, delay in sorted(frameDelays.items()):
+                f.seek(delayOffsets[frameIdx])
+                f.write(struct.pack("<H", max(0, min(delay, 0xFFFF))))
+    else:
+        patched = bytearray(data)
+        for frameIdx, delay in sorted(frameDelays.items(), reverse=True):
+            delay = struct.pack("<H", max(0, min(delay, 0xFFFF)))
+            if frameIdx in missing:
+                patched[delayOffsets[frameIdx] : delayOffsets[frameIdx]] = b"!\xf9\x04\x00" + delay + b"\x00\x00"
+            else:
+                patched[delayOffsets[frameIdx] : delayOffsets[frameIdx] + 2] = delay
+
+        # Graphic control extensions are new in GIF89a
+        patched[:6] = b"GIF89a"
+        with open(fileName, "wb") as f:
+            f.write(patched)
+
+    return notFound
+
+
 class AnimatedGif:
     """Try to keep this class fully de-coupled from the GUI"""
 
@@ -703,12 +1814,22 @@ class AnimatedGif:
         self.videoLength = None
         self.videoFps = 0.0
         self.videoPath = None
+        self.mediaInfo = None  # MediaProbe's probe of the video, if ffprobe is around
         self.videoFileName = ""
         self.imageSequence = []
         self.imageSequenceCropParams = None  # At the moment, used for mac screen grab only. When the image sequence is "extracted" we sneak in the crop operation instead of resizing
         self.fonts = None
         self.rootWindow = rootWindow  # Needed for mouse cursor
         self.gifCreated = False
+        self.resizedImagesDeferred = False  # resized/ is out of date; ImageProcessing crops and resizes from original/
+        self.fusedCropAndResizeDone = False  # While deferred: ImageProcessing has since cropped and resized every frame into processed/
+        self.extractedCropSignature = None  # original/ frames came out of ffmpeg already cropped and resized
+        self.processedSignatures = dict()  # processed/ frame -> GetFrameSignature of what's in it
+        self.frameListeners = []
+        self.duplicateGroups = []  # CheckDuplicates' findings, as groups of frame numbers
+        self.frameHolds = None  # With decimateFrames: how many output frames' worth of time each extracted frame covers
+        self.globalPaletteFile = None  # The palette the processed frames were mapped to, if they share one
+        self.frameStep = 1  # The last GIF kept every frameStep'th processed frame
         self.gifOutPath = None  # Warning: Don't use this directly!
         self.lastSavedGifPath = None
         self.overwriteGif = True
@@ -717,9 +1838,13 @@ class AnimatedGif:
         self.processedDir = os.path.join(workDir, "processed")
         self.captureDir = os.path.join(workDir, "capture")
         self.maskDir = os.path.join(workDir, "mask")
+        self.paletteDir = os.path.join(workDir, "palette")
         self.downloadDir = os.path.join(workDir, "downloads")
         self.previewFile = os.path.join(workDir, "preview.gif")
         self.blankImgFile = os.path.join(workDir, "blank.gif")
+        self.extractedFrames = FrameStore(self.frameDir)
+        self.resizedFrames = FrameStore(self.resizeDir)
+        self.processedFrames = FrameStore(self.processedDir, "." + self.GetIntermediaryFrameFormat())
 
         self.OverwriteOutputGif(self.conf.GetParamBool("settings", "overwriteGif"))
 
@@ -759,10 +1884,31 @@ class AnimatedGif:
             os.makedirs(self.maskDir)
             if not os.path.exists(self.maskDir):
                 self.FatalError("Failed to create working directory: " + self.maskDir)
+        if not os.path.exists(self.paletteDir):
+            os.makedirs(self.paletteDir)
+            if not os.path.exists(self.paletteDir):
+                self.FatalError("Failed to create working directory: " + self.paletteDir)
 
         self.LoadFonts()
         logging.info("CheckPaths...")
         self.CheckPaths()
+
+        self.magickWorkers = None
+        if self.conf.GetParamBool("settings", "persistentImagemagick"):
+            self.magickWorkers = ImagemagickWorkerPool(self.conf.GetParam("paths", "convert"), workDir, self.GetImagemagickEnv())
+
+        try:
+            frameCacheMB = int(self.conf.GetParam("settings", "frameCacheMB"))
+        except ValueError:
+            frameCacheMB = 0
+        self.frameCache = FrameCache(os.path.join(workDir, "cache"), frameCacheMB * 1024 * 1024)
+
+        ffprobePath = self.conf.GetParam("paths", "ffprobe")
+        if len(ffprobePath) and not self._tool_exists(ffprobePath):
+            logging.info("ffprobe not found at %s. Using ffmpeg to get video information" % (ffprobePath))
+            ffprobePath = ""
+        self.mediaProbe = MediaProbe(ffprobePath, os.path.join(workDir, "probe.json"))
+
         logging.info("CheckPaths done. Cleaning up working dirs...")
         self.DeleteResizedImages()
         self.DeleteExtractedImages()
@@ -1044,6 +2190,152 @@ class AnimatedGif:
     def GetFonts(self):
         return self.fonts
 
+    def RunImagemagick(self, cmd, callBackFinalize=True):
+        """Run a per-frame convert command on a persistent worker if possible, otherwise spawn it"""
+        if self.magickWorkers is not None:
+            result = self.magickWorkers.Run(cmd, self.callback)
+
+            if result is not None:
+                if callBackFinalize:
+                    self.callback(True)
+                return result
+
+        return RunProcess(cmd, self.callback, False, callBackFinalize)
+
+    def GetFrameWorkerCount(self):
+        """How many frames to process at once. 0 means one per CPU core"""
+        try:
+            workerCount = int(self.conf.GetParam("settings", "frameWorkers"))
+        except ValueError:
+            workerCount = 1
+
+        if workerCount <= 0:
+            workerCount = os.cpu_count() or 1
+
+        return workerCount
+
+    def GetImagemagickEnv(self):
+        """Environment for ImageMagick when it runs frames side by side. Every one of them would
+        otherwise start a thread per core of its own, so each is held to one thread unless the user
+        has already set a limit"""
+        if self.GetFrameWorkerCount() <= 1 or "MAGICK_THREAD_LIMIT" in os.environ:
+            return None
+
+        return {"MAGICK_THREAD_LIMIT": "1"}
+
+    def RunImagemagickJob(self, cmd, keepGoing):
+        """Run one command of a batch, from a batch worker thread"""
+        result = None
+        if self.magickWorkers is not None:
+            result = self.magickWorkers.Run(cmd, keepGoing)
+        if result is None:
+            result = RunProcess(cmd, keepGoing, False, False, None, self.GetImagemagickEnv())
+        return result
+
+    def GetFrameSignature(self, inputFileName, outputFileName, cmd):
+        """Identifies what cmd will write for this frame: its input and everything else that goes into
+        it (crop, effects, this frame's captions). None if the input can't be read"""
+        try:
+            return self.frameCache.GetEntryName(inputFileName, outputFileName, cmd)
+        except OSError:
+            return None
+
+    def CachedFrameJob(self, signature, outputFileName, job):
+        """Wrap a frame job so that it copies its result out of the frame cache when it can, and
+        files the result away when it has to run"""
+        if signature is None:
+            return job
+
+        def CachedJob(keepGoing):
+            if self.frameCache.Fetch(signature, outputFileName):
+                return True
+            if not job(keepGoing):
+                return False
+
+            self.frameCache.Store(signature, outputFileName)
+            return True
+
+        return CachedJob
+
+    def LogFrameCacheStats(self):
+        if self.frameCache.maxBytes > 0:
+            logging.info("Frame cache: %d hits, %d misses" % self.frameCache.GetStats())
+
+    def RunFrameBatch(self, jobs, statusStr):
+        """Run independent per-frame jobs on up to GetFrameWorkerCount() threads.
+
+        A job is called as job(keepGoing) and returns True on success. Long jobs should give up
+        once keepGoing() returns False. Only this thread talks to the callback: it gets the share
+        of frames finished in order. If a job fails, or the callback returns False, everything in
+        flight is stopped and False is returned.
+        """
+        workerCount = min(self.GetFrameWorkerCount(), len(jobs))
+
+        if workerCount > 1:
+            logging.info("%s: %d frames on %d workers" % (statusStr, len(jobs), workerCount))
+
+        abortEvent = threading.Event()
+        pending = Queue()
+        finished = Queue()
+        results = [None] * len(jobs)
+
+        for idx in range(len(jobs)):
+            pending.put(idx)
+
+        def KeepGoing(*_args):
+            return not abortEvent.is_set()
+
+        def Worker():
+            while not abortEvent.is_set():
+                try:
+                    idx = pending.get_nowait()
+                except Empty:
+                    break
+
+                try:
+                    result = jobs[idx](KeepGoing)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    logging.error("%s: frame %d raised\n%s" % (statusStr, idx + 1, traceback.format_exc()))
+                    result = False
+
+                finished.put((idx, result))
+
+        threads = [Thread(target=Worker, daemon=True) for _ in range(workerCount)]
+        for t in threads:
+            t.start()
+
+        success = True
+        framesInOrder = 0
+
+        while any(t.is_alive() for t in threads) or not finished.empty():
+            try:
+                idx, result = finished.get(timeout=PROCESS_IDLE_TICK_SEC)
+                results[idx] = result
+
+                if not result and not abortEvent.is_set():
+                    logging.error("%s: frame %d failed" % (statusStr, idx + 1))
+                    success = False
+                    abortEvent.set()
+            except Empty:
+                pass
+
+            while framesInOrder < len(results) and results[framesInOrder]:
+                framesInOrder += 1
+
+            percent = framesInOrder * 100 // len(jobs)
+            if self.callback(percent, "%d%% %s" % (percent, statusStr)) == False:
+                success = False
+                abortEvent.set()
+
+        for t in threads:
+            t.join()
+
+        return success and all(results)
+
+    def StopWorkers(self):
+        if self.magickWorkers is not None:
+            self.magickWorkers.Shutdown()
+
     def SetSavePath(self, savePath):
         self.gifOutPath = savePath
 
@@ -1068,6 +2360,8 @@ class AnimatedGif:
         files = []
 
         if includeCropAndResize:
+            if not self.MaterializeResizedImages():
+                return False
             files = self.GetResizedImageList()
         else:
             files = self.GetExtractedImageList()
@@ -1121,6 +2415,7 @@ class AnimatedGif:
 
             x += 1
 
+        self.InvalidateFrameStores()
         self.callback(True)
 
         return retVal
@@ -1150,6 +2445,10 @@ class AnimatedGif:
             logging.info("Move %s to %s" % (fromFile, toFile))
             shutil.move(fromFile, toFile)
 
+        if self.frameHolds is not None:
+            self.frameHolds.reverse()
+
+        self.InvalidateFrameStores()
         return True
 
     def CreateBlankFrame(self, color):
@@ -1209,7 +2508,7 @@ class AnimatedGif:
                 fa,
             )
 
-            if not RunProcess(cmdConvert, self.callback, False):
+            if not self.RunImagemagick(cmdConvert):
                 self.DeleteExtractedImages()
                 self.FatalError("Couldn't fade!")
 
@@ -1302,7 +2601,13 @@ class AnimatedGif:
                 toFile,
             )
 
-            if not RunProcess(cmdConvert, self.callback, False, False):
+            # Multi-frame imports write several files, which the persistent workers don't track
+            if GetFileExtension(importFile) == "gif":
+                importOk = RunProcess(cmdConvert, self.callback, False, False)
+            else:
+                importOk = self.RunImagemagick(cmdConvert, False)
+
+            if not importOk:
                 self.DeleteExtractedImages()
                 self.FatalError("Unable to resize import image %s. Import failed!" % (toFile))
 
@@ -1359,6 +2664,7 @@ class AnimatedGif:
             logging.info("Move %s to %s" % (newImgList[x], toFile))
             shutil.move(newImgList[x], toFile)
 
+        self.InvalidateFrameStores()
         self.callback(True)
         return True
 
@@ -1432,6 +2738,69 @@ class AnimatedGif:
         if not os.path.exists(mediaPath):
             self.FatalError("'" + mediaPath + "' does not exist!")
 
+        self.mediaInfo = self.mediaProbe.Probe(CleanupPath(mediaPath))
+        try:
+            if self.mediaInfo is not None:
+                self.SetVideoParametersFromProbe(self.mediaInfo)
+        except (KeyError, ValueError, ZeroDivisionError):
+            logging.error("Unexpected ffprobe output: %s" % (self.mediaInfo))
+            self.mediaInfo = None
+
+        if self.mediaInfo is None:
+            self.SetVideoParametersFromFfmpeg(mediaPath)
+
+        logging.info(
+            "Video Parameters: %dx%d (%d:%d or %0.3f:1); %d fps"
+            % (
+                self.GetVideoWidth(),
+                self.GetVideoHeight(),
+                self.GetVideoWidth() // gcd(self.GetVideoWidth(), self.GetVideoHeight()),
+                self.GetVideoHeight() // gcd(self.GetVideoWidth(), self.GetVideoHeight()),
+                self.GetVideoWidth() / float(self.GetVideoHeight()),
+                self.GetVideoFps(),
+            )
+        )
+
+        return True
+
+    def SetVideoParametersFromProbe(self, probe):
+        stream = probe["stream"]
+        self.videoWidth = int(stream["width"])
+        self.videoHeight = int(stream["height"])
+
+        # Display aspect ratio - non square pixels
+        sarX, sarY = map(int, stream.get("sample_aspect_ratio", "0:1").split(":"))
+        darX, darY = map(int, stream.get("display_aspect_ratio", "0:1").split(":"))
+        if sarX and sarY and darX and darY:
+            rDar = darX / float(darY)
+            rSar = sarX / float(sarY)
+
+            if rSar != 1.0 and rDar != rSar:
+                logging.info("Storage aspect ratio (%.2f) differs from display aspect ratio (%.2f)" % (rSar, rDar))
+                self.videoWidth = self.videoHeight * rDar
+
+        # Side rotation. Older files tag it, newer ones have a display matrix. ffmpeg turns the frames either way
+        rotation = stream.get("tags", dict()).get("rotate", 0)
+        for sideData in stream.get("side_data_list", []):
+            rotation = sideData.get("rotation", rotation)
+
+        if int(float(rotation)) % 180 == 90:
+            logging.info("Side rotation detected")
+            self.videoWidth, self.videoHeight = self.videoHeight, self.videoWidth
+
+        duration = probe["format"].get("duration", stream.get("duration", "N/A"))
+        if self.videoPath and duration != "N/A":
+            self.videoLength = MillisecToDurationStr(int(round(float(duration) * 1000)))
+
+        # r_frame_rate is what ffmpeg -i reports as tbr
+        rateNum, rateDen = map(int, stream.get("r_frame_rate", "0/0").split("/"))
+        if self.videoPath and rateNum > 0 and rateDen > 0:
+            self.videoFps = rateNum / float(rateDen)
+        elif self.videoFps <= 0.0:
+            self.videoFps = 10.0
+            logging.info("Unable to determine frame rate! Arbitrarily setting it to %d" % (self.videoFps))
+
+    def SetVideoParametersFromFfmpeg(self, mediaPath):
         _stdout, stderr = RunProcess(
             '"' + self.conf.GetParam("paths", "ffmpeg") + '" -i "' + CleanupPath(mediaPath) + '"',
             None,
@@ -1487,46 +2856,32 @@ class AnimatedGif:
             self.videoFps = 10.0
             logging.info("Unable to determine frame rate! Arbitrarily setting it to %d" % (self.videoFps))
 
-        logging.info(
-            "Video Parameters: %dx%d (%d:%d or %0.3f:1); %d fps"
-            % (
-                self.GetVideoWidth(),
-                self.GetVideoHeight(),
-                self.GetVideoWidth() // gcd(self.GetVideoWidth(), self.GetVideoHeight()),
-                self.GetVideoHeight() // gcd(self.GetVideoWidth(), self.GetVideoHeight()),
-                self.GetVideoWidth() / float(self.GetVideoHeight()),
-                self.GetVideoFps(),
-            )
-        )
-
-        return True
-
     def GetResizedImagesDir(self):
         return self.resizeDir + os.sep
 
     def GetResizedImagesLastModifiedTs(self):
-        if self.ResizedImagesExist():
-            largestTimestamp = os.stat(self.GetResizedImagesDir()).st_mtime
-            files = glob.glob(self.GetResizedImagesDir() + "*")
-
-            for f in files:
-                if os.stat(f).st_mtime > largestTimestamp:
-                    largestTimestamp = os.stat(f).st_mtime
-            return largestTimestamp
-        else:
-            return 0
+        return self.resizedFrames.GetLastModifiedTs()
+
+    def ResizedImagesOutOfDate(self):
+        """Whether crop and resize has to run again: the extracted frames changed since it last ran, or
+        it was deferred and the effects pass hasn't done it yet"""
+        if self.resizedImagesDeferred:
+            return not self.fusedCropAndResizeDone or self.GetExtractedImagesLastModifiedTs() > self.GetProcessedImagesLastModifiedTs()
+
+        return self.GetExtractedImagesLastModifiedTs() > self.GetResizedImagesLastModifiedTs()
 
     def GetResizedImageList(self, idx=None):
         if idx is not None:
             origFiles = self.GetExtractedImageList()
             return self.GetResizedImagesDir() + os.path.basename(origFiles[idx - 1])
-        return sorted(glob.glob(self.GetResizedImagesDir() + "*"))
+        return self.resizedFrames.GetList()
 
     def ResizedImagesExist(self):
-        return len(glob.glob(self.GetResizedImagesDir() + "*")) > 0
+        return self.resizedFrames.Exists()
 
     def DeleteResizedImages(self):
         files = glob.glob(self.resizeDir + os.sep + "*")
+        self.resizedFrames.Invalidate()
         for f in files:
             try:
                 os.remove(f)
@@ -1537,28 +2892,20 @@ class AnimatedGif:
         return self.frameDir + os.sep
 
     def GetExtractedImagesLastModifiedTs(self):
-        if self.ExtractedImagesExist():
-            largestTimestamp = os.stat(self.GetExtractedImagesDir()).st_mtime
-            files = glob.glob(self.GetExtractedImagesDir() + "*")
-
-            for f in files:
-                if os.path.exists(f) and os.stat(f).st_mtime > largestTimestamp:
-                    largestTimestamp = os.stat(f).st_mtime
-            return largestTimestamp
-        else:
-            return 0
+        return self.extractedFrames.GetLastModifiedTs()
 
     def ExtractedImagesExist(self):
-        return len(glob.glob(self.GetExtractedImagesDir() + "*")) > 0
+        return self.extractedFrames.Exists()
 
     def GetNumFrames(self):
-        return len(self.GetExtractedImageList())
+        return self.extractedFrames.Count()
 
     def GetExtractedImageList(self):
-        return sorted(glob.glob(self.GetExtractedImagesDir() + "*"))
+        return self.extractedFrames.GetList()
 
     def DeleteExtractedImages(self):
-        files = glob.glob(self.GetExtractedImagesDir() + "*")
+        files = glob.glob(self.GetExtractedImagesDir() + "*") + glob.glob(self.GetExtractedImagesDir() + ".*")
+        self.extractedFrames.Invalidate()
         for f in files:
             try:
                 os.remove(f)
@@ -1566,11 +2913,36 @@ class AnimatedGif:
                 errStr = "Can't delete the following file:\n\n%s\n\nIs it open in another program?" % (f)
                 self.FatalError(errStr)
 
+    def AddFrameListener(self, listener):
+        """listener(fileName) is called for each frame ExtractFrames puts in original/, in order, as soon as
+        the frame is complete. Calls come from whichever thread wrote the frame. The frames before it are
+        all in place, so the extracted image list can be used from inside the call"""
+        self.frameListeners.append(listener)
+
+    def RemoveFrameListener(self, listener):
+        self.frameListeners.remove(listener)
+
+    # Hash while the frame is still in the page cache. CheckDuplicates and the frame cache need it next
+    def PublishExtractedFrame(self, fileName):
+        self.extractedFrames.Invalidate()
+        self.frameCache.HashFile(fileName)
+        for listener in self.frameListeners:
+            listener(fileName)
+
     def GetProcessedImagesDir(self):
         return self.processedDir + os.sep
 
     def GetProcessedImageList(self):
-        return sorted(glob.glob(self.GetProcessedImagesDir() + "*." + self.GetIntermediaryFrameFormat()))
+        return self.processedFrames.GetList()
+
+    def GetProcessedImagesLastModifiedTs(self):
+        return self.processedFrames.GetLastModifiedTs()
+
+    # Frames were rewritten in place, which the frame stores can't see for themselves
+    def InvalidateFrameStores(self):
+        self.extractedFrames.Invalidate()
+        self.resizedFrames.Invalidate()
+        self.processedFrames.Invalidate()
 
     def DeleteProcessedImages(self):
         if os.path.exists(self.previewFile):
@@ -1580,6 +2952,8 @@ class AnimatedGif:
                 pass
 
         files = glob.glob(self.GetProcessedImagesDir() + "*")
+        self.processedFrames.Invalidate()
+        self.processedSignatures = dict()
 
         for f in files:
             try:
@@ -1588,6 +2962,22 @@ class AnimatedGif:
                 errStr = "Can't delete %s. Is it open in another program?" % (f)
                 self.FatalError(errStr)
 
+    # Delete processed frames that aren't part of the GIF any more, e.g. after frames were deleted
+    def DeleteStaleProcessedImages(self, keep):
+        if os.path.exists(self.previewFile):
+            try:
+                os.remove(self.previewFile)
+            except OSError:
+                pass
+
+        for f in glob.glob(self.GetProcessedImagesDir() + "*"):
+            if f not in keep:
+                try:
+                    os.remove(f)
+                except OSError:
+                    errStr = "Can't delete %s. Is it open in another program?" % (f)
+                    self.FatalError(errStr)
+
     def GetCapturedImagesDir(self):
         return self.captureDir + os.sep
 
@@ -1722,10 +3112,437 @@ class AnimatedGif:
         else:
             return False
 
-    def ExtractFrames(self):
+    # Settings the frames from ExtractFrames(cropAndResize=True) were cropped and resized with
+    def GetCropAndResizeSignature(self):
+        return "%dx%d crop=%s:%sx%s+%s+%s size=%dx%d" % (
+            self.GetVideoWidth(),
+            self.GetVideoHeight(),
+            self.conf.GetParam("size", "cropenabled"),
+            self.conf.GetParam("size", "cropwidth"),
+            self.conf.GetParam("size", "cropheight"),
+            self.conf.GetParam("size", "cropoffsetx"),
+            self.conf.GetParam("size", "cropoffsety"),
+            *self.GetCroppedAndResizedDimensions(),
+        )
+
+    # ffmpeg version of the crop and resize in GetCropAndResizeArgs
+    def GetCropAndResizeFilter(self):
+        vf = "scale=%d:%d" % (self.GetVideoWidth(), self.GetVideoHeight())
+
+        # Imagemagick takes a zero size to mean the whole frame
+        if self.conf.GetParam("size", "cropenabled") and int(self.conf.GetParam("size", "cropwidth")) > 0 and int(self.conf.GetParam("size", "cropheight")) > 0:
+            vf += ",crop=%d:%d:%d:%d" % (
+                int(self.conf.GetParam("size", "cropwidth")),
+                int(self.conf.GetParam("size", "cropheight")),
+                int(self.conf.GetParam("size", "cropoffsetx")),
+                int(self.conf.GetParam("size", "cropoffsety")),
+            )
+
+        vf += ",scale=%d:%d:flags=lanczos" % (self.GetCroppedAndResizedDimensions())
+        return vf
+
+    def GetClipFrameCount(self, durationSec):
+        """The clip is durationSec worth of output frames, if the video lasts that long"""
+        return int(ceil(round(durationSec * float(self.conf.GetParam("rate", "framerate")), 6)))
+
+    def GetSeekArgs(self, startTimeStr, durationSec, firstFrame=0, endFrame=None):
+        """ffmpeg input options that decode durationSec of video from startTimeStr, and a filter that picks
+        the frames to keep ("" if -r can be left to it). With the filter, firstFrame and endFrame narrow
+        it down to the output frames numbered firstFrame up to endFrame, counting from 0.
+
+        Right after a seek, -r passes the first frames through at the source's pace before settling into
+        its usual pattern, so clips started with a burst of frames (the slowdown glitch). With
+        fixSlowdownGlitch, the fps filter sets the frame rate instead: output frame n is the last video
+        frame before n + 1/2 output frames past the start (round=near). So that it can see the frame
+        showing at the start, decoding starts a few whole output frames earlier, and start_time drops
+        the frames output before it. trim then cuts the clip at durationSec (rounded up to a whole
+        output frame). A frame exactly halfway between two output frames can go either way, since
+        ffmpeg rounds the seek to the stream's timebase"""
+        if not self.conf.GetParamBool("settings", "fixSlowdownGlitch"):
+            return '-t %.1f -ss %s -i "%s"' % (durationSec, startTimeStr, self.videoPath), ""
+
+        rate = float(self.conf.GetParam("rate", "framerate"))
+        firstFrameSec = DurationStrToMillisec(startTimeStr) / 1000.0 + firstFrame / rate
+
+        # Enough to cover one video frame and half an output frame, if the video goes back that far
+        lookBackFrames = min(int(ceil(rate / float(self.videoFps) + 0.5)), int(firstFrameSec * rate))
+        seekSec = firstFrameSec - lookBackFrames / rate
+
+        if endFrame is None:
+            endFrame = self.GetClipFrameCount(durationSec)
+
+        fpsFilter = "fps=fps=%s:start_time=%.6f:round=near,trim=end_frame=%d,setpts=PTS-STARTPTS" % (
+            self.conf.GetParam("rate", "framerate"),
+            lookBackFrames / rate,
+            endFrame - firstFrame,
+        )
+
+        logging.info("Fixing FPS glitch. Decode from %.3f s, %d output frame(s) early" % (seekSec, lookBackFrames))
+        inputArgs = '-t %.6f -ss %.6f -i "%s"' % ((lookBackFrames + endFrame - firstFrame + 1) / rate, seekSec, self.videoPath)
+        return inputArgs, fpsFilter
+
+    def ExtractFramesToPng(self, startTimeStr, durationSec, cropAndResize, verbosityLevel):
+        """One ffmpeg writing the frames to original/ itself. If it can't run GetSeekArgs' fps filter,
+        ExtractFramesWithLeadIn has another go.
+
+        Returns True, or False if it failed or was aborted"""
+        inputArgs, rateFilter = self.GetSeekArgs(startTimeStr, durationSec)
+        filters = [rateFilter] if rateFilter else []
+        if cropAndResize:
+            filters.append(self.GetCropAndResizeFilter())
+
+        filterArgs = ""
+        if len(filters):
+            filterArgs = '-vf "%s" ' % (",".join(filters))
+
+        cmdExtractImages = '"%s" -v %s -sn %s %s-r %s "%simage%%04d.png"' % (
+            self.conf.GetParam("paths", "ffmpeg"),
+            verbosityLevel,
+            inputArgs,
+            filterArgs,
+            self.conf.GetParam("rate", "framerate"),
+            self.frameDir + os.sep,
+        )
+
+        aborted = []
+
+        def Callback(*args):
+            if self.callback(*args) == False:
+                aborted.append(True)
+                return False
+            return True
+
+        success = RunProcess(cmdExtractImages, Callback)
+        self.extractedFrames.Invalidate()
+
+        if not success and rateFilter and not aborted and not self.ExtractedImagesExist():
+            logging.error("ffmpeg didn't extract any frames with the fps filter. Trying a 2 second lead-in instead")
+            return self.ExtractFramesWithLeadIn(startTimeStr, durationSec, cropAndResize, verbosityLevel)
+
+        # A frame ffmpeg is still writing looks like any other, so these go out once it's done
+        if success:
+            for fileName in self.GetExtractedImageList():
+                self.PublishExtractedFrame(fileName)
+
+        return success
+
+    def ExtractFramesWithLeadIn(self, startTimeStr, durationSec, cropAndResize, verbosityLevel):
+        """The slowdown glitch fix from before GetSeekArgs had the fps filter, for an ffmpeg that won't
+        run it: extract from 2 seconds early, then delete the first 2 seconds of frames and renumber the
+        rest. A clip starting in the first 2 seconds has no room for this and keeps its glitch.
+
+        Returns True, or False if it failed or was aborted"""
+        rate = float(self.conf.GetParam("rate", "framerate"))
+        startMs = DurationStrToMillisec(startTimeStr)
+        skipFrames = 0
+
+        if startMs > 2000:
+            startTimeStr = MillisecToDurationStr(startMs - 2000)
+            durationSec += 2.0
+            skipFrames = int(round(2 * rate))
+            logging.info("Fixing FPS glitch. New start time: " + startTimeStr + "; New duration: " + str(durationSec))
+        else:
+            logging.info("Start time is in the first 2 seconds. There's no room to fix the FPS glitch")
+
+        filterArgs = ""
+        if cropAndResize:
+            filterArgs = '-vf "%s" ' % (self.GetCropAndResizeFilter())
+
+        cmdExtractImages = '"%s" -v %s -sn -t %.1f -ss %s -i "%s" %s-r %s "%simage%%04d.png"' % (
+            self.conf.GetParam("paths", "ffmpeg"),
+            verbosityLevel,
+            durationSec,
+            startTimeStr,
+            self.videoPath,
+            filterArgs,
+            self.conf.GetParam("rate", "framerate"),
+            self.frameDir + os.sep,
+        )
+
+        if not RunProcess(cmdExtractImages, self.callback):
+            return False
+
+        self.extractedFrames.Invalidate()
+        frames = self.GetExtractedImageList()
+        if len(frames) <= skipFrames:
+            logging.error("Lead-in extraction wrote %d frames, not more than the %d to skip" % (len(frames), skipFrames))
+            return False
+
+        logging.info("Deglitch. Remove frames 1 to %d" % (skipFrames))
+        for framePath in frames[:skipFrames]:
+            try:
+                os.remove(framePath)
+            except OSError:
+                self.FatalError("De-glitch failed. Delete failed: " + framePath)
+
+        if not self.ReEnumerateExtractedFrames():
+            self.FatalError("Failed to re-enumerate frames")
+
+        for fileName in self.GetExtractedImageList():
+            self.PublishExtractedFrame(fileName)
+
+        return True
+
+    def OpenFrameStream(self, startTimeStr, durationSec, cropAndResize=False):
+        """Start ffmpeg decoding the clip into an FfmpegFrameStream, at the video's (or with
+        cropAndResize, the final) dimensions"""
+        if cropAndResize:
+            vf = self.GetCropAndResizeFilter()
+            width, height = self.GetCroppedAndResizedDimensions()
+        else:
+            width, height = int(self.GetVideoWidth()), int(self.GetVideoHeight())
+            vf = "scale=%d:%d" % (width, height)
+
+        inputArgs, rateFilter = self.GetSeekArgs(startTimeStr, durationSec)
+        if rateFilter:
+            vf = rateFilter + "," + vf
+
+        cmdStreamFrames = '"%s" -v error -sn %s -vf "%s" -r %s -f rawvideo -pix_fmt rgb24 -' % (
+            self.conf.GetParam("paths", "ffmpeg"),
+            inputArgs,
+            vf,
+            self.conf.GetParam("rate", "framerate"),
+        )
+
+        return FfmpegFrameStream(cmdStreamFrames, width, height)
+
+    def ExtractFramesFromStream(self, startTimeStr, durationSec, cropAndResize):
+        """Write the frames from OpenFrameStream to original/. Pillow's fastest PNG compression is a
+        lot quicker than ffmpeg's PNG encoder, and the frames are temporary anyway. Each frame is
+        written under a hidden name and renamed once it and every frame before it are complete, so
+        original/ only ever holds the start of the clip and frame listeners can use it right away.
+
+        Returns True, False if aborted, or None if nothing could be streamed and the caller should
+        extract the old way"""
+        try:
+            stream = self.OpenFrameStream(startTimeStr, durationSec, cropAndResize)
+        except OSError:
+            return None
+
+        expectedFrames = max(1, int(durationSec * float(self.conf.GetParam("rate", "framerate"))))
+        frameCount = 0
+        aborted = False
+
+        # zlib lets go of the GIL, so frames are compressed side by side while this thread reads the next ones
+        writeQueue = Queue(maxsize=2 * self.GetFrameWorkerCount())
+        writeErrors = []
+        publishLock = Lock()
+        written = set()
+        published = [0]
+
+        def FrameFileName(frameNum, hidden=False):
+            return self.frameDir + os.sep + ("." if hidden else "") + "image%04d.png" % (frameNum)
+
+        def Publish(frameNum):
+            with publishLock:
+                written.add(frameNum)
+                while published[0] + 1 in written:
+                    published[0] += 1
+                    os.replace(FrameFileName(published[0], True), FrameFileName(published[0]))
+                    self.PublishExtractedFrame(FrameFileName(published[0]))
+
+        def Writer():
+            while True:
+                item = writeQueue.get()
+                if item is None:
+                    return
+
+                image, frameNum = item
+                try:
+                    image.save(FrameFileName(frameNum, True), format="PNG", compress_level=1)
+                    Publish(frameNum)
+                except OSError as e:
+                    writeErrors.append("%s: %s" % (FrameFileName(frameNum), e))
+
+        writers = [Thread(target=Writer, daemon=True) for _ in range(self.GetFrameWorkerCount())]
+        for writer in writers:
+            writer.start()
+
+        for frame in stream:
+            frameCount += 1
+            writeQueue.put((stream.ToImage(frame), frameCount))
+
+            percent = min(100, frameCount * 100 // expectedFrames)
+            if self.callback(percent, "Extracted %d frames..." % (frameCount)) == False:
+                aborted = True
+                break
+
+        finished = stream.Close()
+
+        for _ in writers:
+            writeQueue.put(None)
+        for writer in writers:
+            writer.join()
+
+        self.callback(True)
+
+        if aborted:
+            logging.error("Frame extraction was aborted by caller")
+            return False
+
+        if len(writeErrors):
+            logging.error("Unable to write frames: " + "; ".join(writeErrors))
+            return False
+
+        if not finished or frameCount == 0:
+            logging.error("Unable to stream frames from ffmpeg. Extracting to PNG instead")
+            self.DeleteExtractedImages()
+            return None
+
+        return True
+
+    def GetExtractionSegmentCount(self, durationSec):
+        """How many ffmpegs to split frame extraction between. 0 means one per CPU core. Each gets at
+        least EXTRACTION_SEGMENT_MIN_SEC of the clip; below that, starting another costs more than it saves.
+        Each also decodes from the keyframe before its segment, so segments are kept to two keyframe gaps"""
+        try:
+            segmentCount = int(self.conf.GetParam("settings", "extractionSegments"))
+        except ValueError:
+            segmentCount = 1
+
+        if segmentCount <= 0:
+            segmentCount = os.cpu_count() or 1
+
+        minSegmentSec = max(EXTRACTION_SEGMENT_MIN_SEC, 2 * (self.GetKeyframeIntervalSec() or 0))
+        return max(1, min(segmentCount, int(durationSec / minSegmentSec)))
+
+    def ExtractFramesInSegments(self, startTimeStr, durationSec, cropAndResize, segmentCount):
+        """Split the output frames into segmentCount runs and have one ffmpeg per run extract them at
+        the same time. GetSeekArgs numbers output frames from the start of the clip whatever each
+        ffmpeg decodes around its own run, so the runs join up without repeating or losing a frame.
+        Each run is written under hidden names and moved into place once the runs before it are in.
+        Every run but the last must come out with exactly its share of frames. The last can be short
+        if the video ends first.
+
+        Returns True, False if it failed or was aborted, or None if the clip can't be split (no fps
+        filter to number the frames by: fixSlowdownGlitch is off) or a run came out the wrong length"""
+        if not self.GetSeekArgs(startTimeStr, durationSec)[1]:
+            return None
+
+        clipFrameCount = self.GetClipFrameCount(durationSec)
+        framesPerSegment = int(ceil(clipFrameCount / float(segmentCount)))
+        publishLock = Lock()
+        segmentsDone = [False] * segmentCount
+        published = [0, 0]  # segments, frames
+        wrongLength = []
+
+        def SegmentFramePattern(segmentIdx):
+            return self.frameDir + os.sep + ".segment%02d_" % (segmentIdx)
+
+        def Publish(segmentIdx):
+            with publishLock:
+                segmentsDone[segmentIdx] = True
+                while published[0] < segmentCount and segmentsDone[published[0]]:
+                    segmentFrames = sorted(glob.glob(SegmentFramePattern(published[0]) + "*.png"))
+                    expected = min(framesPerSegment, clipFrameCount - published[0] * framesPerSegment)
+                    isLast = published[0] == segmentCount - 1
+                    if len(segmentFrames) > expected or len(segmentFrames) == 0 or (len(segmentFrames) < expected and not isLast):
+                        logging.error("Extraction segment %d came out with %d frames instead of %d" % (published[0] + 1, len(segmentFrames), expected))
+                        wrongLength.append(published[0])
+                        return False
+
+                    for segmentFrame in segmentFrames:
+                        published[1] += 1
+                        fileName = self.frameDir + os.sep + "image%04d.png" % (published[1])
+                        os.replace(segmentFrame, fileName)
+                        self.PublishExtractedFrame(fileName)
+                    published[0] += 1
+            return True
+
+        jobs = []
+        for segmentIdx in range(segmentCount):
+            endFrame = None
+            if segmentIdx < segmentCount - 1:
+                endFrame = (segmentIdx + 1) * framesPerSegment
+
+            inputArgs, rateFilter = self.GetSeekArgs(startTimeStr, durationSec, segmentIdx * framesPerSegment, endFrame)
+            filters = [rateFilter]
+            if cropAndResize:
+                filters.append(self.GetCropAndResizeFilter())
+
+            cmdExtractSegment = '"%s" -v error -sn %s -vf "%s" -r %s "%s%%05d.png"' % (
+                self.conf.GetParam("paths", "ffmpeg"),
+                inputArgs,
+                ",".join(filters),
+                self.conf.GetParam("rate", "framerate"),
+                SegmentFramePattern(segmentIdx),
+            )
+            jobs.append(lambda keepGoing, segmentIdx=segmentIdx, cmd=cmdExtractSegment: RunProcess(cmd, keepGoing) and Publish(segmentIdx))
+
+        logging.info("Extract frames in %d segments of %d frames" % (segmentCount, framesPerSegment))
+        success = self.RunFrameBatch(jobs, "Extracting frames")
+        self.callback(True)
+
+        if wrongLength:
+            logging.error("Extraction segments don't join up. Extracting with one ffmpeg instead")
+            self.DeleteExtractedImages()
+            return None
+
+        return success
+
+    def ExtractDecimatedFrames(self, startTimeStr, durationSec, cropAndResize, verbosityLevel):
+        """Extract frames with ffmpeg's mpdecimate dropping those that barely change from the last one
+        kept, so they're never written out. showinfo reports where each kept frame was in the clip,
+        and the gaps go in self.frameHolds for AlterGifFrameTiming to give back. One ffmpeg writing
+        PNGs: the pipe has no timestamps, and segments would each decimate on their own.
+
+        Returns True, or False if it failed or was aborted"""
+        rate = float(self.conf.GetParam("rate", "framerate"))
+        inputArgs, rateFilter = self.GetSeekArgs(startTimeStr, durationSec)
+
+        # -r would put the dropped frames straight back, so the frame rate is set before decimating
+        filters = [rateFilter or "fps=%s" % (self.conf.GetParam("rate", "framerate"))]
+        if cropAndResize:
+            filters.append(self.GetCropAndResizeFilter())
+        filters += ["mpdecimate", "showinfo"]
+
+        cmdExtractImages = '"%s" -v %s -sn %s -vf "%s" -fps_mode passthrough "%simage%%04d.png"' % (
+            self.conf.GetParam("paths", "ffmpeg"),
+            verbosityLevel,
+            inputArgs,
+            ",".join(filters),
+            self.frameDir + os.sep,
+        )
+
+        aborted = []
+
+        def Callback(*args):
+            if self.callback(*args) == False:
+                aborted.append(True)
+                return False
+            return True
+
+        _out, err = RunProcess(cmdExtractImages, Callback, returnOutput=True)
+        self.extractedFrames.Invalidate()
+        frameCount = self.GetNumFrames()
+
+        if aborted:
+            return False
+
+        # Timestamps count output frames from 0, in the fps filter's timebase
+        keptFrames = [int(round(float(ts) * rate)) for ts in re.findall(r"Parsed_showinfo.* pts_time:(-?[0-9.]+)", err)]
+        if frameCount == 0 or len(keptFrames) != frameCount:
+            logging.error("Decimated extraction wrote %d frames but reported %d" % (frameCount, len(keptFrames)))
+            return False
+
+        keptFrames.append(max(keptFrames[-1] + 1, int(round(durationSec * rate))))
+        self.frameHolds = [keptFrames[i + 1] - keptFrames[i] for i in range(frameCount)]
+        logging.info("Decimation kept %d frames, dropped %d" % (frameCount, sum(self.frameHolds) - frameCount))
+
+        for fileName in self.GetExtractedImageList():
+            self.PublishExtractedFrame(fileName)
+
+        return True
+
+    # With cropAndResize, ffmpeg crops and scales video frames while decoding, so the extracted frames
+    # are already final size and CropAndResize has nothing left to do. Only for when the crop won't be
+    # edited afterwards (the crop tool works on full size frames) and there is no cinemagraph
+    def ExtractFrames(self, cropAndResize=False):
         self.DeleteExtractedImages()
+        self.extractedCropSignature = None
+        self.frameHolds = None
 
-        doDeglitch = False
+        cropAndResize = cropAndResize and self.SourceIsVideo() and not self.conf.GetParamBool("blend", "cinemagraph")
 
         # Video source?
         if self.SourceIsVideo():
@@ -1739,22 +3556,12 @@ class AnimatedGif:
                 startTimeStr = MillisecToDurationStr(randrange(vidLenMs))
                 logging.info("Pick random start time between 0 and %d ms -> %s" % (vidLenMs, startTimeStr))
 
-            # Grab the previous second. This is where the error is found
-            if self.conf.GetParamBool("settings", "fixSlowdownGlitch"):
-                startTimeMs = DurationStrToMillisec(startTimeStr)
-
-                if startTimeMs > 2000:
-                    startTimeMs = startTimeMs - 2000
-                    startTimeStr = MillisecToDurationStr(startTimeMs)
-                    durationSec = durationSec + 2.0
-                    doDeglitch = True
-                    logging.info("Fixing FPS glitch. New start time: " + startTimeStr + "; New duration: " + str(durationSec))
-
             # FFMPEG options (order matters!):
             # -sn: disable subtitles?
             # -t:  duration
             # -ss: start time
             # -i:  video path
+            # -vf: frame rate without the slowdown glitch (see GetSeekArgs), then crop/scale
             # -r:  frame rate
 
             if debug_mode:
@@ -1762,17 +3569,19 @@ class AnimatedGif:
             else:
                 verbosityLevel = "verbose"  # error"
 
-            cmdExtractImages = '"%s" -v %s -sn -t %.1f -ss %s -i "%s" -r %s "%simage%%04d.png"' % (
-                self.conf.GetParam("paths", "ffmpeg"),
-                verbosityLevel,
-                durationSec,
-                startTimeStr,
-                self.videoPath,
-                self.conf.GetParam("rate", "framerate"),
-                self.frameDir + os.sep,
-            )
+            success = None
+            segmentCount = self.GetExtractionSegmentCount(durationSec)
+            if self.conf.GetParamBool("settings", "decimateFrames"):
+                success = self.ExtractDecimatedFrames(startTimeStr, durationSec, cropAndResize, verbosityLevel)
+            elif segmentCount > 1:
+                success = self.ExtractFramesInSegments(startTimeStr, durationSec, cropAndResize, segmentCount)
 
-            success = RunProcess(cmdExtractImages, self.callback)
+            if success is None and self.conf.GetParamBool("settings", "streamExtraction"):
+                success = self.ExtractFramesFromStream(startTimeStr, durationSec, cropAndResize)
+
+            # Not streaming, or ffmpeg couldn't stream this video. Have it write the PNGs itself
+            if success is None:
+                success = self.ExtractFramesToPng(startTimeStr, durationSec, cropAndResize, verbosityLevel)
 
             if not success:
                 self.DeleteExtractedImages()
@@ -1795,7 +3604,8 @@ class AnimatedGif:
                         "image%04d.png" % (frameCount),
                     )
 
-                    if RunProcess(cmdConvert, self.callback, False, False):
+                    if self.RunImagemagick(cmdConvert, False):
+                        self.PublishExtractedFrame(self.frameDir + os.sep + "image%04d.png" % (frameCount))
                         frameCount += 1
                     else:
                         logging.error("Unable to convert image '" + os.path.basename(self.imageSequence[x]) + "' to png. Conversion failed.")
@@ -1815,56 +3625,103 @@ class AnimatedGif:
             else:
                 self.FatalError("Unable to extract images. Your start time might be greater than the video's length, which is unknown.")
 
-        # DEGLITCH
-        # Delete the first second's worth of frames
-        if doDeglitch:
-            deleteCount = 2 * int(self.conf.GetParam("rate", "framerate"))
+        if cropAndResize:
+            self.extractedCropSignature = self.GetCropAndResizeSignature()
 
-            logging.info("Deglitch. Remove frames 1 to %d" % deleteCount)
+        self.InvalidateFrameStores()
+        return True
 
-            for x in range(1, deleteCount + 1):
-                framePath = self.frameDir + os.sep
-                framePath += "image%04d.png" % (x)
+    def GetDuplicateFrameThreshold(self):
+        """How far apart two frames can be and still count as duplicates. 0 means identical files"""
+        try:
+            return max(0, int(self.conf.GetParam("settings", "duplicateFrameThreshold")))
+        except ValueError:
+            return 0
 
-                if not os.path.exists(framePath):
-                    self.FatalError("De-glitch failed. Frame not found: " + framePath)
-                try:
-                    os.remove(framePath)
-                except OSError:
-                    self.FatalError("De-glitch failed. Delete failed: " + framePath)
+    def GetFrameThumbprint(self, fileName):
+        """The frame shrunk to DUPLICATE_GRID_SIZE squared averaged colors. Each cell covers enough pixels
+        to average out compression noise, and few enough that a cursor or a typed letter still shows"""
+        with PIL.Image.open(fileName) as img:
+            return img.convert("RGB").resize((DUPLICATE_GRID_SIZE, DUPLICATE_GRID_SIZE), PIL.Image.BOX)
+
+    def FindDuplicateFrames(self):
+        """Group the extracted frames that are duplicates of each other. Returns a list of groups of
+        1-based frame numbers, the frame to keep first. With no threshold, a frame is a duplicate of
+        any earlier frame with the same file contents. Otherwise it's a duplicate if no cell of its
+        thumbprint is further than the threshold from the frame that started the run it's in.
+        Returns None if cancelled"""
+        imgList = self.GetExtractedImageList()
+        threshold = self.GetDuplicateFrameThreshold()
+        keys = [None] * len(imgList)
+
+        if threshold == 0:
+            fingerprint = self.frameCache.HashFile
+        else:
+            fingerprint = self.GetFrameThumbprint
 
-                self.callback(False)
+        def FingerprintJob(idx):
+            def Job(_keepGoing):
+                keys[idx] = fingerprint(imgList[idx])
+                return True
 
-            # renumerate after de-glitch
-            if not self.ReEnumerateExtractedFrames():
-                self.FatalError("Failed to re-enumerate frames")
+            return Job
 
-        return True
+        if not self.RunFrameBatch([FingerprintJob(idx) for idx in range(len(imgList))], "Checking for duplicate frames"):
+            return None
 
-    def CheckDuplicates(self, cull=False):
-        dupCount = 0
-        hashes = dict()
+        groups = []
 
-        for imgPath in self.GetExtractedImageList():
-            self.callback(False)
+        if threshold == 0:
+            groupByKey = dict()
+            for frameNum, key in enumerate(keys, 1):
+                if key in groupByKey:
+                    groupByKey[key].append(frameNum)
+                else:
+                    groupByKey[key] = [frameNum]
+                    groups.append(groupByKey[key])
+        else:
+            for frameNum, key in enumerate(keys, 1):
+                if groups:
+                    distance = max(band[1] for band in ImageChops.difference(keys[groups[-1][0] - 1], key).getextrema())
+                    if distance <= threshold:
+                        groups[-1].append(frameNum)
+                        continue
 
-            shahash = hashlib.sha256(open(imgPath, "rb").read()).digest()
+                groups.append([frameNum])
 
-            if shahash in hashes:
-                dupCount += 1
-                hashes[shahash].append(imgPath)
+        return [group for group in groups if len(group) > 1]
 
-                if cull == True:
-                    try:
-                        os.remove(imgPath)
-                        logging.info("Removing duplicate frame: %s" % (imgPath))
-                    except OSError:
-                        logging.error("Can't delete duplicate frame: %s" % (imgPath))
+    def CheckDuplicates(self, cull=False):
+        """Find duplicate frames, and delete them if cull is set. The groups found are kept in
+        self.duplicateGroups, numbered as they were before culling. Returns the number of duplicates"""
+        self.duplicateGroups = self.FindDuplicateFrames() or []
+        dupCount = sum(len(group) - 1 for group in self.duplicateGroups)
 
-            else:
-                hashes[shahash] = [imgPath]
+        if cull and dupCount > 0:
+            imgList = self.GetExtractedImageList()
+
+            culled = set(frameNum for group in self.duplicateGroups for frameNum in group[1:])
+
+            # A culled frame's time goes to the frame that's left on screen in its place: the last
+            # one before it that's kept. That isn't its group's first frame when duplicateFrameThreshold
+            # is 0, which groups identical frames from anywhere in the clip
+            if self.frameHolds is not None:
+                holds = []
+                for frameNum, hold in enumerate(self.frameHolds, 1):
+                    if frameNum in culled:
+                        holds[-1] += hold
+                    else:
+                        holds.append(hold)
+                self.frameHolds = holds
+
+            for frameNum in sorted(culled):
+                imgPath = imgList[frameNum - 1]
+                try:
+                    os.remove(imgPath)
+                    logging.info("Removing duplicate frame: %s" % (imgPath))
+                except OSError:
+                    logging.error("Can't delete duplicate frame: %s" % (imgPath))
 
-        if cull and dupCount > 0:
             self.ReEnumerateExtractedFrames()
 
         self.callback(True)
@@ -2153,11 +4010,15 @@ class AnimatedGif:
         return cmdProcImage
 
     def CropAndResize(self, argFrameIdx=None):
-        files = glob.glob(self.frameDir + os.sep + "*.png")
-        files.sort()
+        if self.extractedCropSignature is not None:
+            if self.extractedCropSignature == self.GetCropAndResizeSignature():
+                return self.LinkExtractedToResized(argFrameIdx)
 
-        origWidth = self.GetVideoWidth()
-        origHeight = self.GetVideoHeight()
+            logging.info("Frames were extracted pre-cropped with different settings. Extracting them again")
+            if not self.ExtractFrames():
+                return False
+
+        files = self.GetExtractedImageList()
 
         cinemagraphKeyFrame = int(self.conf.GetParam("blend", "cinemagraphKeyFrameIdx"))
         keyframeFile = files[cinemagraphKeyFrame]
@@ -2170,81 +4031,320 @@ class AnimatedGif:
         else:
             logging.info("Crop, Resize and Blend")
             self.DeleteResizedImages()
+            self.resizedImagesDeferred = False
             frameIdx = 1
 
+        jobs = []
         for f in files:
-            inputFileName = f
             outputFileName = self.resizeDir + os.sep + os.path.basename(f)
 
-            cmdResize = '"%s" -comment "Crop and Resize:%d" -comment "instagiffer" "%s" -resize %dx%d! +repage ' % (
+            cmdResize = '"%s" -comment "Crop and Resize:%d" -comment "instagiffer" ' % (
                 self.conf.GetParam("paths", "convert"),
                 min(len(files), frameIdx - 1) * 100 / len(files),
-                inputFileName,
-                origWidth,
-                origHeight,
             )
-            cmdResize += "  -strip "  # Get rid of weird gamma correction
-
-            #
-            # Blend: Cinemagraph
-            #
-
-            if frameIdx > 1 and self.conf.GetParamBool("blend", "cinemagraph"):
-                maskFile = self.GetMaskFileName(cinemagraphKeyFrame)
-
-                negation = ""
-                if self.conf.GetParamBool("blend", "cinemagraphInvert"):
-                    negation = " +negate "
-
-                if os.path.exists(maskFile):
-                    cmdResize += ' ( "%s" -resize %dx%d!  ( "%s" %s ) -alpha off -compose copy_opacity -composite ) -compose over -composite ' % (
-                        keyframeFile,
-                        origWidth,
-                        origHeight,
-                        maskFile,
-                        negation,
-                    )
+            cmdResize += self.GetCropAndResizeArgs(f, frameIdx, keyframeFile)
+            cmdResize += ' "%s" ' % (outputFileName)
+
+            signature = self.GetFrameSignature(f, outputFileName, cmdResize)
+            jobs.append(self.CachedFrameJob(signature, outputFileName, lambda keepGoing, cmd=cmdResize: self.RunImagemagickJob(cmd, keepGoing)))
+            frameIdx += 1
+
+        # Frames are independent of each other, so they can be run side by side
+        success = self.RunFrameBatch(jobs, "Crop and Resize")
+        self.LogFrameCacheStats()
+
+        if not success:
+            errMsg = "Image crop, resize, and blend failed or aborted"
+            self.DeleteResizedImages()
+            self.FatalError(errMsg)
+            return False
+
+        self.resizedFrames.Invalidate()
+        return True
 
-                    # Transparent cinemagraphs
-                    if self.conf.GetParamBool("blend", "cinemagraphUseTransparency"):
-                        cmdResize += ' ( ( "%s" %s ) -fill black -fuzz 0%% +opaque "#ffffff" -negate -transparent black -negate ) -compose copy_opacity -composite ' % (maskFile, negation)
-
-            #
-            # Crop
-            #
-
-            if self.conf.GetParam("size", "cropenabled"):
-                cmdResize += (
-                    " +repage "
-                    + " -crop "
-                    + self.conf.GetParam("size", "cropwidth")
-                    + "x"
-                    + self.conf.GetParam("size", "cropheight")
-                    + "+"
-                    + self.conf.GetParam("size", "cropoffsetx")
-                    + "+"
-                    + self.conf.GetParam("size", "cropoffsety")
-                    + " +repage"
+    # Imagemagick arguments that load one extracted frame and crop, resize and blend it
+    def GetCropAndResizeArgs(self, inputFileName, frameIdx, keyframeFile):
+        origWidth = self.GetVideoWidth()
+        origHeight = self.GetVideoHeight()
+
+        args = '"%s" -resize %dx%d! +repage ' % (inputFileName, origWidth, origHeight)
+        args += "  -strip "  # Get rid of weird gamma correction
+
+        #
+        # Blend: Cinemagraph
+        #
+
+        if frameIdx > 1 and self.conf.GetParamBool("blend", "cinemagraph"):
+            maskFile = self.GetMaskFileName(int(self.conf.GetParam("blend", "cinemagraphKeyFrameIdx")))
+
+            negation = ""
+            if self.conf.GetParamBool("blend", "cinemagraphInvert"):
+                negation = " +negate "
+
+            if os.path.exists(maskFile):
+                args += ' ( "%s" -resize %dx%d!  ( "%s" %s ) -alpha off -compose copy_opacity -composite ) -compose over -composite ' % (
+                    keyframeFile,
+                    origWidth,
+                    origHeight,
+                    maskFile,
+                    negation,
                 )
 
-            #
-            # Resize
-            #
+                # Transparent cinemagraphs
+                if self.conf.GetParamBool("blend", "cinemagraphUseTransparency"):
+                    args += ' ( ( "%s" %s ) -fill black -fuzz 0%% +opaque "#ffffff" -negate -transparent black -negate ) -compose copy_opacity -composite ' % (maskFile, negation)
 
-            x, y = self.GetCroppedAndResizedDimensions()
-            cmdResize += " -resize %dx%d! " % (x, y)
-            cmdResize += ' "%s" ' % (outputFileName)
+        #
+        # Crop
+        #
 
-            if not RunProcess(cmdResize, self.callback, False, False):
-                errMsg = "Image crop, resize, and blend failed or aborted"
-                self.DeleteResizedImages()
-                self.FatalError(errMsg)
-                return False
+        if self.conf.GetParam("size", "cropenabled"):
+            args += (
+                " +repage "
+                + " -crop "
+                + self.conf.GetParam("size", "cropwidth")
+                + "x"
+                + self.conf.GetParam("size", "cropheight")
+                + "+"
+                + self.conf.GetParam("size", "cropoffsetx")
+                + "+"
+                + self.conf.GetParam("size", "cropoffsety")
+                + " +repage"
+            )
 
-            frameIdx += 1
+        #
+        # Resize
+        #
+
+        x, y = self.GetCroppedAndResizedDimensions()
+        args += " -resize %dx%d! " % (x, y)
+        return args
+
+    # Extracted frames are already cropped and resized. Hard link them into resized/ rather than copying
+    def LinkExtractedToResized(self, argFrameIdx=None):
+        files = self.GetExtractedImageList()
+
+        if argFrameIdx is not None:
+            files = [files[argFrameIdx]]
+            logging.info("Crop, Resize and Blend of frame %d done during extraction" % (argFrameIdx + 1))
+        else:
+            logging.info("Crop, Resize and Blend done during extraction")
+            self.DeleteResizedImages()
+            self.resizedImagesDeferred = False
+
+        for f in files:
+            resizedFile = self.resizeDir + os.sep + os.path.basename(f)
+            if os.path.exists(resizedFile):
+                os.remove(resizedFile)
+            try:
+                os.link(f, resizedFile)
+            except OSError:
+                shutil.copy2(f, resizedFile)
+
+        self.resizedFrames.Invalidate()
+        self.callback(True)
+        return True
+
+    # Skip writing resized/ when the effects pass is about to run anyway: ImageProcessing then
+    # crops and resizes each original frame in the same Imagemagick command that applies the
+    # effects, saving a PNG write and read per frame. resized/ is filled in later if something
+    # needs it (see MaterializeResizedImages)
+    def DeferCropAndResize(self):
+        if not self.conf.GetParamBool("settings", "fusedRender") or self.extractedCropSignature is not None:
+            return self.CropAndResize()
+
+        logging.info("Crop, Resize and Blend deferred to image processing")
+        self.DeleteResizedImages()
+        self.resizedImagesDeferred = True
+        self.fusedCropAndResizeDone = False
+        return True
+
+    def MaterializeResizedImages(self):
+        if self.resizedImagesDeferred:
+            return self.CropAndResize()
         return True
 
+    def GetPillowEffects(self):
+        """The in-process effects engine, if it's selected and can handle the current settings"""
+        if self.conf.GetParam("settings", "effectsEngine").lower() != "pillow":
+            return None
+
+        pillowEffects = PillowEffects(self.conf, self.GetFinalOutputFormat() == "gif")
+        if not pillowEffects.IsSupported():
+            logging.info("Pillow effects engine doesn't do %s. Using Imagemagick" % (", ".join(pillowEffects.unsupported)))
+            return None
+
+        return pillowEffects
+
+    def RunPillowEffectsJob(self, pillowEffects, inputFileName, outputFileName, cmd, keepGoing):
+        """Apply effects in-process, falling back to cmd for frames the Pillow engine can't handle"""
+        result = pillowEffects.Apply(inputFileName, outputFileName)
+        if result is None:
+            result = self.RunImagemagickJob(cmd, keepGoing)
+        return result
+
+    def GetEffectsCommand(self, inputArgs, frameIdx, frameCount):
+        """The Imagemagick command that applies effects, captions and image layers to one frame, up to
+        the color reduction. Returns it along with the caption and image layer arguments in it"""
+        borderOffset = 0
+        if self.conf.GetParamBool("effects", "border"):
+            thickness = ReScale(
+                int(self.conf.GetParam("effects", "borderAmount")),
+                (0, 100),
+                (1, 40),
+            )
+            borderOffset = thickness
+
+        cmdProcImage = '"%s" -comment "Applying Filters, Effects and Captions:%d" -comment "instagiffer" %s' % (
+            self.conf.GetParam("paths", "convert"),
+            min(frameIdx - 1, frameCount) * 100 / frameCount,
+            inputArgs,
+        )
+
+        # Pre Filter fonts
+        overlayArgs = ""
+        for x in range(1, 30):
+            overlayArgs += self.CaptionProcessing(x, frameIdx, True, borderOffset)
+
+        # Pre Filter blits
+        for x in range(1, 2):
+            overlayArgs += self.BlitImage(x, True)
+
+        cmdProcImage += overlayArgs
+
+        #
+        # Effects
+        #
+
+        # Brightness and contrast (not supported in older versions of Imagemagick)
+        if self.conf.GetParam("effects", "brightness") != "0" or self.conf.GetParam("effects", "brightness") != "0":
+            cmdProcImage += "-brightness-contrast %sx%s " % (
+                self.conf.GetParam("effects", "brightness"),
+                self.conf.GetParam("effects", "contrast"),
+            )
+
+        if self.conf.GetParamBool("effects", "sharpen"):
+            cmdProcImage += "-sharpen 3 "
+
+        if self.conf.GetParamBool("effects", "oilPaint"):
+            cmdProcImage += "-morphology OpenI Disk:1.75 "
+
+        if self.conf.GetParam("color", "saturation") != "0":
+            scaledVal = 100 + ReScale(
+                int(self.conf.GetParam("color", "saturation")),
+                (-100, 100),
+                (-80, 80),
+            )
+            cmdProcImage += "-modulate 100,%d " % (scaledVal)
+
+        if self.conf.GetParamBool("effects", "nashville"):
+            amt = ReScale(
+                int(self.conf.GetParam("effects", "nashvilleAmount")),
+                (0, 100),
+                (10, 65),
+            )
+
+            cmdProcImage += ' ( -clone 0 -fill "#222b6d" -colorize %d%% ) ( -clone 0 -colorspace gray -negate ) -compose blend -define compose:args=50,0  -composite ' % (amt)
+            cmdProcImage += ' ( -clone 0 -fill "#f7daae" -colorize %d%% ) ( -clone 0 -colorspace gray -negate ) -compose blend -define compose:args=120,1 -composite ' % (amt)
+            cmdProcImage += " -level 3%,97% -modulate 100,150,100 -auto-gamma "
+
+        # Sepia
+        if self.conf.GetParamBool("effects", "sepiaTone"):
+            scaledVal = ReScale(
+                int(self.conf.GetParam("effects", "sepiaToneAmount")),
+                (0, 100),
+                (75, 100),
+            )
+            cmdProcImage += "-sepia-tone %d%% " % (scaledVal)
+
+        # Cartoon
+        # cmdProcImage += '-edge 1 -negate -normalize -colorspace Gray -blur 0x.5 -contrast-stretch 0x50% '
+
+        if self.conf.GetParamBool("effects", "colorTint"):
+            color = '"%s"' % (self.conf.GetParam("effects", "colorTintColor"))
+            amt = ReScale(
+                int(self.conf.GetParam("effects", "colorTintAmount")),
+                (0, 100),
+                (30, 100),
+            )
+            cmdProcImage += "-fill %s -tint %d " % (color, amt)
+
+        # Fade edges
+        if self.conf.GetParamBool("effects", "fadeEdges"):
+            rad = 100 - int(self.conf.GetParam("effects", "fadeEdgeAmount"))
+            sig = 100 - int(self.conf.GetParam("effects", "fadeEdgeAmount"))
+            rad = ReScale(rad, (0, 100), (20, 60))
+            sig = ReScale(sig, (0, 100), (50, 5000))
+            vx = -30
+            vy = -30
+            cmdProcImage += "-background black -vignette %dx%d%d%d " % (
+                rad,
+                sig,
+                vx,
+                vy,
+            )
+
+        # Blur
+        if int(self.conf.GetParam("effects", "blur")) > 0:
+            rad = 0
+            sig = ReScale(int(self.conf.GetParam("effects", "blur")), (0, 100), (1, 11))
+            cmdProcImage += "-blur %dx%s " % (rad, sig)
+
+        # Border
+        if borderOffset > 0:
+            color = self.conf.GetParam("effects", "borderColor")
+            thickness = borderOffset
+            cmdProcImage += '-bordercolor "%s" -border %d ' % (color, thickness)
+
+        # Enhancement: Dithering
+
+        # misc size optimization -normalize
+        if self.conf.GetParamBool("effects", "sharpen"):
+            sharpAmount = int(self.conf.GetParam("effects", "sharpenAmount"))
+            scaledVal = ReScale(sharpAmount, (0, 100), (0, 5))
+            ditherIdx = 0
+
+            if sharpAmount >= 60:
+                ditherIdx = 2
+            elif sharpAmount >= 30:
+                ditherIdx = 1
+
+            ditherType = [
+                "-ordered-dither checks,20",
+                "-dither Riemersma",
+                "-dither FloydSteinberg",
+            ]
+
+            cmdProcImage += "-sharpen %d %s " % (scaledVal, ditherType[ditherIdx])
+        else:
+            cmdProcImage += "-dither none "
+
+        # Post Filter captions
+        postOverlayArgs = ""
+        for x in range(1, 30):
+            postOverlayArgs += self.CaptionProcessing(x, frameIdx, False, borderOffset)
+
+        # Post Filter blits
+        for x in range(1, 2):
+            postOverlayArgs += self.BlitImage(x, False)
+
+        cmdProcImage += postOverlayArgs
+        overlayArgs += postOverlayArgs
+
+        #
+        # Colorspace conversion
+        #
+        if self.conf.GetParam("color", "colorspace") != "CMYK":
+            cmdProcImage += "-colorspace %s " % (self.conf.GetParam("color", "colorspace"))  # -matte
+
+        return cmdProcImage, overlayArgs
+
     def ImageProcessing(self, previewFrameIdx=-1):
+        pillowEffects = self.GetPillowEffects()
+
+        # The Pillow engine works from resized frames
+        if pillowEffects is not None and previewFrameIdx < 0 and not self.MaterializeResizedImages():
+            return False
 
         if previewFrameIdx >= 0:
             genPreview = True
@@ -2253,184 +4353,178 @@ class AnimatedGif:
             logging.info("Processing frame %d" % (frameIdx))
         else:
             genPreview = False
-            logging.info("Processing frames")
-            files = glob.glob(self.resizeDir + os.sep + "*.png")
-            self.DeleteProcessedImages()
             frameIdx = 1
 
-        files.sort()
+            if self.resizedImagesDeferred:
+                logging.info("Crop, Resize, Blend and Process frames")
+                files = self.GetExtractedImageList()
+            else:
+                logging.info("Processing frames")
+                files = self.GetResizedImageList()
+
+        fused = self.resizedImagesDeferred and not genPreview
+
+        if fused:
+            keyframeFile = files[int(self.conf.GetParam("blend", "cinemagraphKeyFrameIdx"))]
+
+        paletteFile = self.GetGlobalPalette()
+        if paletteFile is not None:
+            colorArgs = ' -depth 8 -remap "%s" ' % (paletteFile)
+            if pillowEffects is not None:
+                pillowEffects.UsePalette(paletteFile)
+        else:
+            colorArgs = " -depth 8 -colors %s " % (self.conf.GetParam("color", "numcolors"))
+
+        jobs = []
+        signatures = dict()  # processed frame -> GetFrameSignature
         for f in files:
-            inputFileName = f
+            # Parentheses keep the crop and blend settings (-compose etc.) away from the effects
+            if fused:
+                inputArgs = "-respect-parentheses ( %s) " % (self.GetCropAndResizeArgs(f, frameIdx, keyframeFile))
+            else:
+                inputArgs = '"%s" ' % (f)
 
             if genPreview:
                 outputFileName = self.previewFile
             else:
                 outputFileName = self.processedDir + os.sep + os.path.splitext(os.path.basename(f))[0] + "." + self.GetIntermediaryFrameFormat()
 
-            borderOffset = 0
-            if self.conf.GetParamBool("effects", "border"):
-                thickness = ReScale(
-                    int(self.conf.GetParam("effects", "borderAmount")),
-                    (0, 100),
-                    (1, 40),
-                )
-                borderOffset = thickness
+            cmdProcImage, overlayArgs = self.GetEffectsCommand(inputArgs, frameIdx, len(files))
 
-            cmdProcImage = '"%s" -comment "Applying Filters, Effects and Captions:%d" -comment "instagiffer" "%s" ' % (
-                self.conf.GetParam("paths", "convert"),
-                min(frameIdx - 1, len(files)) * 100 / len(files),
-                inputFileName,
-            )
+            # Color palette - gif only
+            if self.GetFinalOutputFormat() == "gif":
+                cmdProcImage += colorArgs
 
-            # Pre Filter fonts
-            for x in range(1, 30):
-                cmdProcImage += self.CaptionProcessing(x, frameIdx, True, borderOffset)
+            cmdProcImage += " -format %s " % (self.GetIntermediaryFrameFormat())
+            cmdProcImage += '"%s" ' % (outputFileName)
 
-            # Pre Filter blits
-            for x in range(1, 2):
-                cmdProcImage += self.BlitImage(x, True)
+            # Captions and image layers only exist as Imagemagick commands
+            usePillow = pillowEffects is not None and overlayArgs == ""
+            signature = self.GetFrameSignature(f, outputFileName, ("pillow " if usePillow else "") + cmdProcImage)
+            frameIdx += 1
 
-            #
-            # Effects
-            #
+            if not genPreview:
+                signatures[outputFileName] = signature
+                # Nothing that goes into this frame changed since it was last processed
+                if signature is not None and self.processedSignatures.get(outputFileName) == signature and os.path.exists(outputFileName):
+                    continue
 
-            # Brightness and contrast (not supported in older versions of Imagemagick)
-            if self.conf.GetParam("effects", "brightness") != "0" or self.conf.GetParam("effects", "brightness") != "0":
-                cmdProcImage += "-brightness-contrast %sx%s " % (
-                    self.conf.GetParam("effects", "brightness"),
-                    self.conf.GetParam("effects", "contrast"),
-                )
+            if usePillow:
+                jobs.append(self.CachedFrameJob(signature, outputFileName, lambda keepGoing, args=(f, outputFileName, cmdProcImage): self.RunPillowEffectsJob(pillowEffects, *args, keepGoing)))
+            elif genPreview:
+                jobs.append(self.CachedFrameJob(signature, outputFileName, lambda _keepGoing, cmd=cmdProcImage: self.RunImagemagick(cmd, False)))
+            else:
+                jobs.append(self.CachedFrameJob(signature, outputFileName, lambda keepGoing, cmd=cmdProcImage: self.RunImagemagickJob(cmd, keepGoing)))
 
-            if self.conf.GetParamBool("effects", "sharpen"):
-                cmdProcImage += "-sharpen 3 "
+        # Commands are built up front, in frame order, so that anything that depends on call
+        # order (random caption effects) comes out the same as a serial run
+        if genPreview:
+            success = jobs[0](self.callback)
+        else:
+            self.DeleteStaleProcessedImages(signatures)
+            logging.info("%d of %d frames need processing" % (len(jobs), len(signatures)))
+            success = self.RunFrameBatch(jobs, "Applying Filters, Effects and Captions")
+            self.LogFrameCacheStats()
 
-            if self.conf.GetParamBool("effects", "oilPaint"):
-                cmdProcImage += "-morphology OpenI Disk:1.75 "
+        if not success:
+            errMsg = "Image processing failed or aborted"
+            self.DeleteProcessedImages()
+            self.FatalError(errMsg)
+            return False
 
-            if self.conf.GetParam("color", "saturation") != "0":
-                scaledVal = 100 + ReScale(
-                    int(self.conf.GetParam("color", "saturation")),
-                    (-100, 100),
-                    (-80, 80),
-                )
-                cmdProcImage += "-modulate 100,%d " % (scaledVal)
+        if not genPreview:
+            self.processedSignatures = signatures
+            self.globalPaletteFile = paletteFile
+            self.DeleteStalePalettes(paletteFile)
+            self.fusedCropAndResizeDone = fused
+        self.processedFrames.Invalidate()
+        return True
 
-            if self.conf.GetParamBool("effects", "nashville"):
-                amt = ReScale(
-                    int(self.conf.GetParam("effects", "nashvilleAmount")),
-                    (0, 100),
-                    (10, 65),
-                )
+    def GetGlobalPalette(self):
+        """With globalPalette on, the image of the colors every frame gets mapped to. None to give each
+        frame colors of its own. It's worked out from GLOBAL_PALETTE_SAMPLE_FRAMES frames spread over
+        the clip, after effects, and named after what went into it: those frames, the commands run on
+        them and the color settings. Previews and the full run find the same one, so a preview shows
+        the colors the GIF will have. Samples are always cropped and resized from the extracted frames
+        with the current settings: resized/ can still hold frames from before a crop change. Once a
+        new palette is made, the ones before it are deleted"""
+        if not self.conf.GetParamBool("color", "globalPalette") or self.GetFinalOutputFormat() != "gif":
+            return None
 
-                cmdProcImage += ' ( -clone 0 -fill "#222b6d" -colorize %d%% ) ( -clone 0 -colorspace gray -negate ) -compose blend -define compose:args=50,0  -composite ' % (amt)
-                cmdProcImage += ' ( -clone 0 -fill "#f7daae" -colorize %d%% ) ( -clone 0 -colorspace gray -negate ) -compose blend -define compose:args=120,1 -composite ' % (amt)
-                cmdProcImage += " -level 3%,97% -modulate 100,150,100 -auto-gamma "
+        extracted = self.GetExtractedImageList()
+        frameCount = len(extracted)
+        if frameCount == 0:
+            return None
 
-            # Sepia
-            if self.conf.GetParamBool("effects", "sepiaTone"):
-                scaledVal = ReScale(
-                    int(self.conf.GetParam("effects", "sepiaToneAmount")),
-                    (0, 100),
-                    (75, 100),
-                )
-                cmdProcImage += "-sepia-tone %d%% " % (scaledVal)
+        keyframeFile = extracted[int(self.conf.GetParam("blend", "cinemagraphKeyFrameIdx"))]
+        preCropped = self.extractedCropSignature is not None and self.extractedCropSignature == self.GetCropAndResizeSignature()
+        numColors = int(self.conf.GetParam("color", "numcolors"))
 
-            # Cartoon
-            # cmdProcImage += '-edge 1 -negate -normalize -colorspace Gray -blur 0x.5 -contrast-stretch 0x50% '
+        key = hashlib.sha256(("%d %s" % (numColors, self.conf.GetParam("color", "colorspace"))).encode("utf-8"))
+        samples = []
+        sampleCount = min(GLOBAL_PALETTE_SAMPLE_FRAMES, frameCount)
 
-            if self.conf.GetParamBool("effects", "colorTint"):
-                color = '"%s"' % (self.conf.GetParam("effects", "colorTintColor"))
-                amt = ReScale(
-                    int(self.conf.GetParam("effects", "colorTintAmount")),
-                    (0, 100),
-                    (30, 100),
-                )
-                cmdProcImage += "-fill %s -tint %d " % (color, amt)
-
-            # Fade edges
-            if self.conf.GetParamBool("effects", "fadeEdges"):
-                rad = 100 - int(self.conf.GetParam("effects", "fadeEdgeAmount"))
-                sig = 100 - int(self.conf.GetParam("effects", "fadeEdgeAmount"))
-                rad = ReScale(rad, (0, 100), (20, 60))
-                sig = ReScale(sig, (0, 100), (50, 5000))
-                vx = -30
-                vy = -30
-                cmdProcImage += "-background black -vignette %dx%d%d%d " % (
-                    rad,
-                    sig,
-                    vx,
-                    vy,
-                )
+        for frameIdx in sorted(set(n * frameCount // sampleCount for n in range(sampleCount))):
+            if preCropped:
+                inputFileName = extracted[frameIdx]
+                inputArgs = '"%s" ' % (inputFileName)
+            else:
+                inputFileName = extracted[frameIdx]
+                inputArgs = "-respect-parentheses ( %s) " % (self.GetCropAndResizeArgs(inputFileName, frameIdx + 1, keyframeFile))
 
-            # Blur
-            if int(self.conf.GetParam("effects", "blur")) > 0:
-                rad = 0
-                sig = ReScale(int(self.conf.GetParam("effects", "blur")), (0, 100), (1, 11))
-                cmdProcImage += "-blur %dx%s " % (rad, sig)
-
-            # Border
-            if borderOffset > 0:
-                color = self.conf.GetParam("effects", "borderColor")
-                thickness = borderOffset
-                cmdProcImage += '-bordercolor "%s" -border %d ' % (color, thickness)
-
-            # Enhancement: Dithering
-
-            # misc size optimization -normalize
-            if self.conf.GetParamBool("effects", "sharpen"):
-                sharpAmount = int(self.conf.GetParam("effects", "sharpenAmount"))
-                scaledVal = ReScale(sharpAmount, (0, 100), (0, 5))
-                ditherIdx = 0
-
-                if sharpAmount >= 60:
-                    ditherIdx = 2
-                elif sharpAmount >= 30:
-                    ditherIdx = 1
-
-                ditherType = [
-                    "-ordered-dither checks,20",
-                    "-dither Riemersma",
-                    "-dither FloydSteinberg",
-                ]
+            sampleFileName = os.path.join(self.paletteDir, "sample%04d.png" % (frameIdx + 1))
+            cmdSample = self.GetEffectsCommand(inputArgs, frameIdx + 1, frameCount)[0] + ' -depth 8 "%s"' % (sampleFileName)
+            signature = self.GetFrameSignature(inputFileName, sampleFileName, cmdSample)
+            if signature is None:
+                return None
 
-                cmdProcImage += "-sharpen %d %s " % (scaledVal, ditherType[ditherIdx])
-            else:
-                cmdProcImage += "-dither none "
+            key.update(signature.encode("utf-8"))
+            samples.append((sampleFileName, cmdSample))
 
-            # Post Filter captions
-            for x in range(1, 30):
-                cmdProcImage += self.CaptionProcessing(x, frameIdx, False, borderOffset)
+        paletteFile = os.path.join(self.paletteDir, key.hexdigest()[:32] + ".png")
+        if os.path.exists(paletteFile):
+            return paletteFile
 
-            # Post Filter blits
-            for x in range(1, 2):
-                cmdProcImage += self.BlitImage(x, False)
+        jobs = [lambda keepGoing, cmd=cmdSample: self.RunImagemagickJob(cmd, keepGoing) for _sampleFileName, cmdSample in samples]
+        success = self.RunFrameBatch(jobs, "Working out the palette")
 
-            #
-            # Colorspace conversion
-            #
-            if self.conf.GetParam("color", "colorspace") != "CMYK":
-                cmdProcImage += "-colorspace %s " % (self.conf.GetParam("color", "colorspace"))  # -matte
+        if success:
+            cmdPalette = '"%s" %s +append +dither -colors %d -unique-colors "%s"' % (
+                self.conf.GetParam("paths", "convert"),
+                " ".join('"%s"' % (sampleFileName) for sampleFileName, _cmdSample in samples),
+                numColors,
+                paletteFile + ".tmp.png",
+            )
+            success = RunProcess(cmdPalette, self.callback) and os.path.exists(paletteFile + ".tmp.png")
 
-            # Color palette - gif only
-            if self.GetFinalOutputFormat() == "gif":
-                cmdProcImage += " -depth 8 -colors %s " % (self.conf.GetParam("color", "numcolors"))
+        for sampleFileName, _cmdSample in samples:
+            if os.path.exists(sampleFileName):
+                os.remove(sampleFileName)
 
-            cmdProcImage += " -format %s " % (self.GetIntermediaryFrameFormat())
-            cmdProcImage += '"%s" ' % (outputFileName)
+        if not success:
+            logging.error("Couldn't work out a palette for the GIF. Each frame gets its own")
+            return None
 
-            if not RunProcess(cmdProcImage, self.callback, False, False):
-                errMsg = "Image processing failed or aborted"
-                self.DeleteProcessedImages()
-                self.FatalError(errMsg)
-                return False
+        os.replace(paletteFile + ".tmp.png", paletteFile)
+        logging.info("Global palette: %s" % (paletteFile))
+        self.DeleteStalePalettes(paletteFile)
+        return paletteFile
 
-            frameIdx += 1
-        return True
+    def DeleteStalePalettes(self, paletteFile):
+        """Delete the palettes other than paletteFile and the one the processed frames were mapped to"""
+        for oldPaletteFile in glob.glob(os.path.join(self.paletteDir, "*.png")):
+            if oldPaletteFile not in (paletteFile, self.globalPaletteFile):
+                try:
+                    os.remove(oldPaletteFile)
+                except OSError:
+                    logging.error("Can't delete old palette: %s" % (oldPaletteFile))
 
-    # Generate final output. Returns size of generated GIF in bytes
-    def Generate(self, skipProcessing=False):
+    # Generate final output. Returns size of generated GIF in bytes. With frameStep, only every
+    # frameStep'th frame goes into the GIF, each one staying up for the frames left out after it
+    def Generate(self, skipProcessing=False, frameStep=1):
         err = ""
         fileName = self.GetNextOutputPath()
+        self.frameStep = frameStep
 
         # Process all frames
         if not skipProcessing:
@@ -2438,25 +4532,50 @@ class AnimatedGif:
         else:
             # Copy resized images to the processed directory so the
             # GIF assembly step below can find them.
+            if not self.MaterializeResizedImages():
+                return 0
             self.DeleteProcessedImages()
-            for f in sorted(glob.glob(self.resizeDir + os.sep + "*." + self.GetIntermediaryFrameFormat())):
+            for f in self.GetResizedImageList():
                 shutil.copy2(f, self.processedDir)
+            self.processedFrames.Invalidate()
+            self.globalPaletteFile = None
+
+        gifEncoder = self.GetGifEncoder()
+        if gifEncoder != "imagemagick":
+            if gifEncoder == "ffmpeg":
+                success = self.EncodeGifWithFfmpeg(fileName)
+            else:
+                success = self.EncodeGif(fileName)
+
+            if not success and os.path.exists(fileName):
+                os.remove(fileName)
+
+            if not os.path.exists(fileName) or os.path.getsize(fileName) == 0:
+                self.FatalError("Failed to create GIF :(")
+                return 0
+
+            self.gifCreated = True
+            self.lastSavedGifPath = fileName
+            self.OptimizeGif(fileName)
+            return self.GetSize()
 
         # Using convert util
         cmdCreateGif = '"%s" ' % (self.conf.GetParam("paths", "convert"))
         # Playback rate and looping
-        cmdCreateGif += " -delay %d " % (self.GetGifFrameDelay())
+        cmdCreateGif += " -delay %d " % (self.GetGifFrameDelay() * self.frameStep)
         cmdCreateGif += " -loop %d " % (int(self.conf.GetParam("rate", "numLoops")))
 
         if self.conf.GetParamBool("blend", "cinemagraphUseTransparency"):
             cmdCreateGif += " -alpha set -dispose %d " % (int(self.conf.GetParamBool("blend", "cinemagraphKeyFrameIdx")))
 
-        # Input files (expand glob in Python; shell=False won't expand wildcards)
-        pattern = self.processedDir + os.sep + "*." + self.GetIntermediaryFrameFormat()
-        processedFiles = sorted(glob.glob(pattern))
-        for f in processedFiles:
+        # Input files (expand the list in Python; shell=False won't expand wildcards)
+        for f in self.GetGifFrameList():
             cmdCreateGif += '"%s" ' % f
 
+        # The frames already use only these colors. Mapping them again gives them one color table
+        if self.globalPaletteFile is not None:
+            cmdCreateGif += '+dither -remap "%s" ' % (self.globalPaletteFile)
+
         # IM7: -layers must come after input images
         if not self.conf.GetParamBool("blend", "cinemagraphUseTransparency"):
             cmdCreateGif += "-layers optimizePlus "
@@ -2479,10 +4598,241 @@ class AnimatedGif:
 
         return self.GetSize()
 
-    def AlterGifFrameTiming(self, fileName):
+    def GetGifSizeBudget(self):
+        """maxGifSize in bytes, or 0 for no limit"""
+        try:
+            return ByteSizeStrToBytes(self.conf.GetParam("size", "maxGifSize") or "0")
+        except ValueError:
+            logging.error("Ignoring maxGifSize: %s" % (self.conf.GetParam("size", "maxGifSize")))
+            return 0
+
+    def GenerateWithinBudget(self, maxBytes):
+        """Generate a GIF of at most maxBytes, lowering the size, the frame rate and the number of colors
+        (see BUDGET_SCALES, BUDGET_FRAME_STEPS and BUDGET_COLORS) only as far as needed. Bigger is
+        preferred over smoother, and smoother over more colors. GIF size drops with each of them, so
+        each one is binary searched with the ones after it at their lowest. Extracted frames are
+        reused throughout; resized and processed frames come back out of the frame cache when a
+        setting is tried again. Every try is logged. Returns the size of the GIF left behind, which is
+        the smallest one possible if nothing fits"""
+        if self.GetFinalOutputFormat() != "gif":
+            return self.Generate()
+
+        numColors = int(self.conf.GetParam("color", "numcolors"))
+        resizePostCrop = self.conf.GetParam("size", "resizePostCrop")
+        savePath = self.gifOutPath
+        overwriteGif = self.overwriteGif
+        width, height = self.GetCroppedAndResizedDimensions()
+        colorSteps = [numColors] + [c for c in BUDGET_COLORS if c < numColors]
+        tries = dict()  # (scale, frameStep, numColors) -> GIF size
+        lastTry = []
+
+        def Try(setting):
+            if setting in tries and lastTry[-1:] == [setting]:
+                return tries[setting]
+
+            scale, frameStep, colors = setting
+            dimensions = "%dx%d" % (max(1, width * scale // 100), max(1, height * scale // 100))
+            self.conf.SetParam("color", "numcolors", str(colors))
+            if self.conf.SetParam("size", "resizePostCrop", dimensions):
+                self.DeferCropAndResize()
+
+            tries[setting] = self.Generate(frameStep=frameStep)
+            lastTry.append(setting)
+            logging.info("GIF budget %d kB: %s, every %d frame(s), %d colors -> %d kB" % (maxBytes // 1024, dimensions, frameStep, colors, tries[setting] // 1024))
+            return tries[setting]
+
+        def Fits(setting):
+            if setting not in tries:
+                Try(setting)
+            return tries[setting] <= maxBytes
+
+        def BestThatFits(steps, settingFn):
+            # The last step is known to fit
+            lo, hi = 0, len(steps) - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if Fits(settingFn(steps[mid])):
+                    hi = mid
+                else:
+                    lo = mid + 1
+            return steps[lo]
+
+        try:
+            # Written over and over while searching
+            self.SetSavePath(self.GetNextOutputPath())
+            self.OverwriteOutputGif(True)
+
+            best = (100, 1, numColors)
+            smallest = (BUDGET_SCALES[-1], BUDGET_FRAME_STEPS[-1], colorSteps[-1])
+
+            if Fits(best):
+                pass
+            elif not Fits(smallest):
+                logging.error("GIF budget %d kB: can't get the GIF that small. Keeping the smallest one" % (maxBytes // 1024))
+                best = smallest
+            else:
+                scale = BestThatFits(BUDGET_SCALES, lambda scale: (scale, BUDGET_FRAME_STEPS[-1], colorSteps[-1]))
+                frameStep = BestThatFits(BUDGET_FRAME_STEPS, lambda frameStep: (scale, frameStep, colorSteps[-1]))
+                best = (scale, frameStep, BestThatFits(colorSteps, lambda colors: (scale, frameStep, colors)))
+
+            size = Try(best)
+            logging.info("GIF budget %d kB: went with %d%% of the size, every %d frame(s), %d colors after %d tries" % ((maxBytes // 1024,) + best + (len(lastTry),)))
+        finally:
+            self.SetSavePath(savePath)
+            self.OverwriteOutputGif(overwriteGif)
+            self.conf.SetParam("color", "numcolors", str(numColors))
+
+            # The frames were resized for the GIF. Resize them again when something needs them
+            if self.conf.SetParam("size", "resizePostCrop", resizePostCrop) and self.extractedCropSignature is None:
+                self.DeleteResizedImages()
+                self.resizedImagesDeferred = True
+                self.fusedCropAndResizeDone = False
+
+        return size
+
+    def GetGifEncoder(self):
+        """What Generate writes the GIF with: imagemagick, native (GifEncoder) or ffmpeg"""
+        gifEncoder = self.conf.GetParam("settings", "gifEncoder").lower()
+        if gifEncoder not in ("native", "ffmpeg") or self.GetFinalOutputFormat() != "gif":
+            return "imagemagick"
+
+        if self.conf.GetParamBool("blend", "cinemagraph") and self.conf.GetParamBool("blend", "cinemagraphUseTransparency"):
+            logging.info("GIF encoder: transparency needs ImageMagick")
+            return "imagemagick"
+
+        return gifEncoder
+
+    def EncodeGif(self, fileName):
+        """Write the processed frames to fileName with GifEncoder, reading them in one at a time. Delays
+        and loops are the ones the ImageMagick path ends up with, frame timings included. Returns False
+        if a frame couldn't be read or the callback aborted"""
+        frames = self.GetGifFrameList()
+        frameTimings = self.GetFrameTimingsMs()
+        delayMs = int(self.GetGifFrameDelay()) * 10 * self.frameStep
+        encoder = None
+
+        try:
+            for frameIdx, frameFile in enumerate(frames):
+                with PIL.Image.open(frameFile) as img:
+                    if encoder is None:
+                        encoder = GifEncoder(fileName, img.size, int(self.conf.GetParam("rate", "numLoops")), int(self.conf.GetParam("color", "numcolors")))
+                    encoder.AddFrame(img, frameTimings.get(frameIdx, delayMs))
+
+                if self.callback(frameIdx * 100 // len(frames), "Writing GIF frame %d of %d" % (frameIdx + 1, len(frames))) == False:
+                    logging.error("GIF encoding was aborted by caller")
+                    return False
+        except OSError as e:
+            logging.error("GIF encoder: %s" % (e))
+            return False
+        finally:
+            if encoder is not None:
+                encoder.Close()
+            self.callback(True)
+
+        return encoder is not None
+
+    def EncodeGifWithFfmpeg(self, fileName):
+        """Write the processed frames to fileName with ffmpeg, in two passes: palettegen works out one
+        palette from all of the frames, then paletteuse maps each frame to it and the GIF muxer only
+        stores what changed. The frames go in through a concat list, which carries each frame's delay;
+        the image demuxer's frame rate is set so those land on whole hundredths. Returns False if
+        ffmpeg failed or was aborted"""
+        frames = self.GetGifFrameList()
+        if len(frames) == 0:
+            return False
+
+        frameTimings = self.GetFrameTimingsMs()
+        delayMs = int(self.GetGifFrameDelay()) * 10 * self.frameStep
+        listFile = os.path.join(self.workDir, "gifframes.txt")
+        paletteFile = os.path.join(self.workDir, "gifpalette.png")
+
+        with open(listFile, "w", encoding="utf-8") as f:
+            f.write("ffconcat version 1.0\n")
+            for frameIdx, frameFile in enumerate(frames):
+                f.write("file '%s'\noption framerate 100\nduration %.2f\n" % (frameFile.replace("'", "'\\''"), frameTimings.get(frameIdx, delayMs) / 1000.0))
+
+        ffmpegInput = '"%s" -v error -f concat -safe 0 -i "%s"' % (self.conf.GetParam("paths", "ffmpeg"), listFile)
+        numColors = max(4, min(256, int(self.conf.GetParam("color", "numcolors"))))
+
+        if os.path.exists(paletteFile):
+            os.remove(paletteFile)
+
+        # The frames were mapped to a global palette already. paletteuse takes it as exactly 256 pixels
+        if self.globalPaletteFile is not None:
+            with PIL.Image.open(self.globalPaletteFile) as img:
+                colors = img.convert("RGB").tobytes()[: 256 * 3]
+            PIL.Image.frombytes("RGB", (16, 16), colors + colors[-3:] * (256 - len(colors) // 3)).save(paletteFile)
+        else:
+            cmdPalette = '%s -vf "palettegen=max_colors=%d" -y "%s"' % (ffmpegInput, numColors, paletteFile)
+            RunProcess(cmdPalette, self.callback, callBackFinalize=False)
+
+        if not os.path.exists(paletteFile):
+            logging.error("ffmpeg couldn't make a palette")
+            self.callback(True)
+            return False
+
+        cmdCreateGif = '%s -i "%s" -lavfi "[0:v][1:v]paletteuse=diff_mode=rectangle" -loop %d -final_delay %d -y "%s"' % (
+            ffmpegInput,
+            paletteFile,
+            int(self.conf.GetParam("rate", "numLoops")),
+            frameTimings.get(len(frames) - 1, delayMs) // 10,
+            fileName,
+        )
+        return RunProcess(cmdCreateGif, self.callback)
+
+    def GetGifFrameList(self):
+        """The processed frames that go into the GIF"""
+        return self.GetProcessedImageList()[:: self.frameStep]
+
+    def GetFrameTimingsMs(self):
+        """Frame index -> delay in milliseconds, for frames that don't get the usual delay. Frames that
+        decimation held on screen for longer come first, then customFrameTimingMs. Holds only apply
+        while the frames are the ones extracted; after adding or removing frames they're left out.
+        With a frameStep, indexes are into GetGifFrameList and delays cover the frames left out"""
+        frameTimings = dict()
+
+        if self.frameHolds is not None:
+            if len(self.frameHolds) == self.GetNumFrames():
+                for frameIdx, hold in enumerate(self.frameHolds):
+                    if hold > 1:
+                        frameTimings[frameIdx] = int(hold * self.GetGifFrameDelay() * 10)
+            else:
+                logging.info("Frames were added or removed since decimation. Leaving out the held frame timings")
+
         frameTimingsStr = self.conf.GetParam("rate", "customFrameTimingMs")
 
-        if len(frameTimingsStr) == 0:
+        if len(frameTimingsStr):
+            for frameStr in frameTimingsStr.split(","):
+                frameIdx, frameMs = frameStr.split(":")
+                frameTimings[int(frameIdx)] = int(frameMs)
+
+        if self.frameStep > 1:
+            delayMs = int(self.GetGifFrameDelay()) * 10
+            frameCount = len(self.GetProcessedImageList())
+            steppedTimings = dict()
+
+            for frameIdx in range(0, frameCount, self.frameStep):
+                group = range(frameIdx, min(frameIdx + self.frameStep, frameCount))
+                if len(group) < self.frameStep or any(i in frameTimings for i in group):
+                    steppedTimings[frameIdx // self.frameStep] = sum(frameTimings.get(i, delayMs) for i in group)
+
+            frameTimings = steppedTimings
+
+        return frameTimings
+
+    def AlterGifFrameTiming(self, fileName):
+        frameTimings = self.GetFrameTimingsMs()
+
+        if len(frameTimings) == 0:
+            return
+
+        try:
+            notFound = SetGifFrameDelays(fileName, {frameIdx: int(frameMs / 10) for frameIdx, frameMs in frameTimings.items()})
+        except (OSError, ValueError) as e:
+            logging.error("Couldn't change the frame timings in place (%s). Using Imagemagick" % (e))
+        else:
+            if notFound:
+                logging.error("Frame timings for frames the GIF doesn't have: %s" % (notFound))
             return
 
         cmdChangeGifTiming = '"%s" "%s" ' % (
@@ -2490,35 +4840,68 @@ class AnimatedGif:
             fileName,
         )
 
-        for frameStr in frameTimingsStr.split(","):
-            frameIdx, frameMs = frameStr.split(":")
-
-            frameIdx = int(frameIdx)
-            frameMs = int(frameMs)
-
+        for frameIdx, frameMs in sorted(frameTimings.items()):
             cmdChangeGifTiming += " ( -clone %d -set delay %d ) -swap %d,-1 +delete " % (frameIdx, frameMs / 10, frameIdx)
 
         cmdChangeGifTiming += ' "%s"' % (fileName)
         RunProcess(cmdChangeGifTiming, self.callback, returnOutput=True)
 
     def OptimizeGif(self, fileName):
-        # Run optimizer
-        if self.conf.GetParamBool("size", "fileOptimizer") and os.path.exists(self.conf.GetParam("paths", "gifsicle")):
-            olevel = 3
-            beforeSize = self.GetSize()
-
-            cmdOptimizeGif = '"%s" -O%d --colors 256 "%s" -o "%s"' % (
-                self.conf.GetParam("paths", "gifsicle"),
-                olevel,
-                fileName,
+        """Run the GIF through gifsicle at fileOptimizerTier, if fileOptimizer is on. With
+        fileOptimizerReport, every tier in GIF_OPTIMIZER_TIERS is run on the GIF as well, and how long
+        each took and how big the GIF came out are logged side by side"""
+        gifsicle = self.conf.GetParam("paths", "gifsicle")
+        if not self.conf.GetParamBool("size", "fileOptimizer") or not self._tool_exists(gifsicle):
+            return
+
+        tiers = dict(GIF_OPTIMIZER_TIERS)
+        tier = self.conf.GetParam("size", "fileOptimizerTier").lower() or "lossless"
+        if tier not in tiers:
+            logging.error("Unknown fileOptimizerTier %s. Using lossless" % (tier))
+            tier = "lossless"
+
+        if self.conf.GetParamBool("size", "fileOptimizerReport"):
+            tried = [name for name, _lossy in GIF_OPTIMIZER_TIERS]
+        else:
+            tried = [tier]
+
+        beforeSize = os.path.getsize(fileName)
+        results = dict()  # Tier -> (output file, seconds)
+
+        for name in tried:
+            outputFileName = os.path.join(self.workDir, "optimized.%s.gif" % (name))
+            cmdOptimizeGif = '"%s" -O3 --colors 256 %s"%s" -o "%s"' % (
+                gifsicle,
+                "--lossy=%d " % (tiers[name]) if tiers[name] else "",
                 fileName,
+                outputFileName,
             )
 
+            start = time.perf_counter()
             RunProcess(cmdOptimizeGif, self.callback, returnOutput=True)
+            elapsedSec = time.perf_counter() - start
+
+            if os.path.exists(outputFileName) and os.path.getsize(outputFileName) > 0:
+                results[name] = (outputFileName, elapsedSec)
+                afterSize = os.path.getsize(outputFileName)
+                logging.info(
+                    "gifsicle %-8s %7.0f ms %9.1f kB (%+.1f%%)%s"
+                    % (name, elapsedSec * 1000, afterSize / 1024.0, (afterSize - beforeSize) * 100.0 / beforeSize, " <- fileOptimizerTier" if name == tier else "")
+                )
+            else:
+                logging.error("gifsicle %s didn't write a GIF" % (name))
 
-            afterSize = self.GetSize()
+        if tier in results:
+            optimizedFileName = results.pop(tier)[0]
+            try:
+                os.replace(optimizedFileName, fileName)
+            except OSError:  # Work dir is on another drive
+                shutil.copyfile(optimizedFileName, fileName)
+                os.remove(optimizedFileName)
+            logging.info("Optimization shaved off %.1f kB" % (float(beforeSize - os.path.getsize(fileName)) / 1024.0))
 
-            logging.info("Optimization shaved off %.1f kB" % (float(beforeSize - afterSize) / 1024.0))
+        for outputFileName, _elapsedSec in results.values():
+            os.remove(outputFileName)
 
     def GenerateFramePreview(self, idx):
         idx -= 1
@@ -2527,6 +4910,60 @@ class AnimatedGif:
         self.callback(True)
         return self.previewFile
 
+    def RenderFramePreview(self, idx):
+        """GenerateFramePreview in memory: frame idx is cropped, resized and processed with Pillow
+        (PillowEffects), without starting ImageMagick or writing files. Returns the image, or None if
+        the frame needs ImageMagick: captions, image layers, a cinemagraph blend or effects that
+        PillowEffects doesn't do. The crop is the same as Imagemagick's; the resize filter can differ
+        slightly"""
+        if not self.conf.GetParamBool("settings", "fastPreview"):
+            return None
+
+        pillowEffects = PillowEffects(self.conf, self.GetFinalOutputFormat() == "gif")
+        if not pillowEffects.IsSupported():
+            logging.info("Pillow preview doesn't do %s. Using Imagemagick" % (", ".join(pillowEffects.unsupported)))
+            return None
+
+        if idx > 1 and self.conf.GetParamBool("blend", "cinemagraph"):
+            return None
+
+        # Frames that were extracted cropped with other settings have to be extracted again
+        preCropped = self.extractedCropSignature is not None
+        if preCropped and self.extractedCropSignature != self.GetCropAndResizeSignature():
+            return None
+
+        if self.GetEffectsCommand("", idx, self.GetNumFrames())[1] != "":
+            return None
+
+        paletteFile = self.GetGlobalPalette()
+        if paletteFile is not None:
+            pillowEffects.UsePalette(paletteFile)
+
+        with PIL.Image.open(self.GetExtractedImageList()[idx - 1]) as img:
+            img.load()
+
+        if not preCropped:
+            videoSize = (self.GetVideoWidth(), self.GetVideoHeight())
+            if img.size != videoSize:
+                img = img.resize(videoSize, PIL.Image.LANCZOS)
+
+            # -crop clips the crop box to the image, and 0x0 means all of it
+            cropWidth, cropHeight = int(self.conf.GetParam("size", "cropWidth")), int(self.conf.GetParam("size", "cropHeight"))
+            cropX, cropY = int(self.conf.GetParam("size", "cropOffsetX")), int(self.conf.GetParam("size", "cropOffsetY"))
+            box = (
+                max(0, cropX),
+                max(0, cropY),
+                min(img.width, cropX + cropWidth) if cropWidth > 0 else img.width,
+                min(img.height, cropY + cropHeight) if cropHeight > 0 else img.height,
+            )
+            if box[0] < box[2] and box[1] < box[3] and box != (0, 0) + img.size:
+                img = img.crop(box)
+
+            if img.size != self.GetCroppedAndResizedDimensions():
+                img = img.resize(self.GetCroppedAndResizedDimensions(), PIL.Image.LANCZOS)
+
+        return pillowEffects.Render(img)
+
     def GetPreviewImagePath(self):
         return self.previewFile
 
@@ -2569,6 +5006,16 @@ class AnimatedGif:
         vidLen = float("%.1f" % (DurationStrToMillisec(self.videoLength) / 1000.0))
         return vidLen
 
+    def GetVideoCodec(self):
+        if self.mediaInfo is None:
+            return None
+        return self.mediaInfo["stream"].get("codec_name")
+
+    def GetKeyframeIntervalSec(self):
+        if self.mediaInfo is None:
+            return None
+        return self.mediaInfo["keyframeIntervalSec"]
+
     def GetVideoFps(self):
         if self.videoFps < 1:
             return 1
@@ -2657,6 +5104,7 @@ class GifApp:
         self.gif = None
         self.guiBusy = False
         self.showPreviewFlag = False
+        self.previewImage = None  # The last preview, if it was rendered in memory
         self.parent = parent
         self.configPath = configPath
         self.thumbnailIdx = 0
@@ -2681,6 +5129,10 @@ class GifApp:
         self.maskEventList = None
         self.maskEdited = False
         self.trackBarTs = 0
+        self.framesExtracted = None  # Frames ExtractFrames has handed over so far. None when it isn't running
+        self.framesExtractedLock = Lock()  # OnFrameExtracted runs on the engine's writer threads
+        self.framesShown = 0
+        self.framesShownTs = 0
 
         # DPI scaling
         # On Windows with Python 3/Tk9 the process is DPI-aware, so we must query
@@ -2863,6 +5315,22 @@ class GifApp:
             )
         #
 
+        #
+        # GIF size limit
+        #
+
+        self.maxGifSizeMenu = Menu(self.settingsMenu, tearoff=0)
+        self.maxGifSize = StringVar()
+        self.maxGifSize.set(self.conf.GetParam("size", "maxGifSize") or "0")
+
+        for label, size in [("No Limit", "0"), ("1 MB", "1MB"), ("2 MB", "2MB"), ("5 MB", "5MB"), ("8 MB", "8MB"), ("10 MB", "10MB"), ("15 MB", "15MB")]:
+            self.maxGifSizeMenu.add_radiobutton(
+                label=label,
+                value=size,
+                variable=self.maxGifSize,
+                command=self.OnChangeMenuSetting,
+            )
+
         self.overwriteOutputGif = StringVar()
         self.fileSizeOptimize = StringVar()
 
@@ -2873,6 +5341,7 @@ class GifApp:
             command=self.OnChangeMenuSetting,
         )
         self.settingsMenu.add_cascade(label="Youtube Download Quality", underline=0, menu=self.qualityMenu)
+        self.settingsMenu.add_cascade(label="Maximum GIF Size", underline=0, menu=self.maxGifSizeMenu)
         self.settingsMenu.add_command(label="Configure Your Logo...", underline=0, command=self.OnSetLogo)
 
         if ImAPC():
@@ -3598,6 +6067,7 @@ class GifApp:
 
         if deleteConfirmed:
             if self.gif is not None:
+                self.gif.StopWorkers()
                 self.gif = None
                 self.ResetInputs()
                 self.EnableInputs(False, True)
@@ -3693,6 +6163,9 @@ class GifApp:
         # Download quality setting
         self.conf.SetParam("settings", "downloadQuality", self.downloadQuality.get())
 
+        # Size limit
+        self.frameTimingOrCompressionChanges += self.conf.SetParam("size", "maxGifSize", self.maxGifSize.get())
+
         # File size optimize
         if len(self.fileSizeOptimize.get()):
             self.frameTimingOrCompressionChanges += self.conf.SetParam("size", "fileOptimizer", bool(int(self.fileSizeOptimize.get()) == 1))
@@ -3913,8 +6386,8 @@ class GifApp:
 
         img = None
 
-        # Cached thumbnail mode
-        if self.conf.GetParamBool("settings", "cacheThumbs"):
+        # Cached thumbnail mode. Not while frames are still coming in; the cache would be rebuilt for every one
+        if self.conf.GetParamBool("settings", "cacheThumbs") and self.framesExtracted is None:
             # Update thumbnail memory cache
             framesOnDiskTs = self.gif.GetExtractedImagesLastModifiedTs()
             if self.thumbNailsUpdatedTs < framesOnDiskTs:
@@ -3968,6 +6441,35 @@ class GifApp:
             self.frameCounterStr.set("Frame  %d / %d" % (self.thumbnailIdx, len(imgList)))
             self.sclFrameTrackbar.configure(to=len(imgList))  # This can recurse?
 
+    # Called by the engine, possibly from one of its threads, each time a frame is extracted
+    def OnFrameExtracted(self, fileName):
+        with self.framesExtractedLock:
+            if self.framesExtracted is not None:
+                self.framesExtracted += 1
+
+    def SetFramesExtracted(self, count):
+        with self.framesExtractedLock:
+            self.framesExtracted = count
+
+    # Frames extracted so far that aren't on show yet. Only counts while frames are being extracted
+    def GetFramesExtractedNotShown(self):
+        with self.framesExtractedLock:
+            if not self.framesExtracted or self.framesExtracted == self.framesShown:
+                return 0
+            return self.framesExtracted - self.framesShown
+
+    # Let the frames extracted so far be looked through, and the crop set, while the rest are on their way.
+    # Only the GUI follows along: cropping, resizing and effects still wait for the whole clip
+    def ShowExtractedFrames(self):
+        with self.framesExtractedLock:
+            self.framesShown = self.framesExtracted
+        self.framesShownTs = time.time()
+
+        for inputs in [self.sclFrameTrackbar, self.btnTrackbarRight, self.btnTrackbarLeft]:
+            inputs.configure(state="normal")
+
+        self.UpdateThumbnailPreview()
+
     def TrackbarCanPlay(self):
         since = (time.time() - self.trackBarTs) * 1000
 
@@ -4275,6 +6777,9 @@ class GifApp:
 
             self.guiBusy = True
 
+            if time.time() - self.framesShownTs >= 0.25 and self.GetFramesExtractedNotShown():
+                self.ShowExtractedFrames()
+
         self.parent.update_idletasks()
         self.parent.update()
 
@@ -4289,6 +6794,9 @@ class GifApp:
         # Cancel any actions in progress
         self.OnCancel(None)
 
+        if self.gif is not None:
+            self.gif.StopWorkers()
+
         if self.conf:
             if self.conf.GetParamBool("settings", "deleteTempFilesOnClose"):
                 self.OnDeleteTemporaryFiles(False)  # Don't prompt
@@ -4558,15 +7066,18 @@ class GifApp:
         self.InitializeCropTool()
         self.guiBusy = False
 
+    # Show an image file, or a PIL image, scaled to the canvas
     def ShowImageOnCanvas(self, fileName):
 
-        if not os.path.exists(fileName):
+        if isinstance(fileName, PIL.Image.Image):
+            img = fileName
+        elif not os.path.exists(fileName):
             return False
+        else:
+            img = PIL.Image.open(fileName)
 
         cw, ch = self._canvas_dims()
 
-        img = PIL.Image.open(fileName)
-
         w, h = img.size
 
         if w <= 0 or h <= 0:
@@ -4617,7 +7128,9 @@ class GifApp:
         if self.showPreviewFlag == False:
             return False
 
-        if self.gif.PreviewFileExists():
+        if self.previewImage is not None:
+            self.ShowImageOnCanvas(self.previewImage)
+        elif self.gif.PreviewFileExists():
             self.ShowImageOnCanvas(self.gif.GetPreviewImagePath())
 
         return True
@@ -4651,6 +7164,9 @@ class GifApp:
         if self.gif == None:
             return False
 
+        # Pick up frames edited by hand since the last update. One directory scan per stage for this update
+        self.gif.InvalidateFrameStores()
+
         timeOrRateSettingChanges = 0
         sizeSettingChanges = 0
         gifSettingChanges = 0
@@ -4752,11 +7268,7 @@ class GifApp:
 
         if self.lastProcessTsByLevel[1] == 0:
             timeOrRateSettingChanges += 1
-        if (
-            self.lastProcessTsByLevel[2] == 0
-            or (self.lastProcessTsByLevel[1] > self.lastProcessTsByLevel[2])
-            or (self.gif.GetExtractedImagesLastModifiedTs() > self.gif.GetResizedImagesLastModifiedTs())
-        ):
+        if self.lastProcessTsByLevel[2] == 0 or (self.lastProcessTsByLevel[1] > self.lastProcessTsByLevel[2]) or self.gif.ResizedImagesOutOfDate():
             sizeSettingChanges += 1
         if (
             self.lastProcessTsByLevel[3] == 0
@@ -4794,7 +7306,12 @@ class GifApp:
                 self.EnableInputs(False, False)
                 inputDisabled = True
                 self.SetStatus("(1/" + str(processStages) + ") Extracting frames...")
-                self.gif.ExtractFrames()
+                self.framesShown = 0
+                self.SetFramesExtracted(0)
+                try:
+                    self.gif.ExtractFrames()
+                finally:
+                    self.SetFramesExtracted(None)
 
                 #
                 # Dup detection and removal
@@ -4806,8 +7323,13 @@ class GifApp:
                 self.SetStatus("(1/" + str(processStages) + ") Checking for duplicate frames...")
                 numDups = self.gif.CheckDuplicates(deleteDupFrames)
 
-                if numDups > 0 and deleteDupFrames:
-                    self.SetStatus("%d/%d were duplicates. Delete: %s" % (numDups, frameCount, str(deleteDupFrames)))
+                if numDups > 0:
+                    dupFrames = ", ".join(FrameNumbersToStr(group[1:]) for group in self.gif.duplicateGroups)
+                    logging.info("Duplicate frames (kept frame first): %s" % (self.gif.duplicateGroups))
+                    if deleteDupFrames:
+                        self.SetStatus("%d/%d were duplicates. Deleted frames %s" % (numDups, frameCount, dupFrames))
+                    else:
+                        self.SetStatus("%d/%d are duplicates: frames %s" % (numDups, frameCount, dupFrames))
 
                 if not self.gif.SourceIsVideo() and frameCount > 20 and frameCount - 1 == numDups:
                     raise RuntimeError(
@@ -4828,7 +7350,11 @@ class GifApp:
                     self.SetStatus("(2/" + str(processStages) + ") Cropping and resizing...")
 
                 if not preview:
-                    self.gif.CropAndResize()
+                    # Effects always follow a crop/resize change, so both can be done in one pass
+                    if processStages >= 3:
+                        self.gif.DeferCropAndResize()
+                    else:
+                        self.gif.CropAndResize()
                     self.lastProcessTsByLevel[2] = time.time()
 
             imageProcessingRequired = timeOrRateSettingChanges or sizeSettingChanges or gifSettingChanges
@@ -4838,7 +7364,10 @@ class GifApp:
 
                 if preview:
                     self.SetStatus("Generating preview")
-                    self.gif.GenerateFramePreview(self.GetThumbNailIndex())
+                    self.previewImage = None  # Not the last one, if this fails
+                    self.previewImage = self.gif.RenderFramePreview(self.GetThumbNailIndex())
+                    if self.previewImage is None:
+                        self.gif.GenerateFramePreview(self.GetThumbNailIndex())
                 else:
                     self.SetStatus(
                         "(3/"
@@ -4849,7 +7378,11 @@ class GifApp:
                             self.gif.GetNextOutputPath(),
                         )
                     )
-                    self.gif.Generate(not imageProcessingRequired)
+                    if self.gif.GetGifSizeBudget() > 0:
+                        self.gif.GenerateWithinBudget(self.gif.GetGifSizeBudget())
+                        self.miscGifChanges += 1  # Start from the chosen settings next time, not the budget's
+                    else:
+                        self.gif.Generate(not imageProcessingRequired)
                     self.lastProcessTsByLevel[3] = time.time()
 
                 self.SetStatus("Done")
@@ -4898,7 +7431,7 @@ class GifApp:
             else:
                 self.SetStatus("GIF saved. GIF size: " + str(round(self.gif.GetSize() / 1024)) + "kB. Path: " + self.gif.GetLastGifOutputPath())
 
-                self.PlayGif(self.gif.GetProcessedImageList(), self.gif.GetGifFrameDelay())
+                self.PlayGif(self.gif.GetGifFrameList(), self.gif.GetGifFrameDelay() * self.gif.frameStep)
 
         if doUpdateThumbs:
             self.SetThumbNailIndex(1)
@@ -5037,8 +7570,12 @@ class GifApp:
 
         # Attempt to open the video for processing
         if len(fileName):
+            if self.gif is not None:
+                self.gif.StopWorkers()
+
             try:
                 self.gif = AnimatedGif(self.conf, fileName, self.tempDir, self.OnShowProgress, self.parent)
+                self.gif.AddFrameListener(self.OnFrameExtracted)
 
             except Exception as e:  # pylint: disable=broad-exception-caught
                 self.gif = None
@@ -7434,7 +9971,14 @@ class InstaCommandLine:
         parser.add_argument("-o", "--output", help="Output GIF path (default: ~/Desktop/insta.gif)")
         parser.add_argument("--config", default="instagiffer.conf", help="Path to config file")
         parser.add_argument("--debug", action="store_true", help="Enable debug mode (verbose logging to stdout)")
+        parser.add_argument("--max-size", help="Make the GIF no bigger than this, e.g. 8MB or 500k, by lowering its size, frame rate and colors")
         args = parser.parse_args()
+        if args.max_size is not None:
+            try:
+                ByteSizeStrToBytes(args.max_size)
+            except ValueError as e:
+                parser.error(str(e))
+        self.maxSize = args.max_size
         self.configPath = args.config
         self.debug = args.debug
         self.batchMode = args.video is not None
@@ -7446,6 +9990,8 @@ class InstaCommandLine:
         conf = InstaConfig(self.configPath)
         if self.outputPath:
             conf.SetParam("paths", "gifOutputPath", os.path.abspath(self.outputPath))
+        if self.maxSize is not None:
+            conf.SetParam("size", "maxGifSize", self.maxSize)
 
         def progress(done, _=None):
             if done:
@@ -7461,12 +10007,19 @@ class InstaCommandLine:
             pct = max(1, int(resizeVal)) / 100.0
             conf.SetParam("size", "resizePostCrop", "%dx%d" % (int(gif.GetVideoWidth() * pct), int(gif.GetVideoHeight() * pct)))
 
-        for step, fn in [("Extracting frames", gif.ExtractFrames), ("Cropping and resizing", gif.CropAndResize)]:
+        # Nothing edits the crop afterwards, so let ffmpeg do it while extracting. A size budget
+        # resizes the frames over and over, so that has to start from the full frames
+        maxBytes = gif.GetGifSizeBudget()
+        for step, fn in [("Extracting frames", lambda: gif.ExtractFrames(cropAndResize=maxBytes == 0)), ("Cropping and resizing", gif.CropAndResize)]:
             print(step + ":")
             fn()
-        print("Generating GIF:")
-        gif.Generate(skipProcessing=True)
-        print("Output: " + gif.GetNextOutputPath())
+        if maxBytes > 0:
+            print("Generating GIF of up to %d kB (search trace in %s):" % (maxBytes // 1024, GetLogPath()))
+            gif.GenerateWithinBudget(maxBytes)
+        else:
+            print("Generating GIF:")
+            gif.Generate(skipProcessing=True)
+        print("Output: " + gif.GetLastGifOutputPath())
         return 0
 
 
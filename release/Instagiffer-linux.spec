@@ -24,6 +24,7 @@ p = lambda *parts: os.path.join(ROOT, *parts)
 datas = [
     (p("instagiffer.conf"), "."),
     (p("deps/linux/ffmpeg"), "deps/linux"),
+    (p("deps/linux/ffprobe"), "deps/linux"),
     (p("deps/linux/magick"), "deps/linux"),
     (p("deps/linux/yt-dlp"), "deps/linux"),
     (p("assets/logo.png"), "assets"),
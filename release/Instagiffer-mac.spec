@@ -25,6 +25,7 @@ datas = [
     (p("instagiffer.conf"), "."),
     (p("instagiffer.icns"), "."),
     (p("deps/mac/ffmpeg"), "deps/mac"),
+    (p("deps/mac/ffprobe"), "deps/mac"),
     (p("deps/mac/magick"), "deps/mac"),
     (p("deps/mac/yt-dlp"), "deps/mac"),
     (p("deps/mac/gifsicle"), "deps/mac"),
@@ -0,0 +1,332 @@
+"""
+Instagiffer Benchmarks — timings for the animation engine against the real ffmpeg/ImageMagick binaries.
+
+Tool paths come from instagiffer.conf, the same as the app. Run from the project directory.
+
+Usage:
+    python test/instagiffer_benchmark.py            # run every benchmark
+    python test/instagiffer_benchmark.py worker     # run the named benchmark(s)
+"""
+
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import PIL.Image
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+_PROJECT_DIR = str(Path(__file__).resolve().parent.parent)
+sys.path.insert(0, _PROJECT_DIR)
+
+import instagiffer  # pylint: disable=wrong-import-position
+
+
+def _conf():
+    os.chdir(_PROJECT_DIR)
+    return instagiffer.InstaConfig(os.path.join(_PROJECT_DIR, "instagiffer.conf"))
+
+
+def _make_frames(directory, count, size=(640, 360)):
+    """Write count distinct PNG frames to directory and return their paths."""
+    paths = []
+    for i in range(count):
+        img = PIL.Image.new("RGB", size, ((i * 7) % 256, (i * 13) % 256, (i * 29) % 256))
+        path = os.path.join(directory, "image%04d.png" % (i + 1))
+        img.save(path)
+        paths.append(path)
+    return paths
+
+
+def _make_video(conf, path, seconds, size="1920x1080"):
+    """Encode a synthetic test clip with ffmpeg."""
+    instagiffer.RunProcess('"%s" -f lavfi -i testsrc2=size=%s:rate=30 -t %d -pix_fmt yuv420p "%s"' % (conf.GetParam("paths", "ffmpeg"), size, seconds, path))
+
+
+def _open_gif(conf, video, workDir):
+    conf.SetParam("paths", "gifOutputPath", os.path.join(workDir, "out.gif"))
+    return instagiffer.AnimatedGif(conf, video, os.path.join(workDir, "work"), lambda *args: True, None)
+
+
+def _dir_bytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, f)) for f in os.listdir(directory))
+
+
+def _peak_memory(fn):
+    """Run fn() in a forked child. Returns its result and the peak resident memory in MB, of the child
+    itself and of the biggest process it started. Without fork and resource (Windows), fn() runs here
+    and the peaks are None."""
+    if resource is None:
+        return fn(), None
+
+    def child(results):
+        result = fn()
+        unit = 1 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS, kB on Linux
+        results.put((result, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 1e6, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * unit / 1e6)))
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    process = context.Process(target=child, args=(results,))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _report(name, rows):
+    print("\n" + name)
+    for label, value in rows:
+        print("  %-40s %s" % (label, value))
+
+
+def bench_worker(frames=60):
+    """Per-frame overhead: one magick process per frame vs. a persistent ImageMagick worker."""
+    convert = _conf().GetParam("paths", "convert")
+    workDir = tempfile.mkdtemp(prefix="instagiffer-bench-")
+
+    try:
+        inputs = _make_frames(workDir, frames)
+        cmds = ['"%s" "%s" -resize 320x180! "%s"' % (convert, f, f.replace("image", "out")) for f in inputs]
+
+        start = time.perf_counter()
+        for cmd in cmds:
+            instagiffer.RunProcess(cmd)
+        spawnSec = time.perf_counter() - start
+
+        pool = instagiffer.ImagemagickWorkerPool(convert, workDir)
+        pool.Run(cmds[0])  # Startup and protocol probe are paid once per session
+        start = time.perf_counter()
+        for cmd in cmds:
+            if pool.Run(cmd) is not True:
+                print("Persistent worker unavailable; nothing to compare")
+                return
+        workerSec = time.perf_counter() - start
+        pool.Shutdown()
+
+        _report(
+            "ImageMagick per-frame overhead (%d frames)" % frames,
+            [
+                ("spawn per frame", "%.1f ms/frame" % (spawnSec * 1000 / frames)),
+                ("persistent worker", "%.1f ms/frame" % (workerSec * 1000 / frames)),
+                ("speedup", "%.1fx" % (spawnSec / workerSec)),
+            ],
+        )
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def bench_effects(frames=60):
+    """Sepia, tint, vignette and blur: spawning magick per frame vs. the in-process Pillow engine."""
+    conf = _conf()
+    convert = conf.GetParam("paths", "convert")
+    workDir = tempfile.mkdtemp(prefix="instagiffer-bench-")
+
+    try:
+        inputs = _make_frames(workDir, frames)
+        cmds = [
+            '"%s" "%s" -sepia-tone 80%% -fill "#0000ff" -tint 70 -background black -vignette 40x2525-30-30 -blur 0x3 -depth 8 -colors 210 "%s"' % (convert, f, f.replace("image", "im")) for f in inputs
+        ]
+
+        start = time.perf_counter()
+        for cmd in cmds:
+            instagiffer.RunProcess(cmd)
+        magickSec = time.perf_counter() - start
+
+        for key, value in [
+            ("sharpen", "False"),
+            ("sepiaTone", "True"),
+            ("sepiaToneAmount", "20"),
+            ("colorTint", "True"),
+            ("colorTintAmount", "58"),
+            ("fadeEdges", "True"),
+            ("fadeEdgeAmount", "50"),
+            ("blur", "20"),
+        ]:
+            conf.SetParam("effects", key, value)
+        effects = instagiffer.PillowEffects(conf, True)
+
+        start = time.perf_counter()
+        for f in inputs:
+            effects.Apply(f, f.replace("image", "pil"))
+        pillowSec = time.perf_counter() - start
+
+        _report(
+            "Effects chain (%d frames)" % frames,
+            [
+                ("imagemagick", "%.1f ms/frame" % (magickSec * 1000 / frames)),
+                ("pillow", "%.1f ms/frame" % (pillowSec * 1000 / frames)),
+                ("speedup", "%.1fx" % (magickSec / pillowSec)),
+            ],
+        )
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def bench_extract(seconds=31):
+    """Frame extraction: ffmpeg writing PNGs vs. raw frames piped into the engine vs. one ffmpeg per CPU core."""
+    conf = _conf()
+    workDir = tempfile.mkdtemp(prefix="instagiffer-bench-")
+
+    try:
+        video = os.path.join(workDir, "clip.mp4")
+        _make_video(conf, video, seconds)
+        conf.SetParam("length", "startTime", "00:00:01.000")
+        conf.SetParam("length", "durationSec", str(seconds - 1))
+        conf.SetParam("rate", "frameRate", "15")
+        gif = _open_gif(conf, video, workDir)
+
+        rows = []
+        for label, streaming, segments in [("ffmpeg png", "False", "1"), ("pipe", "True", "1"), ("segments", "False", "0")]:
+            conf.SetParam("settings", "streamExtraction", streaming)
+            conf.SetParam("settings", "extractionSegments", segments)
+            if segments != "1":
+                label += " (%d)" % (gif.GetExtractionSegmentCount(seconds - 1))
+            start = time.perf_counter()
+            gif.ExtractFrames()
+            elapsed = time.perf_counter() - start
+            rows.append((label, "%.2f s, %d frames, %.1f MB" % (elapsed, gif.GetNumFrames(), _dir_bytes(gif.GetExtractedImagesDir()) / 1e6)))
+
+        gif.StopWorkers()
+        _report("Extract %d s of 1080p at 15 fps" % (seconds - 1), rows)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def bench_gif(seconds=20):
+    """Writing the GIF from the same processed frames: ImageMagick vs. the in-process encoder vs. ffmpeg palettegen/paletteuse."""
+    conf = _conf()
+    workDir = tempfile.mkdtemp(prefix="instagiffer-bench-")
+
+    try:
+        video = os.path.join(workDir, "clip.mp4")
+        _make_video(conf, video, seconds + 1, "640x360")
+        conf.SetParam("length", "startTime", "00:00:01.000")
+        conf.SetParam("length", "durationSec", str(seconds))
+        conf.SetParam("rate", "frameRate", "15")
+        conf.SetParam("size", "resizePostCrop", "480x270")
+        gif = _open_gif(conf, video, workDir)
+        gif.ExtractFrames()
+        gif.CropAndResize()
+        gif.ImageProcessing()
+        gif.StopWorkers()
+
+        def encode():
+            start = time.perf_counter()
+            size = gif.Generate()
+            return time.perf_counter() - start, size
+
+        rows = []
+        for encoder in ("imagemagick", "native", "ffmpeg"):
+            conf.SetParam("settings", "gifEncoder", encoder)
+            (elapsed, size), peaks = _peak_memory(encode)
+            memory = "peak %.0f MB in Python, %.0f MB in tools" % peaks if peaks else "peak memory not measured here"
+            rows.append((encoder, "%.2f s, %.0f kB, %s" % (elapsed, size / 1024.0, memory)))
+
+        _report("Write a GIF from %d processed 480x270 frames" % (gif.GetNumFrames()), rows)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def bench_subframes(frames=90, size=(480, 270)):
+    """Storing only what changed between frames: ImageMagick -layers optimizePlus vs. the in-process encoder with and without subframes."""
+    convert = _conf().GetParam("paths", "convert")
+    workDir = tempfile.mkdtemp(prefix="instagiffer-bench-")
+
+    try:
+        # A still background with a square moving across it, already down to the colors of a processed frame
+        background = PIL.Image.effect_noise(size, 40).convert("RGB")
+        inputs = []
+        for i in range(frames):
+            frame = background.copy()
+            x = i * (size[0] - 60) // frames
+            frame.paste((255, 0, 0), (x, size[1] // 2 - 30, x + 60, size[1] // 2 + 30))
+            path = os.path.join(workDir, "image%04d.png" % (i + 1))
+            frame.quantize(210).save(path)
+            inputs.append(path)
+
+        rows = []
+        gifFile = os.path.join(workDir, "magick.gif")
+        start = time.perf_counter()
+        instagiffer.RunProcess('"%s" -delay 7 "%s" -layers optimizePlus -loop 0 "%s"' % (convert, os.path.join(workDir, "image*.png"), gifFile))
+        rows.append(("imagemagick optimizePlus", "%.2f s, %.0f kB" % (time.perf_counter() - start, os.path.getsize(gifFile) / 1024.0)))
+
+        for optimize in (False, True):
+            gifFile = os.path.join(workDir, "native%s.gif" % optimize)
+            start = time.perf_counter()
+            encoder = instagiffer.GifEncoder(gifFile, size, 0, 210, optimize)
+            for path in inputs:
+                with PIL.Image.open(path) as img:
+                    encoder.AddFrame(img, 70)
+            encoder.Close()
+            rows.append(("native, " + ("subframes" if optimize else "full frames"), "%.2f s, %.0f kB" % (time.perf_counter() - start, os.path.getsize(gifFile) / 1024.0)))
+
+        _report("Write a GIF of %d %dx%d frames with a moving square" % (frames, size[0], size[1]), rows)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+def bench_preview(previews=10):
+    """Right-click preview latency: ImageMagick crop, resize and effects through preview.gif vs. rendering in memory with Pillow."""
+    conf = _conf()
+    workDir = tempfile.mkdtemp(prefix="instagiffer-bench-")
+
+    try:
+        video = os.path.join(workDir, "clip.mp4")
+        _make_video(conf, video, 3, "1280x720")
+        conf.SetParam("length", "startTime", "00:00:00.000")
+        conf.SetParam("length", "durationSec", "2")
+        for section, key, value in [
+            ("size", "cropOffsetX", "160"),
+            ("size", "cropOffsetY", "90"),
+            ("size", "cropWidth", "960"),
+            ("size", "cropHeight", "540"),
+            ("size", "resizePostCrop", "480x270"),
+            ("effects", "sharpenAmount", "50"),
+            ("effects", "sepiaTone", "True"),
+            ("effects", "fadeEdges", "True"),
+            ("effects", "fadeEdgeAmount", "50"),
+        ]:
+            conf.SetParam(section, key, value)
+        gif = _open_gif(conf, video, workDir)
+        gif.ExtractFrames()
+
+        rows = []
+        for label, render in [("imagemagick", gif.GenerateFramePreview), ("pillow, in memory", gif.RenderFramePreview)]:
+            timings = []
+            for i in range(previews):
+                start = time.perf_counter()
+                render(1 + i * gif.GetNumFrames() // previews)
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            rows.append((label, "%.0f ms median, %.0f ms worst" % (timings[len(timings) // 2] * 1000, timings[-1] * 1000)))
+
+        gif.StopWorkers()
+        _report("Preview a 1280x720 frame cropped and resized to 480x270, with sharpen, sepia and vignette", rows)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+BENCHMARKS = {
+    "worker": bench_worker,
+    "effects": bench_effects,
+    "extract": bench_extract,
+    "gif": bench_gif,
+    "subframes": bench_subframes,
+    "preview": bench_preview,
+}
+
+
+def main(names):
+    for name in names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -10,12 +10,19 @@ Usage:
     python -m pytest test/ -v --app dist/Instagiffer/Instagiffer.exe  # Windows frozen app
 """
 
+import math
 import os
+import shutil
 import sys
 import time
+import types
 import pytest
+import PIL.Image
+from PIL import ImageChops, ImageStat
 from instagiffer_automation import InstagifferAutomator
+import instagiffer
 
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 TEST_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_data")
 TEST_VIDEOS = sorted(os.path.join(TEST_DIR, f) for f in os.listdir(TEST_DIR)) if os.path.isdir(TEST_DIR) else []
 
@@ -30,6 +37,22 @@ requires_test_video = pytest.mark.skipif(
 )
 
 
+def _conf_tool(name):
+    """The path instagiffer.conf gives for a tool under [paths], resolved from the project directory, or None if it isn't there."""
+    path = instagiffer.InstaConfig(os.path.join(PROJECT_DIR, "instagiffer.conf")).GetParam("paths", name)
+    if not path:
+        return None
+    if os.sep in path or (os.altsep and os.altsep in path):
+        path = os.path.normpath(os.path.join(PROJECT_DIR, path))
+        return path if os.path.exists(path) else None
+    return shutil.which(path)
+
+
+requires_tools = pytest.mark.skipif(not (_conf_tool("ffmpeg") and _conf_tool("convert")), reason="ffmpeg/ImageMagick not found — run: make init")
+requires_ffprobe = pytest.mark.skipif(_conf_tool("ffprobe") is None, reason="ffprobe not found — run: make init")
+requires_gifsicle = pytest.mark.skipif(_conf_tool("gifsicle") is None, reason="gifsicle not found — run: make init")
+
+
 # Helpers
 
 
@@ -39,6 +62,19 @@ def gif_path_from_status(status):
     return status.split("Path:", 1)[1].strip()
 
 
+def psnr(path_a, path_b):
+    """Peak signal-to-noise ratio between two images, in dB."""
+    with PIL.Image.open(path_a) as a, PIL.Image.open(path_b) as b:
+        return psnr_images(a, b)
+
+
+def psnr_images(a, b):
+    """psnr() for images that are already open."""
+    assert a.size == b.size, f"{a.size} != {b.size}"
+    mse = sum(ImageStat.Stat(ImageChops.difference(a.convert("RGB"), b.convert("RGB"))).sum2) / (3.0 * a.size[0] * a.size[1])
+    return float("inf") if mse == 0 else 10 * math.log10(255.0**2 / mse)
+
+
 def assert_valid_gif(path):
     """Assert the file at path exists, was recently created, and has valid GIF magic bytes."""
     assert os.path.isfile(path), f"GIF not found at {path}"
@@ -49,6 +85,29 @@ def assert_valid_gif(path):
     assert magic == b"GIF89a", f"Not a valid GIF file (magic: {magic!r})"
 
 
+@pytest.fixture(name="conf")
+def conf_fixture(tmp_path, monkeypatch):
+    """A fresh instagiffer.conf that writes its GIF to tmp_path. Runs from the project directory, which the tool paths in it are relative to."""
+    monkeypatch.chdir(PROJECT_DIR)
+    conf = instagiffer.InstaConfig(os.path.join(PROJECT_DIR, "instagiffer.conf"))
+    conf.SetParam("paths", "gifOutputPath", str(tmp_path / "out.gif"))
+    return conf
+
+
+@pytest.fixture(name="make_test_video")
+def make_test_video_fixture(tmp_path, conf):
+    """Renders an ffmpeg testsrc2 clip to tmp_path/video.mp4 and returns its path. gop is the keyframe interval in frames, and filters go on after the source."""
+
+    def make(size="320x240", rate=30, seconds=1, gop=None, filters=None):
+        video = tmp_path / "video.mp4"
+        source = f"testsrc2=size={size}:rate={rate}:duration={seconds}" + (f",{filters}" if filters else "")
+        keyframes = f"-g {gop} " if gop else ""
+        assert instagiffer.RunProcess(f'"{conf.GetParam("paths", "ffmpeg")}" -f lavfi -i {source} {keyframes}-pix_fmt yuv420p "{video}"')
+        return video
+
+    return make
+
+
 # GUI tests
 
 
@@ -99,3 +158,963 @@ def disabled_test_cli_creates_gif(video):
     result = InstagifferAutomator.run_cli(video, output_gif)
     assert result.returncode == 0, f"CLI exited with {result.returncode}\nstderr: {result.stderr}"
     assert_valid_gif(output_gif)
+
+
+# Engine tests
+
+
+def test_run_process_wakes_on_exit(monkeypatch):
+    """RunProcess returns as soon as the process exits instead of waiting out a polling interval."""
+    monkeypatch.setattr(instagiffer, "PROCESS_IDLE_TICK_SEC", 30)
+    start = time.time()
+    stdout, stderr = instagiffer.RunProcess(f'"{sys.executable}" -c "import sys; print(1); sys.stderr.write(\'2\')"', returnOutput=True)
+    assert time.time() - start < 10
+    assert stdout.strip() == "1"
+    assert stderr.strip() == "2"
+
+
+def test_run_process_returns_when_process_exits_before_its_pipes_close():
+    """A process that leaves a child running with its stdout and stderr doesn't keep RunProcess waiting for the child."""
+    start = time.time()
+    stdout, _stderr = instagiffer.RunProcess(
+        f"\"{sys.executable}\" -c \"import subprocess, sys; subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(20)']); print(1)\"", returnOutput=True
+    )
+    assert time.time() - start < 10
+    assert stdout.strip() == "1"
+
+
+def test_run_process_abort():
+    """A callback returning False kills the process; the callback is then finalized with True."""
+    calls = []
+
+    def callback(done, status=None):
+        calls.append(done)
+        return done is True
+
+    start = time.time()
+    success = instagiffer.RunProcess(f'"{sys.executable}" -c "import time; time.sleep(30)"', callback)
+    assert not success
+    assert time.time() - start < 10
+    assert calls[-1] is True
+
+
+def test_split_command_line_keeps_windows_paths(monkeypatch):
+    """On Windows, command lines are split on quotes and spaces only, so backslashes in local and UNC paths survive."""
+    monkeypatch.setattr(instagiffer, "ImAPC", lambda: True)
+    cmd = r'"C:\Program Files\magick.exe" -comment "Crop and Resize:50" "C:\in.png" -fill "#0000ff" ( -clone 0 ) "\\server\share\out.png"'
+    assert instagiffer.SplitCommandLine(cmd) == [
+        r"C:\Program Files\magick.exe",
+        "-comment",
+        "Crop and Resize:50",
+        r"C:\in.png",
+        "-fill",
+        "#0000ff",
+        "(",
+        "-clone",
+        "0",
+        ")",
+        r"\\server\share\out.png",
+    ]
+
+
+@pytest.mark.skipif(sys.platform == "win32", reason="Uses a shell script as a stand-in for ImageMagick")
+def test_imagemagick_job_falls_back_to_run_process(tmp_path, monkeypatch):
+    """A convert that doesn't answer the worker protocol disables the pool, and frame jobs are spawned with RunProcess instead, held to one thread each."""
+    monkeypatch.delenv("MAGICK_THREAD_LIMIT", raising=False)
+    fakeConvert = tmp_path / "magick"
+    fakeConvert.write_text("#!/bin/sh\nexit 0\n")
+    fakeConvert.chmod(0o755)
+    pool = instagiffer.ImagemagickWorkerPool(str(fakeConvert), str(tmp_path))
+
+    out = tmp_path / "out.txt"
+    cmd = f"\"{sys.executable}\" -c \"import os, sys; open(sys.argv[1], 'w').write(os.environ.get('MAGICK_THREAD_LIMIT', '-'))\" \"{out}\""
+    assert pool.Run(cmd) is None
+    assert pool.disabled
+
+    gif = types.SimpleNamespace(magickWorkers=pool, GetFrameWorkerCount=lambda: 4)
+    gif.GetImagemagickEnv = types.MethodType(instagiffer.AnimatedGif.GetImagemagickEnv, gif)
+    assert instagiffer.AnimatedGif.RunImagemagickJob(gif, cmd, lambda *args: True) is True
+    assert out.read_text() == "1"
+
+    gif.GetFrameWorkerCount = lambda: 1
+    assert instagiffer.AnimatedGif.RunImagemagickJob(gif, cmd, lambda *args: True) is True
+    assert out.read_text() == "-"
+
+
+def test_imagemagick_worker_needs_new_output(tmp_path):
+    """A worker that finishes a command without an error message but leaves the output file as it was is not trusted with the frame."""
+    fakeMagick = tmp_path / "magick"
+    fakeMagick.write_text(
+        f"#!{sys.executable}\n"
+        "import shlex, sys\n"
+        "for line in sys.stdin:\n"
+        "    tokens = shlex.split(line)\n"
+        "    if '-write' not in tokens:\n"
+        "        continue\n"
+        "    outputFileName = tokens[tokens.index('-write') + 1]\n"
+        "    if '-verbose' in tokens:\n"
+        "        print(outputFileName, flush=True)\n"
+        "    elif 'stale' not in outputFileName:\n"
+        "        open(outputFileName, 'w').write('new')\n"
+    )
+    fakeMagick.chmod(0o755)
+    pool = instagiffer.ImagemagickWorkerPool(str(fakeMagick), str(tmp_path))
+
+    for name in ("fresh.png", "stale.png"):
+        (tmp_path / name).write_text("old")
+
+    assert pool.Run(f'"{fakeMagick}" xc:red "{tmp_path / "fresh.png"}"') is True
+    assert (tmp_path / "fresh.png").read_text() == "new"
+    assert pool.Run(f'"{fakeMagick}" xc:red "{tmp_path / "stale.png"}"') is None
+    assert not pool.disabled
+    pool.Shutdown()
+
+
+def frame_batch_runner(workerCount, callback):
+    """Just enough of an AnimatedGif to call RunFrameBatch on."""
+    return types.SimpleNamespace(GetFrameWorkerCount=lambda: workerCount, callback=callback)
+
+
+def test_run_frame_batch_reports_progress_in_frame_order():
+    """Frames finishing out of order on several workers are only counted once every frame before them is done."""
+    progress = []
+    finished = []
+
+    def job(idx):
+        def Run(_keepGoing):
+            time.sleep(0.2 if idx == 0 else 0.01)
+            finished.append(idx)
+            return True
+
+        return Run
+
+    runner = frame_batch_runner(4, lambda percent, status: progress.append((percent, 0 in finished)))
+    assert instagiffer.AnimatedGif.RunFrameBatch(runner, [job(idx) for idx in range(8)], "Testing")
+    assert finished[0] != 0
+    assert [percent for percent, _firstDone in progress] == sorted(percent for percent, _firstDone in progress)
+    assert progress[-1] == (100, True)
+    assert all(percent == 0 for percent, firstDone in progress if not firstDone)
+
+
+def test_run_frame_batch_stops_when_the_callback_cancels():
+    """Returning False from the callback stops the jobs in flight and no new frames are started."""
+    started = []
+
+    def job(idx):
+        def Run(keepGoing):
+            started.append(idx)
+            while keepGoing():
+                time.sleep(0.01)
+            return False
+
+        return Run
+
+    start = time.time()
+    runner = frame_batch_runner(2, lambda percent, status: False)
+    assert not instagiffer.AnimatedGif.RunFrameBatch(runner, [job(idx) for idx in range(20)], "Testing")
+    assert time.time() - start < 10
+    assert len(started) <= 2
+
+
+@requires_tools
+def test_imagemagick_worker_protocol(tmp_path, conf):
+    """A persistent worker reports each command done at its sentinel, gives up on commands that print an ImageMagick error, and stops when the callback says so."""
+    convert = conf.GetParam("paths", "convert")
+    pool = instagiffer.ImagemagickWorkerPool(convert, str(tmp_path))
+
+    assert pool.Run(f'"{convert}" -size 32x24 xc:red "{tmp_path / "red.png"}"') is True
+    with PIL.Image.open(tmp_path / "red.png") as img:
+        assert (img.size, img.convert("RGB").getpixel((0, 0))) == ((32, 24), (255, 0, 0))
+    assert len(pool.idleWorkers) == 1
+
+    # The caller runs it again with RunProcess, which reports the error properly
+    assert pool.Run(f'"{convert}" "{tmp_path / "missing.png"}" -negate "{tmp_path / "out.png"}"') is None
+    assert not os.path.exists(tmp_path / "out.png")
+    assert len(pool.idleWorkers) == 0
+
+    assert pool.Run(f'"{convert}" -size 4000x4000 plasma: -blur 0x20 "{tmp_path / "slow.png"}"', lambda *args: False) is False
+    assert pool.Run(f'"{convert}" -size 32x24 xc:blue "{tmp_path / "blue.png"}"') is True
+    assert not pool.disabled
+    pool.Shutdown()
+
+
+def test_frame_store_tracks_directory(tmp_path):
+    """FrameStore lists frames like a sorted glob, and notices frames added behind its back once the directory has settled."""
+    for name in ("image0002.png", "image0001.png", ".hidden", "notes.txt"):
+        (tmp_path / name).write_bytes(b"x")
+    old = time.time() - 60
+    for f in tmp_path.iterdir():
+        os.utime(f, (old, old))
+    os.utime(tmp_path, (old, old))
+
+    store = instagiffer.FrameStore(str(tmp_path), ".png")
+    assert store.GetList() == [str(tmp_path / "image0001.png"), str(tmp_path / "image0002.png")]
+    assert store.GetLastModifiedTs() == old
+
+    (tmp_path / "image0003.png").write_bytes(b"x")
+    assert store.Count() == 3
+
+    # Rewriting a frame in place leaves the directory alone; Invalidate picks it up
+    os.utime(tmp_path, (old, old))
+    assert store.Count() == 3
+    os.utime(tmp_path / "image0001.png", (old + 30, old + 30))
+    os.utime(tmp_path / "image0003.png", (old, old))
+    store.Invalidate()
+    assert store.GetLastModifiedTs() == old + 30
+
+    empty = instagiffer.FrameStore(str(tmp_path / "missing"))
+    assert not empty.Exists()
+    assert empty.GetLastModifiedTs() == 0
+
+
+def test_frame_cache_keys_and_eviction(tmp_path):
+    """FrameCache entries are keyed on file contents rather than names, and the least recently used ones go first."""
+    frame, mask, out = tmp_path / "frame.png", tmp_path / "mask.png", tmp_path / "out.png"
+    frame.write_bytes(b"frame")
+    mask.write_bytes(b"mask")
+    cache = instagiffer.FrameCache(str(tmp_path / "cache"), 10)
+
+    def cmd(effect):
+        return f'"convert" -comment "Progress:{effect}" "{frame}" ( "{mask}" ) {effect} "{out}"'
+
+    entry = cache.GetEntryName(str(frame), str(out), cmd("-sepia-tone 80%"))
+    assert not cache.Fetch(entry, str(out))
+    out.write_bytes(b"sepia")
+    cache.Store(entry, str(out))
+
+    out.write_bytes(b"")
+    assert cache.Fetch(cache.GetEntryName(str(frame), str(out), cmd("-sepia-tone 80%")), str(out))
+    assert out.read_bytes() == b"sepia"
+    assert cache.GetEntryName(str(frame), str(out), cmd("-blur 0x3")) != entry
+
+    mask.write_bytes(b"new mask")
+    assert cache.GetEntryName(str(frame), str(out), cmd("-sepia-tone 80%")) != entry
+
+    cache.Store("other.png", str(out))
+    cache.Store("newest.png", str(out))
+    assert not os.path.exists(cache.directory + os.sep + entry)
+    assert cache.GetStats() == (1, 1)
+
+
+def test_gif_encoder_writes_frames_exactly(tmp_path):
+    """GifEncoder keeps frames that already fit in a color table exactly, quantizes the rest, and writes the delays and loop count given."""
+    frames = [PIL.Image.effect_noise((120, 80), 30 + i * 10).convert("RGB").quantize(40 + i * 60) for i in range(3)]
+    frames[1] = frames[1].convert("RGB")
+    frames.append(PIL.Image.merge("RGB", [PIL.Image.linear_gradient("L").resize((120, 80)), PIL.Image.radial_gradient("L").resize((120, 80)), PIL.Image.new("L", (120, 80))]))
+
+    encoder = instagiffer.GifEncoder(str(tmp_path / "out.gif"), (120, 80), 3, 210)
+    for i, frame in enumerate(frames):
+        encoder.AddFrame(frame, 100 + i * 20)
+    encoder.Close()
+
+    with PIL.Image.open(tmp_path / "out.gif") as gif:
+        assert gif.n_frames == len(frames)
+        assert gif.info["loop"] == 3
+        for i, frame in enumerate(frames):
+            gif.seek(i)
+            assert gif.info["duration"] == 100 + i * 20
+            if i < 3:
+                assert ImageChops.difference(gif.convert("RGB"), frame.convert("RGB")).getbbox() is None, f"frame {i} differs"
+            else:
+                assert len(gif.convert("RGB").getcolors(256)) <= 210
+                assert psnr_images(gif, frame) > 30
+
+
+def test_gif_encoder_stores_only_changed_regions(tmp_path):
+    """With optimize, frames after the first only store what changed, unchanged frames lengthen the one before, and the GIF plays back the same."""
+    background = PIL.Image.effect_noise((160, 120), 40).convert("RGB").quantize(64).convert("RGB")
+    frames = []
+    for i in range(6):
+        frame = background.copy()
+        frame.paste((255, 0, 0), (10 + i * 15, 40, 40 + i * 15, 70))
+        frames.append(frame)
+    frames.insert(3, frames[2].copy())
+    delays = [100, 120, 140, 160, 180, 200, 220]
+
+    for optimize in (False, True):
+        encoder = instagiffer.GifEncoder(str(tmp_path / f"out{optimize}.gif"), (160, 120), 0, 210, optimize)
+        for frame, delay in zip(frames, delays):
+            encoder.AddFrame(frame, delay)
+        encoder.Close()
+
+    with PIL.Image.open(tmp_path / "outTrue.gif") as gif:
+        assert gif.n_frames == len(frames) - 1
+        for i, src in enumerate([0, 1, 2, 4, 5, 6]):
+            gif.seek(i)
+            assert gif.info["duration"] == (delays[2] + delays[3] if src == 2 else delays[src])
+            if i > 0:
+                # The square in the frame before and where it is now
+                x = 10 + (src - 1 if src < 4 else src - 2) * 15
+                assert gif.dispose_extent == (x, 40, x + 45, 70)
+            assert ImageChops.difference(gif.convert("RGB"), frames[src]).getbbox() is None, f"frame {i} differs"
+
+    assert os.path.getsize(tmp_path / "outTrue.gif") < os.path.getsize(tmp_path / "outFalse.gif") / 3
+
+
+def test_set_gif_frame_delays_only_touches_delays(tmp_path):
+    """SetGifFrameDelays changes just the delay bytes when every frame has a graphic control extension, adds one where a frame has none, and reports frames the GIF doesn't have."""
+    frames = [PIL.Image.effect_noise((64, 48), 20 + i * 5).convert("RGB") for i in range(5)]
+    frames[0].save(tmp_path / "timed.gif", save_all=True, append_images=frames[1:], duration=100, loop=0)
+    frames[0].save(tmp_path / "untimed.gif", save_all=True, append_images=frames[1:], loop=0)
+
+    before = (tmp_path / "timed.gif").read_bytes()
+    assert instagiffer.SetGifFrameDelays(str(tmp_path / "timed.gif"), {1: 25, 4: 300, 7: 10}) == [7]
+    after = (tmp_path / "timed.gif").read_bytes()
+    assert len(after) == len(before) and sum(a != b for a, b in zip(before, after)) == 3
+
+    assert instagiffer.SetGifFrameDelays(str(tmp_path / "untimed.gif"), {0: 7, 3: 50}) == []
+
+    for name, delays in [("timed.gif", [100, 250, 100, 100, 3000]), ("untimed.gif", [70, 0, 0, 500, 0])]:
+        with PIL.Image.open(tmp_path / name) as gif:
+            for i, frame in enumerate(frames):
+                gif.seek(i)
+                assert gif.info.get("duration", 0) == delays[i]
+                assert ImageChops.difference(gif.convert("RGB"), frame).getbbox() is None
+
+
+PILLOW_EFFECTS = {
+    "brightness-contrast": {("effects", "brightness"): "30", ("effects", "contrast"): "30"},
+    "sharpen": {("effects", "sharpen"): "True", ("effects", "sharpenAmount"): "50"},
+    "saturation": {("color", "saturation"): "-60"},
+    "sepia": {("effects", "sepiaTone"): "True", ("effects", "sepiaToneAmount"): "80"},
+    "tint": {("effects", "colorTint"): "True", ("effects", "colorTintAmount"): "70", ("effects", "colorTintColor"): "#0000ff"},
+    "vignette": {("effects", "fadeEdges"): "True", ("effects", "fadeEdgeAmount"): "50"},
+    "blur": {("effects", "blur"): "30"},
+    "border": {("effects", "border"): "True", ("effects", "borderAmount"): "20", ("effects", "borderColor"): "#ff0000"},
+    "grayscale": {("color", "colorSpace"): "Gray"},
+}
+
+
+@requires_tools
+@pytest.mark.parametrize("effect", PILLOW_EFFECTS)
+def test_pillow_effects_match_imagemagick(effect, tmp_path, conf):
+    """effectsEngine=pillow renders each supported effect close enough to ImageMagick to mix frames in one GIF."""
+    frame = tmp_path / "frame.png"
+    gradient = PIL.Image.linear_gradient("L").resize((160, 120))
+    PIL.Image.merge("RGB", (gradient, gradient.rotate(90), PIL.Image.radial_gradient("L").resize((160, 120)))).save(frame)
+
+    conf.SetParam("size", "resizePostCrop", "160x120")
+    conf.SetParam("effects", "brightness", "0")
+    conf.SetParam("effects", "sharpen", "False")
+    conf.SetParam("color", "numColors", "255")
+    for (section, key), value in PILLOW_EFFECTS[effect].items():
+        conf.SetParam(section, key, value)
+
+    gif = instagiffer.AnimatedGif(conf, str(frame), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+    gif.CropAndResize()
+
+    rendered = {}
+    for engine in ("imagemagick", "pillow"):
+        conf.SetParam("settings", "effectsEngine", engine)
+        assert gif.ImageProcessing()
+        rendered[engine] = tmp_path / f"{engine}.png"
+        os.replace(gif.GetProcessedImageList()[0], rendered[engine])
+    gif.StopWorkers()
+
+    assert psnr(rendered["imagemagick"], rendered["pillow"]) > 25
+
+
+@requires_tools
+def test_extract_frames_crop_and_resize(tmp_path, conf, make_test_video):
+    """ExtractFrames(cropAndResize=True) writes final-size frames, which CropAndResize then passes straight through."""
+    video = make_test_video(size="640x360", seconds=2)
+
+    conf.SetParam("size", "cropEnabled", "True")
+    conf.SetParam("size", "cropOffsetX", "40")
+    conf.SetParam("size", "cropOffsetY", "20")
+    conf.SetParam("size", "cropWidth", "320")
+    conf.SetParam("size", "cropHeight", "240")
+    conf.SetParam("size", "resizePostCrop", "160x120")
+
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames(cropAndResize=True)
+    frames = gif.GetExtractedImageList()
+    assert frames
+    with PIL.Image.open(frames[0]) as img:
+        assert img.size == (160, 120)
+
+    assert gif.CropAndResize()
+    assert [os.path.basename(f) for f in gif.GetResizedImageList()] == [os.path.basename(f) for f in frames]
+
+    # Redoing one frame leaves the others alone. Resized frames are links to the extracted ones, so
+    # they are replaced rather than written over
+    resized = gif.GetResizedImageList()
+    for idx, color in ((0, "blue"), (1, "red")):
+        os.remove(resized[idx])
+        PIL.Image.new("RGB", (160, 120), color).save(resized[idx])
+    gif.InvalidateFrameStores()
+    assert gif.CropAndResize(0)
+    resized = gif.GetResizedImageList()
+    assert len(resized) == len(frames)
+    assert psnr(resized[0], frames[0]) == float("inf")
+    with PIL.Image.open(resized[1]) as img:
+        assert img.convert("RGB").getpixel((0, 0)) == (255, 0, 0)
+
+    # A crop change afterwards needs full size frames again
+    conf.SetParam("size", "cropWidth", "300")
+    assert gif.CropAndResize()
+    with PIL.Image.open(gif.GetExtractedImageList()[0]) as img:
+        assert img.size == (640, 360)
+    gif.StopWorkers()
+
+
+@requires_tools
+@pytest.mark.parametrize("streaming", ["False", "True"])
+def test_extract_frames_publishes_frames_in_order(tmp_path, conf, make_test_video, streaming):
+    """Frame listeners hear about every extracted frame in order, and original/ never holds frames past the last one announced."""
+    video = make_test_video(seconds=3)
+
+    conf.SetParam("settings", "streamExtraction", streaming)
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+
+    published = []
+    onDisk = []
+
+    def OnFrame(fileName):
+        published.append(fileName)
+        with PIL.Image.open(fileName) as img:
+            img.load()
+        onDisk.append(gif.GetExtractedImageList())
+
+    gif.AddFrameListener(OnFrame)
+    gif.ExtractFrames()
+    gif.StopWorkers()
+
+    assert published and published == gif.GetExtractedImageList()
+    if streaming == "True":
+        assert onDisk == [published[: i + 1] for i in range(len(published))]
+
+
+@requires_tools
+def test_streamed_frames_match_ffmpeg_png_output(tmp_path, conf, make_test_video):
+    """Frames saved from ffmpeg's rawvideo stream are pixel for pixel the ones ffmpeg writes as PNG files itself."""
+    video = make_test_video(seconds=4)
+
+    conf.SetParam("length", "startTime", "00:00:01.0")
+    conf.SetParam("length", "durationSec", "2.0")
+
+    extracted = {}
+    for streaming in ("True", "False"):
+        conf.SetParam("settings", "streamExtraction", streaming)
+        gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / ("work" + streaming)), lambda *args: True, None)
+        gif.ExtractFrames()
+        extracted[streaming] = gif.GetExtractedImageList()
+        gif.StopWorkers()
+
+    assert len(extracted["True"]) == len(extracted["False"]) > 0
+    for streamed, written in zip(extracted["True"], extracted["False"]):
+        with PIL.Image.open(streamed) as a, PIL.Image.open(written) as b:
+            assert a.size == b.size
+            assert ImageChops.difference(a.convert("RGB"), b.convert("RGB")).getbbox() is None, f"{os.path.basename(streamed)} differs"
+
+
+@requires_tools
+def test_extract_frames_in_segments_matches_one_ffmpeg(tmp_path, monkeypatch, conf, make_test_video):
+    """Extracting a long clip in segments gives the same frames, numbered the same way, as extracting it in one go."""
+    # A keyframe every second, so that 5 second segments are allowed
+    video = make_test_video(size="160x120", rate=25, seconds=20, gop=25)
+
+    conf.SetParam("settings", "streamExtraction", "False")
+    conf.SetParam("length", "startTime", "00:00:02.450")
+    conf.SetParam("length", "durationSec", "15.0")
+    conf.SetParam("rate", "frameRate", "15")
+
+    def one_frame_short(getSeekArgs):
+        def GetSeekArgs(startTimeStr, durationSec, *args):
+            return tuple(arg.replace("trim=end_frame=75,", "trim=end_frame=74,") for arg in getSeekArgs(startTimeStr, durationSec, *args))
+
+        return GetSeekArgs
+
+    frames = {}
+    for segments in ("1", "3", "3-short"):
+        conf.SetParam("settings", "extractionSegments", segments[0])
+        gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / f"work{segments}"), lambda *args: True, None)
+        assert gif.GetExtractionSegmentCount(15.0) == int(segments[0])
+
+        # A segment that comes out a frame short means extracting the clip again with one ffmpeg
+        if segments == "3-short":
+            monkeypatch.setattr(gif, "GetSeekArgs", one_frame_short(gif.GetSeekArgs))
+
+        gif.ExtractFrames()
+        frames[segments] = gif.GetExtractedImageList()
+        gif.StopWorkers()
+
+    assert len(frames["1"]) == 225
+    assert [os.path.basename(f) for f in frames["3"]] == [os.path.basename(f) for f in frames["1"]]
+    assert [os.path.basename(f) for f in frames["3-short"]] == [os.path.basename(f) for f in frames["1"]]
+    for got, want in zip(frames["3"] + frames["3-short"], frames["1"] * 2):
+        with PIL.Image.open(got) as a, PIL.Image.open(want) as b:
+            assert ImageChops.difference(a.convert("RGB"), b.convert("RGB")).getbbox() is None, f"{os.path.basename(got)} differs"
+
+
+@requires_tools
+@pytest.mark.parametrize("threshold,groups", [("0", [[1, 2, 4], [5, 6]]), ("6", [[1, 2, 3, 4], [5, 6]])])
+def test_check_duplicates_groups_near_identical_frames(tmp_path, conf, make_test_video, threshold, groups):
+    """With a threshold, frames that differ by noise are duplicates of the frame that started their run; a small moved square isn't."""
+    video = make_test_video(rate=10)
+
+    conf.SetParam("settings", "duplicateFrameThreshold", threshold)
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+    for f in gif.GetExtractedImageList():
+        os.remove(f)
+
+    still = PIL.Image.effect_noise((320, 240), 10).convert("RGB")
+    noisy = ImageChops.add(still, PIL.Image.effect_noise((320, 240), 3).convert("RGB"), 1.0, -128)
+    square = still.copy()
+    square.paste((255, 255, 255), (100, 100, 112, 112))
+    moved = still.copy()
+    moved.paste((255, 255, 255), (140, 100, 152, 112))
+    for i, img in enumerate([still, still, noisy, still, square, square, moved], 1):
+        img.save(os.path.join(gif.GetExtractedImagesDir(), "image%04d.png" % i))
+    os.utime(gif.GetExtractedImagesDir())
+    gif.InvalidateFrameStores()
+
+    culled = sum(len(group) - 1 for group in groups)
+    assert gif.CheckDuplicates(cull=True) == culled
+    assert gif.duplicateGroups == groups
+    assert gif.GetNumFrames() == 7 - culled
+    gif.StopWorkers()
+
+
+@requires_tools
+def test_decimated_extraction_holds_frames_for_the_dropped_time(tmp_path, conf, make_test_video):
+    """decimateFrames leaves a freeze as one frame, held for as long as the frames ffmpeg dropped would have lasted."""
+    # Frame 120 (4 s in) stays up for 2 more seconds
+    video = make_test_video(size="160x120", seconds=8, filters="loop=loop=60:size=1:start=120,setpts=N/30/TB")
+
+    conf.SetParam("length", "startTime", "00:00:03.000")
+    conf.SetParam("length", "durationSec", "5.0")
+    conf.SetParam("rate", "customFrameTimingMs", "0:500")
+
+    frames = {}
+    for decimate in ("False", "True"):
+        conf.SetParam("settings", "decimateFrames", decimate)
+        gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / f"work{decimate}"), lambda *args: True, None)
+        gif.ExtractFrames()
+        frames[decimate] = gif.GetExtractedImageList()
+
+    holds = gif.frameHolds
+    assert len(holds) == len(frames["True"]) < len(frames["False"])
+    assert max(holds) >= 20
+    assert sum(holds) == pytest.approx(len(frames["False"]), abs=2)
+
+    # Each kept frame is the frame that would have been extracted at that point
+    keptAt = [sum(holds[:i]) for i in range(len(holds))]
+    for got, idx in zip(frames["True"], keptAt):
+        with PIL.Image.open(got) as a, PIL.Image.open(frames["False"][idx]) as b:
+            assert ImageChops.difference(a.convert("RGB"), b.convert("RGB")).getbbox() is None, f"{os.path.basename(got)} differs"
+
+    timings = gif.GetFrameTimingsMs()
+    held = holds.index(max(holds))
+    assert timings[held] == max(holds) * gif.GetGifFrameDelay() * 10
+    assert timings[0] == 500
+
+    # Culling a duplicate afterwards gives its time to the kept frame before it, not to the frame it
+    # duplicates further back
+    holds = list(holds)
+    shutil.copyfile(frames["True"][0], frames["True"][3])
+    conf.SetParam("settings", "duplicateFrameThreshold", "0")
+    gif.InvalidateFrameStores()
+    assert gif.CheckDuplicates(True) == 1
+    assert gif.duplicateGroups == [[1, 4]]
+    assert gif.frameHolds == holds[:2] + [holds[2] + holds[3]] + holds[4:]
+    assert len(gif.GetExtractedImageList()) == len(holds) - 1
+    gif.StopWorkers()
+
+
+@requires_tools
+def test_ffmpeg_gif_encoder_keeps_frame_timings(tmp_path, monkeypatch, conf, make_test_video):
+    """The ffmpeg palettegen/paletteuse encoder writes every frame with its own delay, custom timings included, and the loop count."""
+    video = make_test_video(size="160x120", seconds=2)
+
+    conf.SetParam("rate", "frameRate", "10")
+    conf.SetParam("rate", "numLoops", "3")
+    conf.SetParam("rate", "customFrameTimingMs", "1:750")
+
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+    monkeypatch.setattr(gif, "GetProcessedImageList", gif.GetExtractedImageList)
+    assert gif.EncodeGifWithFfmpeg(str(tmp_path / "out.gif"))
+
+    frames = gif.GetExtractedImageList()
+    with PIL.Image.open(tmp_path / "out.gif") as out:
+        assert out.n_frames == len(frames)
+        assert out.info["loop"] == 3
+        delays = []
+        for i, frame in enumerate(frames):
+            out.seek(i)
+            delays.append(out.info["duration"])
+            with PIL.Image.open(frame) as want:
+                assert psnr_images(out, want) > 25
+    assert delays == [100, 750] + [100] * (len(frames) - 2)
+    gif.StopWorkers()
+
+
+@requires_tools
+def test_alter_gif_frame_timing_matches_imagemagick(tmp_path, conf, make_test_video):
+    """Patching the delays in place gives the same frames and timings as running the GIF back through ImageMagick with clone and swap."""
+    convert = conf.GetParam("paths", "convert")
+    video = make_test_video(size="160x120", seconds=2)
+
+    conf.SetParam("rate", "frameRate", "10")
+    conf.SetParam("rate", "customFrameTimingMs", "0:500,3:1230,12:40")
+
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+    frames = " ".join(f'"{f}"' for f in gif.GetExtractedImageList())
+    assert instagiffer.RunProcess(f'"{convert}" -delay 10 -loop 0 {frames} -layers optimizePlus "{tmp_path / "patched.gif"}"')
+
+    # What AlterGifFrameTiming used to run
+    cmd = f'"{convert}" "{tmp_path / "patched.gif"}" '
+    for frameIdx, frameMs in sorted(gif.GetFrameTimingsMs().items()):
+        cmd += " ( -clone %d -set delay %d ) -swap %d,-1 +delete " % (frameIdx, frameMs / 10, frameIdx)
+    assert instagiffer.RunProcess(cmd + f' "{tmp_path / "magick.gif"}"')
+
+    gif.AlterGifFrameTiming(str(tmp_path / "patched.gif"))
+
+    with PIL.Image.open(tmp_path / "patched.gif") as patched, PIL.Image.open(tmp_path / "magick.gif") as magick:
+        assert patched.n_frames == magick.n_frames
+        for i in range(magick.n_frames):
+            patched.seek(i)
+            magick.seek(i)
+            assert patched.info["duration"] == magick.info["duration"], f"frame {i}"
+            assert ImageChops.difference(patched.convert("RGB"), magick.convert("RGB")).getbbox() is None, f"frame {i} differs"
+    gif.StopWorkers()
+
+
+@requires_tools
+@requires_gifsicle
+def test_optimize_gif_reports_every_tier_and_keeps_the_configured_one(tmp_path, monkeypatch, caplog, conf, make_test_video):
+    """With fileOptimizerReport, OptimizeGif runs and logs every gifsicle tier, keeps fileOptimizerTier's GIF and cleans up the rest."""
+    video = make_test_video(size="160x120")
+
+    conf.SetParam("size", "fileOptimizer", "True")
+    conf.SetParam("size", "fileOptimizerTier", "medium")
+    conf.SetParam("size", "fileOptimizerReport", "True")
+
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+    encoder = instagiffer.GifEncoder(str(tmp_path / "out.gif"), (160, 120), 0)
+    for frame in gif.GetExtractedImageList():
+        with PIL.Image.open(frame) as img:
+            encoder.AddFrame(img, 100)
+    encoder.Close()
+    original = (tmp_path / "out.gif").read_bytes()
+    (tmp_path / "medium.gif").write_bytes(original)
+    assert instagiffer.RunProcess(f'"{conf.GetParam("paths", "gifsicle")}" -O3 --colors 256 --lossy=80 "{tmp_path / "medium.gif"}" -o "{tmp_path / "medium.gif"}"')
+
+    commands = []
+    run_process = instagiffer.RunProcess
+    monkeypatch.setattr(instagiffer, "RunProcess", lambda cmd, *args, **kwargs: commands.append(cmd) or run_process(cmd, *args, **kwargs))
+    caplog.set_level("INFO")
+    gif.OptimizeGif(str(tmp_path / "out.gif"))
+
+    tiers = [name for name, _lossy in instagiffer.GIF_OPTIMIZER_TIERS]
+    assert [r.getMessage().split()[1] for r in caplog.records if r.getMessage().startswith("gifsicle ")] == tiers
+    assert (tmp_path / "out.gif").read_bytes() == (tmp_path / "medium.gif").read_bytes() != original
+    assert all(cmd.endswith('-o "%s"' % os.path.join(gif.workDir, "optimized.%s.gif" % name)) for cmd, name in zip(commands, tiers))
+    assert sorted(os.listdir(tmp_path)) == ["medium.gif", "out.gif", "video.mp4", "work"]
+    assert not [f for f in os.listdir(gif.workDir) if f.startswith("optimized.")]
+    gif.StopWorkers()
+
+
+@requires_tools
+@requires_ffprobe
+def test_media_probe_is_cached_by_size_and_mtime(tmp_path, make_test_video):
+    """MediaProbe reads what it needs from ffprobe once, then answers from its cache file until the video changes."""
+    video = make_test_video(size="160x120", rate=25, seconds=6, gop=25)
+
+    cacheFile = str(tmp_path / "probe.json")
+    probe = instagiffer.MediaProbe(_conf_tool("ffprobe"), cacheFile).Probe(str(video))
+    assert (probe["stream"]["width"], probe["stream"]["height"], probe["stream"]["r_frame_rate"]) == (160, 120, "25/1")
+    assert float(probe["format"]["duration"]) == pytest.approx(6.0)
+    assert probe["keyframeIntervalSec"] == pytest.approx(1.0)
+
+    # A new session finds it on disk, without ffprobe
+    assert instagiffer.MediaProbe("", cacheFile).Probe(str(video)) == probe
+
+    stat = os.stat(video)
+    os.utime(video, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert instagiffer.MediaProbe("", cacheFile).Probe(str(video)) is None
+
+
+@requires_tools
+def test_image_processing_redoes_changed_frames_only(tmp_path, conf, make_test_video):
+    """ImageProcessing leaves processed frames alone unless something that goes into them changed."""
+    video = make_test_video()
+
+    conf.SetParam("size", "resizePostCrop", "160x120")
+    conf.SetParam("effects", "sharpen", "False")
+
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+    assert gif.CropAndResize()
+    assert gif.ImageProcessing()
+
+    def stamps():
+        return [os.stat(f).st_mtime_ns for f in gif.GetProcessedImageList()]
+
+    before = stamps()
+    time.sleep(0.05)
+    assert gif.ImageProcessing()
+    assert stamps() == before
+
+    PIL.Image.new("RGB", (160, 120), "red").save(gif.GetResizedImageList()[2])
+    assert gif.ImageProcessing()
+    changed = [a != b for a, b in zip(before, stamps())]
+    assert changed == [idx == 2 for idx in range(len(before))]
+
+    conf.SetParam("effects", "brightness", "20")
+    before = stamps()
+    time.sleep(0.05)
+    assert gif.ImageProcessing()
+    assert all(a != b for a, b in zip(before, stamps()))
+    gif.StopWorkers()
+
+
+@requires_tools
+def test_deferred_crop_and_resize_happens_in_image_processing(tmp_path, conf, make_test_video):
+    """A deferred crop and resize stays out of date until ImageProcessing has done it, and resized/ is only written when something asks for it."""
+    video = make_test_video()
+
+    conf.SetParam("size", "resizePostCrop", "160x120")
+    conf.SetParam("effects", "sharpen", "False")
+    conf.SetParam("settings", "fusedRender", "True")
+    conf.SetParam("settings", "effectsEngine", "imagemagick")
+
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+    assert gif.DeferCropAndResize()
+    assert gif.ResizedImagesOutOfDate()
+    assert not gif.GetResizedImageList()
+
+    assert gif.ImageProcessing()
+    assert not gif.ResizedImagesOutOfDate()
+    assert not gif.GetResizedImageList()
+    processed = gif.GetProcessedImageList()
+    assert len(processed) == gif.GetNumFrames()
+    with PIL.Image.open(processed[0]) as img:
+        assert img.size == (160, 120)
+
+    assert gif.MaterializeResizedImages()
+    assert not gif.ResizedImagesOutOfDate()
+    resized = gif.GetResizedImageList()
+    assert len(resized) == len(processed)
+    assert all(psnr(a, b) > 25 for a, b in zip(resized, processed))
+
+    # Frames edited in another program need cropping and resizing again
+    time.sleep(0.05)
+    PIL.Image.new("RGB", (320, 240), "red").save(gif.GetExtractedImageList()[0])
+    gif.InvalidateFrameStores()
+    assert gif.ResizedImagesOutOfDate()
+    gif.StopWorkers()
+
+
+@requires_tools
+def test_image_processing_on_parallel_workers_keeps_frame_order_and_cancels(tmp_path, monkeypatch, conf, make_test_video):
+    """With several frame workers, every processed frame still comes from its own resized frame, and cancelling stops the batch early."""
+    video = make_test_video(seconds=2)
+
+    conf.SetParam("size", "resizePostCrop", "160x120")
+    conf.SetParam("length", "durationSec", "2.0")
+    conf.SetParam("effects", "sharpen", "False")
+    conf.SetParam("settings", "frameWorkers", "4")
+    conf.SetParam("settings", "effectsEngine", "imagemagick")
+    conf.SetParam("settings", "frameCacheMB", "0")
+
+    cancel = [False]
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: args[0] is True or not cancel[0], None)
+    gif.ExtractFrames()
+    assert gif.CropAndResize()
+    assert gif.ImageProcessing()
+
+    resized = gif.GetResizedImageList()
+    processed = gif.GetProcessedImageList()
+    assert len(processed) == len(resized) > 8
+    for idx, frame in enumerate(processed):
+        neighbours = [other for other in (idx - 1, idx + 1) if 0 <= other < len(resized)]
+        assert all(psnr(frame, resized[idx]) > psnr(frame, resized[other]) for other in neighbours), f"frame {idx + 1} is out of place"
+
+    started = []
+    runJob = gif.RunImagemagickJob
+    monkeypatch.setattr(gif, "RunImagemagickJob", lambda cmd, keepGoing: started.append(cmd) or runJob(cmd, keepGoing))
+    conf.SetParam("effects", "brightness", "20")
+    cancel[0] = True
+    with pytest.raises(RuntimeError):
+        gif.ImageProcessing()
+    assert len(started) < len(resized)
+    assert not gif.GetProcessedImageList()
+    gif.StopWorkers()
+
+
+@requires_tools
+def test_global_palette_is_shared_by_preview_and_frames(tmp_path, conf, make_test_video):
+    """With globalPalette on, the preview and every processed frame only use colors from one palette, worked out once."""
+    video = make_test_video(seconds=2)
+
+    conf.SetParam("size", "resizePostCrop", "160x120")
+    conf.SetParam("effects", "sharpen", "False")
+    conf.SetParam("color", "numColors", "48")
+    conf.SetParam("color", "globalPalette", "True")
+
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+    assert gif.CropAndResize()
+
+    def colors(path):
+        with PIL.Image.open(path) as img:
+            return set(color for _count, color in img.convert("RGB").getcolors(256))
+
+    preview = gif.GenerateFramePreview(3)
+    palette = gif.GetGlobalPalette()
+    paletteColors = colors(palette)
+    assert len(paletteColors) <= 48
+    assert colors(preview) <= paletteColors
+
+    assert gif.ImageProcessing()
+    assert gif.globalPaletteFile == palette
+    for frame in gif.GetProcessedImageList():
+        assert colors(frame) <= paletteColors, f"{os.path.basename(frame)} has colors outside the palette"
+    assert os.listdir(gif.paletteDir) == [os.path.basename(palette)]
+
+    # A crop change is sampled straight away, not from the resized frames it leaves behind
+    conf.SetParam("size", "cropEnabled", "True")
+    conf.SetParam("size", "cropOffsetX", "0")
+    conf.SetParam("size", "cropOffsetY", "0")
+    conf.SetParam("size", "cropWidth", "80")
+    conf.SetParam("size", "cropHeight", "60")
+    croppedPalette = gif.GetGlobalPalette()
+    assert croppedPalette != palette
+    assert gif.CropAndResize()
+    assert gif.GetGlobalPalette() == croppedPalette
+
+    # Palettes nothing uses any more are cleared out
+    assert gif.ImageProcessing()
+    assert os.listdir(gif.paletteDir) == [os.path.basename(croppedPalette)]
+    gif.StopWorkers()
+
+
+@requires_tools
+def test_render_frame_preview_matches_imagemagick_preview(tmp_path, conf, make_test_video):
+    """RenderFramePreview crops, resizes and processes a frame in memory close to what GenerateFramePreview gets from ImageMagick, and leaves frames it can't do to ImageMagick."""
+    video = make_test_video()
+
+    for section, key, value in [("size", "cropOffsetX", "40"), ("size", "cropOffsetY", "20"), ("size", "cropWidth", "200"), ("size", "cropHeight", "150"), ("size", "resizePostCrop", "160x120")]:
+        conf.SetParam(section, key, value)
+    for key, value in [("brightness", "0"), ("sharpen", "False"), ("sepiaTone", "True"), ("sepiaToneAmount", "80")]:
+        conf.SetParam("effects", key, value)
+
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+
+    rendered = gif.RenderFramePreview(4)
+    assert rendered.size == (160, 120)
+    with PIL.Image.open(gif.GenerateFramePreview(4)) as magick:
+        assert psnr_images(rendered, magick) > 25
+
+    conf.SetParam("effects", "oilPaint", "True")
+    assert gif.RenderFramePreview(4) is None
+    gif.StopWorkers()
+
+
+@requires_tools
+def test_generate_within_budget_finds_best_setting_under_size(tmp_path, conf, make_test_video, caplog):
+    """GenerateWithinBudget leaves a GIF under the budget that lasts as long as the full one, logs each try, and puts the settings back."""
+    video = make_test_video(seconds=2)
+
+    conf.SetParam("size", "resizePostCrop", "320x240")
+    conf.SetParam("effects", "sharpen", "False")
+    conf.SetParam("color", "numColors", "200")
+    conf.SetParam("settings", "gifEncoder", "native")
+
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+    assert gif.CropAndResize()
+    fullSize = gif.Generate()
+
+    def durations():
+        with PIL.Image.open(tmp_path / "out.gif") as out:
+            return [out.seek(i) or out.info["duration"] for i in range(out.n_frames)]
+
+    fullDurations = durations()
+    assert gif.GenerateWithinBudget(fullSize * 2) == fullSize
+
+    caplog.set_level("INFO")
+    size = gif.GenerateWithinBudget(fullSize // 3)
+    assert size == os.path.getsize(tmp_path / "out.gif") <= fullSize // 3
+    assert sum(durations()) == sum(fullDurations)
+    assert len([r for r in caplog.records if " -> " in r.getMessage()]) >= 3
+    assert (conf.GetParam("color", "numColors"), conf.GetParam("size", "resizePostCrop")) == ("200", "320x240")
+
+    # Frames are resized again at the configured size when needed
+    gif.Generate()
+    with PIL.Image.open(tmp_path / "out.gif") as out:
+        assert (out.size, out.n_frames) == ((320, 240), len(fullDurations))
+    gif.StopWorkers()
+
+
+@requires_tools
+@pytest.mark.parametrize("streaming", ["False", "True"])
+@pytest.mark.parametrize("video_fps,frame_rate,start", [(30, 10, "00:00:03.000"), (24, 15, "00:00:07.300"), (25, 10, "00:00:12.050"), (24, 30, "00:00:04.100"), (30, 10, "00:00:00.050")])
+def test_extract_frames_seek_picks_frames_by_the_fps_rule(tmp_path, conf, make_test_video, streaming, video_fps, frame_rate, start):
+    """With fixSlowdownGlitch, output frame n is the last video frame before n + 1/2 output frames past the start, from the very first frame on."""
+    video = make_test_video(size="160x120", rate=video_fps, seconds=16)
+
+    sourceDir = tmp_path / "source"
+    sourceDir.mkdir()
+    assert instagiffer.RunProcess(f'"{conf.GetParam("paths", "ffmpeg")}" -i "{video}" -fps_mode passthrough "{sourceDir}{os.sep}image%04d.png"')
+    source = sorted(sourceDir.iterdir())
+
+    conf.SetParam("settings", "fixSlowdownGlitch", "True")
+    conf.SetParam("settings", "streamExtraction", streaming)
+    conf.SetParam("length", "startTime", start)
+    conf.SetParam("length", "durationSec", "3.0")
+    conf.SetParam("rate", "frameRate", str(frame_rate))
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    gif.ExtractFrames()
+    frames = gif.GetExtractedImageList()
+    gif.StopWorkers()
+
+    assert len(frames) == 3 * frame_rate
+    startSec = instagiffer.DurationStrToMillisec(start) / 1000.0
+    for n, got in enumerate(frames):
+        # Source frame index of the output frame's cut-off. Right on it, ffmpeg's rounding of the seek decides
+        cutOff = (startSec + (n + 0.5) / frame_rate) * video_fps
+        candidates = {round(cutOff) - 1, round(cutOff)} if abs(cutOff - round(cutOff)) < 1e-3 else {math.ceil(cutOff) - 1}
+        matches = []
+        for idx in candidates:
+            with PIL.Image.open(got) as a, PIL.Image.open(source[idx]) as b:
+                if ImageChops.difference(a.convert("RGB"), b.convert("RGB")).getbbox() is None:
+                    matches.append(idx)
+        assert matches, f"{os.path.basename(got)} isn't video frame {sorted(candidates)}"
+
+
+@requires_tools
+def test_extract_frames_falls_back_to_the_lead_in(tmp_path, monkeypatch, conf, make_test_video):
+    """If ffmpeg won't run the fps filter, frames come from the old 2 second lead-in with its frames deleted."""
+    video = make_test_video(size="160x120", seconds=8)
+
+    leadInDir = tmp_path / "leadin"
+    leadInDir.mkdir()
+    assert instagiffer.RunProcess(f'"{conf.GetParam("paths", "ffmpeg")}" -sn -t 5.0 -ss 00:00:01.000 -i "{video}" -r 10 "{leadInDir}{os.sep}image%04d.png"')
+    expected = sorted(leadInDir.iterdir())[20:]
+
+    conf.SetParam("settings", "fixSlowdownGlitch", "True")
+    conf.SetParam("settings", "streamExtraction", "False")
+    conf.SetParam("settings", "extractionSegments", "1")
+    conf.SetParam("length", "startTime", "00:00:03.000")
+    conf.SetParam("length", "durationSec", "3.0")
+    conf.SetParam("rate", "frameRate", "10")
+    gif = instagiffer.AnimatedGif(conf, str(video), str(tmp_path / "work"), lambda *args: True, None)
+    seekArgs = gif.GetSeekArgs
+    monkeypatch.setattr(gif, "GetSeekArgs", lambda *args: (seekArgs(*args)[0], "fps=fps=notarate"))
+    gif.ExtractFrames()
+    frames = gif.GetExtractedImageList()
+    gif.StopWorkers()
+
+    assert [os.path.basename(f) for f in frames] == ["image%04d.png" % (n + 1) for n in range(len(expected))]
+    for got, want in zip(frames, expected):
+        with PIL.Image.open(got) as a, PIL.Image.open(want) as b:
+            assert ImageChops.difference(a.convert("RGB"), b.convert("RGB")).getbbox() is None, f"{os.path.basename(got)} differs"